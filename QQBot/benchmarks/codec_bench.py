@@ -0,0 +1,85 @@
+"""网关帧解析/回复序列化微基准
+
+在 QQBot 目录下运行: python benchmarks/codec_bench.py [次数]
+对比标准库 json + dict 取字段 与 utils.codec 当前后端 + 轻量结构体 的耗时。
+"""
+import json
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import codec
+from utils.codec import MessageEvent, decode_frame
+
+FRAME = json.dumps({
+    "op": 0,
+    "s": 42,
+    "t": "GROUP_AT_MESSAGE_CREATE",
+    "id": "GROUP_AT_MESSAGE_CREATE:abcdef0123456789",
+    "d": {
+        "id": "ROBOT1.0_abcdef0123456789abcdef0123456789",
+        "content": " /运行状态 5",
+        "timestamp": "2024-01-01T00:00:00+08:00",
+        "group_id": "G1234567890",
+        "group_openid": "C9F778FE6ADF9D1D1DBE395BF744A33A",
+        "author": {
+            "id": "E4F4AEA33253A2797FB897C50B81D7ED",
+            "member_openid": "E4F4AEA33253A2797FB897C50B81D7ED"
+        },
+        "attachments": []
+    }
+}, ensure_ascii=False)
+
+PAYLOAD = {
+    "content": "🕒 运行时间: 1天2小时3分\n💻 CPU使用率: 12.5%\n🧠 内存使用: 512.0MB / 2048.0MB",
+    "msg_type": 0,
+    "msg_id": "ROBOT1.0_abcdef0123456789abcdef0123456789",
+    "msg_seq": "1"
+}
+
+
+def stdlib_decode():
+    data = json.loads(FRAME)
+    d = data['d']
+    logging.debug(f"Raw message data: {data}")
+    return (data['t'], d['id'], d['content'].strip(), d.get('group_openid'),
+            d['author'].get('member_openid'), d['author'].get('user_openid'))
+
+
+def codec_decode():
+    frame = decode_frame(FRAME)
+    logging.debug("Raw message data: %r", frame)
+    return MessageEvent.from_frame(frame)
+
+
+def stdlib_encode():
+    # aiohttp 的 json= 参数默认使用 json.dumps 后再编码为 bytes
+    return json.dumps(PAYLOAD).encode('utf-8')
+
+
+def codec_encode():
+    return codec.dumps(PAYLOAD)
+
+
+def bench(func, number: int) -> float:
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    logging.basicConfig(level=logging.INFO)
+    print(f"codec 后端: {codec.BACKEND}，每项 {number} 次，取 5 轮最小值")
+    for name, baseline, candidate in (
+        ('解析网关帧', stdlib_decode, codec_decode),
+        ('序列化回复', stdlib_encode, codec_encode),
+    ):
+        base = bench(baseline, number)
+        fast = bench(candidate, number)
+        print(f"{name}: 标准库 {base:.2f}µs  codec {fast:.2f}µs  提升 {base / fast:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+"""端到端压测：本地模拟网关 + 模拟开放平台接口
+
+在 QQBot 目录下运行: python benchmarks/load_test.py --rate 500 --count 5000
+
+模拟网关按设定速率下发 GROUP_AT_MESSAGE_CREATE / C2C_MESSAGE_CREATE / GROUP_ADD_ROBOT 帧，
+消息经真实的 websocket_listener → process_message → message_sender 链路处理，
+模拟接口负责签发 access_token 并接收回复，最终输出吞吐、端到端延迟分位数和内存占用。
+插件在临时工作目录中运行（plugins 目录以软链接引入），不会改动仓库内的统计数据库。
+使用 --hot 0.5 时一半的群消息来自同一个群，用于对比刷屏群与其他会话的延迟（检查公平调度）。
+使用 --outbox 时回复先写入工作目录下的发件箱数据库再发送，用于衡量持久化的开销。
+使用 --redeliver N 时每 N 帧重投一次同一事件，模拟断线重连后的重复分发，用于检查去重是否生效。
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import websockets
+from aiohttp import web
+
+BOT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BOT_ROOT)
+
+# 默认消息构成：权重越大出现越多
+DEFAULT_MIX = 'group=8,c2c=1,event=1'
+# 群聊/单聊消息触发的命令（基本指令插件，纯内存计算）
+BENCH_COMMAND = '/获取ID'
+
+
+def rss_mb():
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 / 1024
+    except ImportError:
+        import resource
+        # Linux 下 ru_maxrss 单位为 KB
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class FakeOpenAPI:
+    """模拟 access_token 接口和消息发送接口，记录每条回复到达的时间"""
+
+    def __init__(self):
+        self.replies: Dict[str, float] = {}
+        self.duplicate_replies = 0
+        self.token_requests = 0
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/app/getAppAccessToken', self._token)
+        app.router.add_post('/v2/groups/{openid}/messages', self._message)
+        app.router.add_post('/v2/users/{openid}/messages', self._message)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def _token(self, request):
+        self.token_requests += 1
+        return web.json_response({'access_token': 'bench-token', 'expires_in': '7200'})
+
+    async def _message(self, request):
+        body = await request.json()
+        if body['msg_id'] in self.replies:
+            self.duplicate_replies += 1
+        self.replies.setdefault(body['msg_id'], time.perf_counter())
+        return web.json_response({'id': 'reply', 'timestamp': 0})
+
+
+class FakeGateway:
+    """模拟网关：完成 Hello/Identify 握手后按速率下发事件帧"""
+
+    def __init__(self, rate: float, count: int, mix: Dict[str, int], groups: int, redeliver: int = 0,
+                 hot: float = 0.0):
+        self.rate = rate
+        self.count = count
+        self.redeliver = redeliver
+        self.hot = hot
+        self.hot_ids = set()
+        self._random = random.Random(0)
+        self.frames_sent = 0
+        self.kinds = [kind for kind, weight in mix.items() for _ in range(weight)]
+        self.groups = groups
+        self.sent_at: Dict[str, float] = {}
+        self.reply_expected = 0
+        self.started_at = None
+        self.finished_at = None
+        self.done = asyncio.Event()
+        self.server = None
+        self.url = None
+
+    async def start(self):
+        self.server = await websockets.serve(self._handler, '127.0.0.1', 0)
+        port = next(iter(self.server.sockets)).getsockname()[1]
+        self.url = f"ws://127.0.0.1:{port}"
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def _frame(self, seq: int) -> str:
+        kind = self.kinds[seq % len(self.kinds)]
+        group = f"G{seq % self.groups:05d}"
+        member = f"M{seq % 997:05d}"
+        msg_id = f"bench-{seq}"
+        if kind == 'event':
+            event_type = 'GROUP_ADD_ROBOT'
+            d = {'group_openid': group, 'op_member_openid': member, 'timestamp': int(time.time())}
+        elif kind == 'c2c':
+            event_type = 'C2C_MESSAGE_CREATE'
+            d = {'id': msg_id, 'content': BENCH_COMMAND, 'author': {'user_openid': member}}
+        else:
+            event_type = 'GROUP_AT_MESSAGE_CREATE'
+            if self.hot and self._random.random() < self.hot:
+                group = 'HOT-GROUP'
+                self.hot_ids.add(msg_id)
+            d = {'id': msg_id, 'content': f" {BENCH_COMMAND}", 'group_openid': group,
+                 'author': {'member_openid': member}}
+        if kind != 'event':
+            self.reply_expected += 1
+            self.sent_at[msg_id] = time.perf_counter()
+        return json.dumps({'op': 0, 's': seq + 1, 't': event_type, 'id': f"{event_type}:{msg_id}", 'd': d})
+
+    async def _handler(self, websocket):
+        await websocket.send(json.dumps({'op': 10, 'd': {'heartbeat_interval': 30000}}))
+        try:
+            async for message in websocket:
+                data = json.loads(message)
+                if data['op'] == 1:
+                    await websocket.send(json.dumps({'op': 11}))
+                elif data['op'] in (2, 6):
+                    await websocket.send(json.dumps({'op': 0, 's': 0, 't': 'READY', 'd': {'session_id': 'bench'}}))
+                    asyncio.create_task(self._emit(websocket))
+        except websockets.exceptions.ConnectionClosed:
+            # 压测结束时客户端直接取消监听任务
+            pass
+
+    async def _emit(self, websocket):
+        # 每个时间片批量下发，避免高速率下 sleep 精度成为瓶颈
+        tick = 0.01
+        per_tick = max(1, int(self.rate * tick))
+        self.started_at = time.perf_counter()
+        seq = itertools.count()
+        sent = 0
+        while sent < self.count:
+            batch = min(per_tick, self.count - sent)
+            for _ in range(batch):
+                index = next(seq)
+                frame = self._frame(index)
+                await websocket.send(frame)
+                self.frames_sent += 1
+                if self.redeliver and index % self.redeliver == 0:
+                    await websocket.send(frame)
+                    self.frames_sent += 1
+            sent += batch
+            target = self.started_at + sent / self.rate
+            await asyncio.sleep(max(0, target - time.perf_counter()))
+        self.finished_at = time.perf_counter()
+        self.done.set()
+
+
+async def run_benchmark(args) -> Dict[str, float]:
+    # 插件加载依赖当前目录，须在切换工作目录后再导入
+    from fetch_access_token import token_manager
+    from message_sender import init_sender, close_sender
+    from message_processor import admission
+    import websocket_handler
+    # 网关模块导入时会把根日志调回 INFO，压测期间只保留告警
+    logging.getLogger().setLevel(logging.WARNING)
+
+    api = FakeOpenAPI()
+    await api.start()
+    mix = {kind: int(weight) for kind, weight in (part.split('=') for part in args.mix.split(','))}
+    gateway = FakeGateway(args.rate, args.count, mix, args.groups, args.redeliver, args.hot)
+    await gateway.start()
+
+    sender_config = {'api_base': api.url}
+    if args.outbox:
+        sender_config['outbox_path'] = 'outbox.db'
+    if not args.real_limits:
+        # 默认放开发送限速，测量的是机器人自身的处理能力
+        sender_config.update({'route_rate': 1e6, 'route_burst': 1e6, 'global_rate': 1e6, 'global_burst': 1e6})
+        admission.configure({'enabled': False})
+    token_manager.api_url = api.url + '/app/getAppAccessToken'
+    sender = await init_sender(sender_config)
+    await token_manager.start(sender.session)
+
+    rss_before = rss_mb()
+    listener = asyncio.create_task(websocket_handler.websocket_listener(
+        gateway.url,
+        {'workers': args.workers, 'max_size': args.queue_size, 'overflow': 'block'},
+        {'backoff_base': 0.1, 'backoff_max': 1}
+    ))
+    rss_peak = rss_before
+    try:
+        await asyncio.wait_for(gateway.done.wait(), args.count / args.rate + args.timeout)
+        deadline = time.perf_counter() + args.timeout
+        while time.perf_counter() < deadline:
+            rss_peak = max(rss_peak, rss_mb())
+            pipeline = websocket_handler.pipeline
+            if pipeline and pipeline.processed + pipeline.failed >= gateway.frames_sent:
+                break
+            await asyncio.sleep(0.05)
+        finished = time.perf_counter()
+        pipeline_stats = websocket_handler.pipeline.stats()
+        dedup_hits = websocket_handler.dedup.hits if websocket_handler.dedup else 0
+    finally:
+        listener.cancel()
+        await asyncio.gather(listener, return_exceptions=True)
+        await token_manager.close()
+        await close_sender()
+        await gateway.stop()
+        await api.stop()
+
+    latencies, hot_latencies, other_latencies = [], [], []
+    for msg_id, sent_at in gateway.sent_at.items():
+        if msg_id in api.replies:
+            latency = (api.replies[msg_id] - sent_at) * 1000
+            latencies.append(latency)
+            (hot_latencies if msg_id in gateway.hot_ids else other_latencies).append(latency)
+    elapsed = finished - gateway.started_at
+    return {
+        'frames': gateway.frames_sent,
+        'elapsed': elapsed,
+        'throughput': pipeline_stats['processed'] / elapsed if elapsed else 0.0,
+        'replies': len(latencies),
+        'reply_expected': gateway.reply_expected,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'max': max(latencies) if latencies else 0.0,
+        'hot_p99': percentile(hot_latencies, 0.99),
+        'other_p99': percentile(other_latencies, 0.99),
+        'max_depth': pipeline_stats['max_depth'],
+        'failed': pipeline_stats['failed'],
+        'token_requests': api.token_requests,
+        'dedup_hits': dedup_hits,
+        'outbox': sender.outbox.stats() if sender.outbox else None,
+        'duplicate_replies': api.duplicate_replies,
+        'rss_before': rss_before,
+        'rss_peak': rss_peak,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="QQBot 端到端压测")
+    parser.add_argument('--rate', type=float, default=500, help="每秒下发的帧数")
+    parser.add_argument('--count', type=int, default=5000, help="下发的帧总数")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="消息构成权重，如 group=8,c2c=1,event=1")
+    parser.add_argument('--groups', type=int, default=200, help="模拟的群数量")
+    parser.add_argument('--workers', type=int, default=10, help="消息管道工作协程数")
+    parser.add_argument('--queue-size', type=int, default=1000, help="消息管道队列容量")
+    parser.add_argument('--timeout', type=float, default=30, help="下发结束后等待处理完成的最长时间（秒）")
+    parser.add_argument('--hot', type=float, default=0.0, help="群消息中来自同一个刷屏群的比例，0 表示均匀分布")
+    parser.add_argument('--outbox', action='store_true', help="开启发件箱（回复落盘后再发送）")
+    parser.add_argument('--redeliver', type=int, default=0, help="每 N 帧重投一次同一事件，0 表示不重投")
+    parser.add_argument('--real-limits', action='store_true', help="保留发送器限速和入站限流的默认配置")
+    parser.add_argument('--workdir', help="插件工作目录，默认使用临时目录")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='qqbot-bench-')
+    plugins_link = os.path.join(workdir, 'plugins')
+    if not os.path.exists(plugins_link):
+        try:
+            os.symlink(os.path.join(BOT_ROOT, 'plugins'), plugins_link, target_is_directory=True)
+        except OSError:
+            shutil.copytree(os.path.join(BOT_ROOT, 'plugins'), plugins_link)
+    os.chdir(workdir)
+
+    import message_processor
+    try:
+        result = asyncio.run(run_benchmark(args))
+    finally:
+        message_processor.plugin_manager.shutdown()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"帧数: {result['frames']}，耗时 {result['elapsed']:.2f}s，吞吐 {result['throughput']:.0f} 条/秒")
+    print(f"回复: {result['replies']}/{result['reply_expected']}，管道失败 {result['failed']}，"
+          f"最大队列深度 {result['max_depth']}，令牌请求 {result['token_requests']} 次")
+    if args.hot:
+        print(f"刷屏群 p99 {result['hot_p99']:.2f}ms，其他会话 p99 {result['other_p99']:.2f}ms")
+    if result['outbox']:
+        print(f"发件箱: {result['outbox']}")
+    if args.redeliver:
+        print(f"去重: 拦截重投 {result['dedup_hits']} 次，重复回复 {result['duplicate_replies']} 条")
+    print(f"端到端延迟: p50 {result['p50']:.2f}ms  p99 {result['p99']:.2f}ms  max {result['max']:.2f}ms")
+    print(f"内存: 启动 {result['rss_before']:.1f}MB  峰值 {result['rss_peak']:.1f}MB")
+    # 回复缺失时以非零状态退出，便于在发布前的检查脚本中使用
+    ok = result['replies'] == result['reply_expected'] and result['duplicate_replies'] == 0
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
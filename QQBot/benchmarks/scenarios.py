@@ -0,0 +1,446 @@
+"""协议场景检查：本地模拟网关和消息接口，验证断线恢复、重连和发送重试逻辑
+
+在 QQBot 目录下运行: python benchmarks/scenarios.py [场景名 ...]
+
+网关场景启动一个按脚本行事的模拟网关，让真实的 GatewayClient 连上去，
+检查其发出的 Identify / Resume 是否符合预期（会话 ID、序号）以及事件是否完整送达。
+发送场景让真实的 MessageSender 指向按脚本返回状态码的模拟接口，
+检查限流（429 与 Retry-After）、服务端错误的重试次数、间隔和请求体。
+任一场景失败时以非零状态退出，便于在发布前的检查脚本中使用。
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import websockets
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 单个场景的最长运行时间（秒）
+SCENARIO_TIMEOUT = 15
+# 缩短重连退避，场景在一两秒内完成
+FAST_RECONNECT = {'backoff_base': 0.05, 'backoff_max': 0.2}
+# 发送场景放开限速并缩短重试退避，重试间隔只取决于退避或 Retry-After
+FAST_SENDER = {
+    'route_rate': 1e6, 'route_burst': 1e6, 'global_rate': 1e6, 'global_burst': 1e6,
+    'retry_base_delay': 0.05, 'retry_max_delay': 0.2, 'max_retries': 3
+}
+
+
+class ScriptedGateway:
+    """模拟网关：记录每个连接的鉴权/恢复请求，鉴权完成后按场景脚本下发事件和控制帧
+
+    script(gateway, websocket, index) 在第 index 个连接鉴权完成后执行；
+    ack=False 时不回复心跳 ACK，模拟僵死连接。
+    """
+
+    def __init__(self, script: Callable, heartbeat_interval: int = 30000):
+        self.script = script
+        self.heartbeat_interval = heartbeat_interval
+        self.ack = True
+        self.session_id = 'session-1'
+        # 每个连接收到的鉴权(op 2)或恢复(op 6)请求
+        self.handshakes: List[dict] = []
+        self.heartbeats = 0
+        self.close_codes: List[Optional[int]] = []
+        self.server = None
+        self.url = None
+
+    async def start(self):
+        self.server = await websockets.serve(self._handler, '127.0.0.1', 0)
+        port = next(iter(self.server.sockets)).getsockname()[1]
+        self.url = f"ws://127.0.0.1:{port}"
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _handler(self, websocket):
+        index = len(self.close_codes)
+        self.close_codes.append(None)
+        script = None
+        await websocket.send(json.dumps({'op': 10, 'd': {'heartbeat_interval': self.heartbeat_interval}}))
+        try:
+            async for message in websocket:
+                data = json.loads(message)
+                if data['op'] == 1:
+                    self.heartbeats += 1
+                    if self.ack:
+                        await websocket.send(json.dumps({'op': 11}))
+                elif data['op'] in (2, 6):
+                    self.handshakes.append(data)
+                    if data['op'] == 2:
+                        self.session_id = f"session-{len(self.handshakes)}"
+                        ready = {'op': 0, 's': 0, 't': 'READY', 'd': {'session_id': self.session_id}}
+                    else:
+                        ready = {'op': 0, 't': 'RESUMED', 'd': ''}
+                    await websocket.send(json.dumps(ready))
+                    script = asyncio.create_task(self.script(self, websocket, index))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            if script is not None:
+                script.cancel()
+                await asyncio.gather(script, return_exceptions=True)
+            self.close_codes[index] = websocket.close_code
+
+    @staticmethod
+    async def dispatch(websocket, seq: int, event_type: str = 'C2C_MESSAGE_CREATE'):
+        await websocket.send(json.dumps({
+            'op': 0, 's': seq, 't': event_type, 'id': f"{event_type}:E{seq}",
+            'd': {'id': f"M{seq}", 'content': '/获取ID', 'author': {'user_openid': 'U1'}}
+        }))
+
+
+async def run_client(gateway: ScriptedGateway, until: Callable[[List[int]], bool],
+                     handler: Callable[[object], Awaitable[None]] = None,
+                     pipeline_config: Dict = None) -> Tuple[List[int], bool]:
+    """运行真实的 GatewayClient 直到 until(已收到的事件序号) 成立，返回 (事件序号, 客户端是否自行退出)"""
+    import websocket_handler
+    from utils.message_pipeline import MessagePipeline
+
+    received: List[int] = []
+
+    async def record(frame):
+        if handler is not None:
+            await handler(frame)
+        received.append(frame.s)
+
+    pipeline = MessagePipeline(record, pipeline_config)
+    await pipeline.start()
+    client = websocket_handler.GatewayClient(gateway.url, pipeline, FAST_RECONNECT)
+    task = asyncio.create_task(client.run())
+    deadline = time.monotonic() + SCENARIO_TIMEOUT
+    try:
+        while not until(received) and not task.done() and time.monotonic() < deadline:
+            await asyncio.sleep(0.02)
+        stopped = task.done()
+    finally:
+        await client.close()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await pipeline.stop()
+    return received, stopped
+
+
+def ops(gateway: ScriptedGateway) -> List[int]:
+    return [handshake['op'] for handshake in gateway.handshakes]
+
+
+async def scenario_resume() -> Tuple[bool, str]:
+    """断线后以原会话 ID 和最后序号恢复，恢复后继续收到事件"""
+    async def script(gateway, websocket, index):
+        if index == 0:
+            for seq in (1, 2, 3):
+                await gateway.dispatch(websocket, seq)
+            await asyncio.sleep(0.1)
+            await websocket.close(code=1011)
+        else:
+            await gateway.dispatch(websocket, 4)
+
+    gateway = ScriptedGateway(script)
+    await gateway.start()
+    try:
+        received, _ = await run_client(gateway, lambda r: 4 in r)
+    finally:
+        await gateway.stop()
+    resume = gateway.handshakes[1]['d'] if len(gateway.handshakes) > 1 else {}
+    ok = (ops(gateway) == [2, 6] and resume.get('session_id') == 'session-1' and resume.get('seq') == 3
+          and sorted(received) == [1, 2, 3, 4])
+    return ok, f"握手 {ops(gateway)}，恢复参数 {resume.get('session_id')}/{resume.get('seq')}，事件 {sorted(received)}"
+
+
+async def scenario_reconnect() -> Tuple[bool, str]:
+    """收到 op 7 后断开并恢复会话"""
+    async def script(gateway, websocket, index):
+        if index == 0:
+            await gateway.dispatch(websocket, 1)
+            await websocket.send(json.dumps({'op': 7}))
+        else:
+            await gateway.dispatch(websocket, 2)
+
+    gateway = ScriptedGateway(script)
+    await gateway.start()
+    try:
+        received, _ = await run_client(gateway, lambda r: 2 in r)
+    finally:
+        await gateway.stop()
+    resume = gateway.handshakes[1]['d'] if len(gateway.handshakes) > 1 else {}
+    ok = ops(gateway) == [2, 6] and resume.get('seq') == 1 and sorted(received) == [1, 2]
+    return ok, f"握手 {ops(gateway)}，恢复序号 {resume.get('seq')}，事件 {sorted(received)}"
+
+
+async def scenario_invalid_session() -> Tuple[bool, str]:
+    """收到 op 9（不可恢复）后丢弃会话，重新鉴权而不是恢复"""
+    async def script(gateway, websocket, index):
+        if index == 0:
+            await gateway.dispatch(websocket, 1)
+            await websocket.send(json.dumps({'op': 9, 'd': False}))
+        else:
+            await gateway.dispatch(websocket, 1)
+
+    gateway = ScriptedGateway(script)
+    await gateway.start()
+    try:
+        received, _ = await run_client(gateway, lambda r: len(r) >= 2)
+    finally:
+        await gateway.stop()
+    return ops(gateway) == [2, 2] and len(received) == 2, f"握手 {ops(gateway)}，事件 {received}"
+
+
+async def scenario_session_invalid_close() -> Tuple[bool, str]:
+    """会话失效类关闭码（4009）后重新鉴权"""
+    async def script(gateway, websocket, index):
+        if index == 0:
+            await gateway.dispatch(websocket, 1)
+            await asyncio.sleep(0.1)
+            await websocket.close(code=4009)
+        else:
+            await gateway.dispatch(websocket, 1)
+
+    gateway = ScriptedGateway(script)
+    await gateway.start()
+    try:
+        received, _ = await run_client(gateway, lambda r: len(r) >= 2)
+    finally:
+        await gateway.stop()
+    return ops(gateway) == [2, 2], f"握手 {ops(gateway)}，事件 {received}"
+
+
+async def scenario_fatal_close() -> Tuple[bool, str]:
+    """不可恢复的关闭码（4914）后停止重连"""
+    async def script(gateway, websocket, index):
+        await websocket.close(code=4914)
+
+    gateway = ScriptedGateway(script)
+    await gateway.start()
+    try:
+        _, stopped = await run_client(gateway, lambda r: False)
+    finally:
+        await gateway.stop()
+    return stopped and len(gateway.handshakes) == 1, f"连接 {len(gateway.handshakes)} 次，客户端已停止: {stopped}"
+
+
+async def scenario_zombie() -> Tuple[bool, str]:
+    """心跳得不到 ACK 时主动断开（4000）并恢复会话"""
+    async def script(gateway, websocket, index):
+        if index == 0:
+            await gateway.dispatch(websocket, 1)
+            gateway.ack = False
+        else:
+            gateway.ack = True
+            await gateway.dispatch(websocket, 2)
+
+    gateway = ScriptedGateway(script, heartbeat_interval=200)
+    await gateway.start()
+    try:
+        received, _ = await run_client(gateway, lambda r: 2 in r)
+    finally:
+        await gateway.stop()
+    ok = ops(gateway) == [2, 6] and gateway.close_codes[0] == 4000 and sorted(received) == [1, 2]
+    return ok, f"握手 {ops(gateway)}，首个连接关闭码 {gateway.close_codes[0]}，事件 {sorted(received)}"
+
+
+async def scenario_backpressure() -> Tuple[bool, str]:
+    """管道满时暂停读取（背压），心跳不应被判定为丢失而触发重连"""
+    total = 60
+
+    async def script(gateway, websocket, index):
+        for seq in range(1, total + 1):
+            await gateway.dispatch(websocket, seq)
+
+    async def slow(frame):
+        await asyncio.sleep(0.02)
+
+    gateway = ScriptedGateway(script, heartbeat_interval=200)
+    await gateway.start()
+    try:
+        received, _ = await run_client(gateway, lambda r: len(r) >= total, slow, {'workers': 1, 'max_size': 5})
+    finally:
+        await gateway.stop()
+    ok = len(gateway.handshakes) == 1 and len(received) == total and gateway.heartbeats >= 3
+    return ok, f"连接 {len(gateway.handshakes)} 次，心跳 {gateway.heartbeats} 次，事件 {len(received)}/{total}"
+
+
+class ScriptedAPI:
+    """模拟消息发送接口：按脚本依次返回 (状态码, 响应头, 响应体)，脚本用完后重复最后一项
+
+    记录每个请求到达的时间和请求体，用于检查重试次数、间隔以及重试时请求体是否保持不变。
+    """
+
+    def __init__(self, script: List[Tuple[int, Dict[str, str], dict]]):
+        self.script = script
+        self.requests: List[Tuple[float, dict]] = []
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/v2/groups/{openid}/messages', self._message)
+        app.router.add_post('/v2/users/{openid}/messages', self._message)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def _message(self, request):
+        self.requests.append((time.monotonic(), await request.json()))
+        status, headers, body = self.script[min(len(self.requests), len(self.script)) - 1]
+        return web.json_response(body, status=status, headers=headers)
+
+    def gaps(self) -> List[float]:
+        """相邻两次请求的间隔（秒）"""
+        times = [at for at, _ in self.requests]
+        return [round(later - earlier, 2) for earlier, later in zip(times, times[1:])]
+
+
+async def run_sender(api: ScriptedAPI, contents: List[str], config: Dict = None) -> Tuple[List[bool], object]:
+    """用真实的 MessageSender 向同一个群发送 contents，返回 (各条是否成功, 发送器)"""
+    from message_sender import MessageSender
+
+    sender = MessageSender({**FAST_SENDER, **(config or {}), 'api_base': api.url})
+    await sender.start()
+    try:
+        results = await asyncio.wait_for(asyncio.gather(*(
+            sender.post_message(sender.group_url.format('G1'), 'scenario-token', content, 'M1', str(seq),
+                                route='group:G1')
+            for seq, content in enumerate(contents, 1)
+        )), SCENARIO_TIMEOUT)
+    finally:
+        await sender.close()
+    return list(results), sender
+
+
+async def scenario_rate_limited() -> Tuple[bool, str]:
+    """429 时按 Retry-After 暂停该路由，到期后重试成功，同一路由的其他消息不提前发送"""
+    retry_after = 0.5
+    api = ScriptedAPI([(429, {'Retry-After': str(retry_after)}, {'code': 429, 'message': 'too many requests'}),
+                       (200, {}, {'id': 'reply'})])
+    await api.start()
+    try:
+        # 单个发送协程：第二条在第一条被限流之后才出队，检查的是路由暂停而不是并发的在途请求
+        results, sender = await run_sender(api, ['第一条', '第二条'], {'workers': 1})
+    finally:
+        await api.stop()
+    # 第一个请求被限流，之后的请求都应在 Retry-After 之后才到达
+    first = api.requests[0][0] if api.requests else 0
+    waited = min((at - first for at, _ in api.requests[1:]), default=0)
+    ok = (results == [True, True] and len(api.requests) == 3 and waited >= retry_after * 0.9
+          and sender.rate_limited == 1 and sender.retried == 1)
+    return ok, f"结果 {results}，请求 {len(api.requests)} 次，限流后首个请求等待 {waited:.2f} 秒"
+
+
+async def scenario_rate_limit_code() -> Tuple[bool, str]:
+    """响应体中的频率限制错误码（22009）按限流处理并重试"""
+    api = ScriptedAPI([(400, {}, {'code': 22009, 'message': 'msg limit exceed'}), (200, {}, {'id': 'reply'})])
+    await api.start()
+    try:
+        results, sender = await run_sender(api, ['限流错误码'])
+    finally:
+        await api.stop()
+    ok = results == [True] and len(api.requests) == 2 and sender.rate_limited == 1
+    return ok, f"结果 {results}，请求 {len(api.requests)} 次，限流 {sender.rate_limited} 次"
+
+
+async def scenario_server_errors() -> Tuple[bool, str]:
+    """5xx 按指数退避重试，请求体（含 msg_seq）保持不变，最终送达"""
+    api = ScriptedAPI([(500, {}, {'code': 500}), (502, {}, {'code': 502}), (200, {}, {'id': 'reply'})])
+    await api.start()
+    try:
+        results, sender = await run_sender(api, ['服务端错误'])
+    finally:
+        await api.stop()
+    bodies = [body for _, body in api.requests]
+    gaps = api.gaps()
+    base = FAST_SENDER['retry_base_delay']
+    ok = (results == [True] and len(bodies) == 3 and all(body == bodies[0] for body in bodies)
+          and len(gaps) == 2 and gaps[0] >= base * 0.9 and gaps[1] >= base * 2 * 0.9 and sender.retried == 2)
+    return ok, f"结果 {results}，请求 {len(bodies)} 次，重试间隔 {gaps}，msg_seq {[body.get('msg_seq') for body in bodies]}"
+
+
+async def scenario_client_error() -> Tuple[bool, str]:
+    """不属于限流的 4xx 不重试，直接返回失败"""
+    api = ScriptedAPI([(400, {}, {'code': 40034, 'message': 'invalid request'})])
+    await api.start()
+    try:
+        results, sender = await run_sender(api, ['请求错误'])
+    finally:
+        await api.stop()
+    ok = results == [False] and len(api.requests) == 1 and sender.retried == 0
+    return ok, f"结果 {results}，请求 {len(api.requests)} 次"
+
+
+async def scenario_retries_exhausted() -> Tuple[bool, str]:
+    """持续 5xx 时重试 max_retries 次后放弃"""
+    api = ScriptedAPI([(503, {}, {'code': 503})])
+    await api.start()
+    try:
+        results, sender = await run_sender(api, ['持续失败'])
+    finally:
+        await api.stop()
+    expected = FAST_SENDER['max_retries'] + 1
+    ok = results == [False] and len(api.requests) == expected and sender.failed == 1
+    return ok, f"结果 {results}，请求 {len(api.requests)}/{expected} 次，重试间隔 {api.gaps()}"
+
+
+SCENARIOS = {
+    'resume': scenario_resume,
+    'reconnect': scenario_reconnect,
+    'invalid_session': scenario_invalid_session,
+    'session_invalid_close': scenario_session_invalid_close,
+    'fatal_close': scenario_fatal_close,
+    'zombie': scenario_zombie,
+    'backpressure': scenario_backpressure,
+    'rate_limited': scenario_rate_limited,
+    'rate_limit_code': scenario_rate_limit_code,
+    'server_errors': scenario_server_errors,
+    'client_error': scenario_client_error,
+    'retries_exhausted': scenario_retries_exhausted,
+}
+
+
+async def run_scenarios(names: List[str]) -> bool:
+    from fetch_access_token import token_manager
+    # 网关模块导入时会把根日志调回 INFO，场景运行期间只保留错误
+    import websocket_handler  # noqa: F401
+    logging.getLogger().setLevel(logging.ERROR)
+    # 模拟网关不校验令牌，预置一个长期有效的令牌，不访问真实接口
+    token_manager.access_token = 'scenario-token'
+    token_manager.expires_in = 7200
+    token_manager.expiration_time = time.time() + 7200
+
+    passed = True
+    for name in names:
+        try:
+            ok, detail = await asyncio.wait_for(SCENARIOS[name](), SCENARIO_TIMEOUT + 5)
+        except Exception as e:
+            ok, detail = False, f"{type(e).__name__}: {e}"
+        passed = passed and ok
+        print(f"{'✅' if ok else '❌'} {name}: {SCENARIOS[name].__doc__.strip()} — {detail}")
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="QQBot 协议场景检查")
+    parser.add_argument('names', nargs='*', help=f"只运行指定场景，默认全部：{', '.join(SCENARIOS)}")
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"未知的场景: {', '.join(unknown)}")
+    logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(0 if asyncio.run(run_scenarios(args.names or list(SCENARIOS))) else 1)
+
+
+if __name__ == '__main__':
+    main()
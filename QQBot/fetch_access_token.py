@@ -1,6 +1,8 @@
-import requests
+import asyncio
+import aiohttp
 import logging
 import time
+from typing import Optional
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -9,29 +11,201 @@ APP_ID = 'APPID'
 CLIENT_SECRET = '秘钥'
 BOT_API_URL = 'https://bots.qq.com/app/getAppAccessToken'
 
-# 全局变量存储 access_token 和过期时间
-current_access_token = None
-token_expiration_time = 0
+# 剩余有效期低于该值时视为即将过期，必须同步刷新（秒）
+EXPIRY_MARGIN = 60
+# 后台提前刷新的时间（秒），应大于 EXPIRY_MARGIN，保证请求路径上基本不需要等待刷新
+REFRESH_AHEAD = 300
+# 后台刷新失败后的重试间隔（秒）
+RETRY_INTERVAL = 5
+# 分片模式下从共享存储同步令牌的间隔（秒）
+SHARED_POLL_INTERVAL = 30
 
-async def fetch_access_token():
-    global current_access_token, token_expiration_time
-    
-    # 检查当前 access_token 是否即将过期（剩余60秒内）
-    if time.time() >= token_expiration_time - 60:
+
+class AccessTokenManager:
+    """异步 access_token 管理器
+
+    - 使用 aiohttp 非阻塞刷新
+    - 并发调用方共享同一个进行中的刷新请求（single-flight）
+    - 后台任务在过期前主动刷新
+    - 多进程分片时可挂接共享存储，由监督进程统一刷新，各分片只读取
+    """
+
+    def __init__(self, app_id: str = APP_ID, client_secret: str = CLIENT_SECRET, api_url: str = BOT_API_URL):
+        self.app_id = app_id
+        self.client_secret = client_secret
+        self.api_url = api_url
+        self.access_token: Optional[str] = None
+        self.expiration_time = 0.0
+        self.expires_in = 0
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._owns_session = False
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._background_task: Optional[asyncio.Task] = None
+        # 跨进程共享的令牌存储（multiprocessing.Manager 的 dict 与 Lock）
+        self.shared_store = None
+        self.shared_lock = None
+        self.shared_consumer = False
+
+    def attach_shared_store(self, store, lock, consumer: bool = False):
+        """挂接跨进程共享存储
+
+        consumer=True 时（分片进程）优先采用共享存储中的令牌，仅在其失效时
+        持跨进程锁自行刷新；否则（监督进程）负责刷新并发布到共享存储。
+        """
+        self.shared_store = store
+        self.shared_lock = lock
+        self.shared_consumer = consumer
+
+    def _is_valid(self) -> bool:
+        return self.access_token is not None and time.time() < self.expiration_time - EXPIRY_MARGIN
+
+    async def start(self, session: aiohttp.ClientSession = None):
+        """启动后台刷新任务，可传入共享会话以复用连接池"""
+        if session is not None:
+            self._session = session
+            self._owns_session = False
+        if self._background_task is None or self._background_task.done():
+            self._background_task = asyncio.create_task(self._background_refresh())
+
+    async def close(self):
+        """停止后台任务并释放自建会话"""
+        for task in (self._background_task, self._refresh_task):
+            if task and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+        self._background_task = None
+        self._refresh_task = None
+        if self._owns_session and self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def get_token(self) -> str:
+        """获取有效的 access_token，必要时等待（共享的）刷新结果"""
+        if self._is_valid():
+            return self.access_token
+        return await self.refresh()
+
+    async def refresh(self) -> str:
+        """刷新 access_token；已有刷新在进行中时直接等待其结果"""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._do_refresh())
+        # shield：单个调用方被取消时不影响其他等待者
+        return await asyncio.shield(self._refresh_task)
+
+    async def _do_refresh(self) -> str:
+        if self.shared_store is None or not self.shared_consumer:
+            token = await self._fetch_token()
+            await self._publish()
+            return token
+
+        # 分片进程：先尝试采用共享令牌，失效时持锁刷新，避免多个分片同时请求
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, self._adopt_shared):
+            return self.access_token
+        await loop.run_in_executor(None, self.shared_lock.acquire)
+        try:
+            if await loop.run_in_executor(None, self._adopt_shared):
+                return self.access_token
+            token = await self._fetch_token()
+            await self._publish()
+            return token
+        finally:
+            self.shared_lock.release()
+
+    def _adopt_shared(self) -> bool:
+        """采用共享存储中更新且有效的令牌（阻塞的 IPC 调用，需在线程中执行）"""
+        snapshot = dict(self.shared_store)
+        expiration_time = snapshot.get('expiration_time', 0)
+        if not snapshot.get('access_token') or time.time() >= expiration_time - EXPIRY_MARGIN:
+            return False
+        if expiration_time > self.expiration_time:
+            self.access_token = snapshot['access_token']
+            self.expires_in = snapshot.get('expires_in', 0)
+            self.expiration_time = expiration_time
+        return True
+
+    async def _publish(self):
+        if self.shared_store is None:
+            return
+        snapshot = {
+            'access_token': self.access_token,
+            'expires_in': self.expires_in,
+            'expiration_time': self.expiration_time
+        }
+        await asyncio.get_running_loop().run_in_executor(None, self.shared_store.update, snapshot)
+
+    async def _fetch_token(self) -> str:
         logging.info("Current access token is about to expire. Fetching a new one...")
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+            self._owns_session = True
         payload = {
-            "appId": APP_ID,
-            "clientSecret": CLIENT_SECRET
+            "appId": self.app_id,
+            "clientSecret": self.client_secret
         }
-        response = requests.post(BOT_API_URL, json=payload)
-        if response.status_code == 200:
-            data = response.json()
-            current_access_token = data.get('access_token')
-            expires_in = data.get('expires_in', 7200)  # 默认有效期为7200秒
-            token_expiration_time = time.time() + int(expires_in)  # 确保 expires_in 是整数
-            logging.info(f"New access token fetched successfully. Expires in {expires_in} seconds.")
-        else:
-            logging.error(f"Failed to get access token: {response.text}")
-            raise Exception(f"Failed to get access token: {response.text}")
-    
-    return current_access_token
\ No newline at end of file
+        async with self._session.post(self.api_url, json=payload) as response:
+            if response.status != 200:
+                text = await response.text()
+                logging.error(f"Failed to get access token: {text}")
+                raise Exception(f"Failed to get access token: {text}")
+            data = await response.json(content_type=None)
+
+        # 返回 200 但缺少字段时按失败处理，交给调用方的重试间隔，不能把 None 当作令牌使用
+        access_token = data.get('access_token') if isinstance(data, dict) else None
+        try:
+            expires_in = int(data['expires_in'])
+        except (KeyError, TypeError, ValueError):
+            expires_in = 0
+        if not access_token or expires_in <= 0:
+            logging.error(f"Failed to get access token: invalid response {data}")
+            raise Exception(f"Failed to get access token: invalid response {data}")
+
+        self.access_token = access_token
+        self.expires_in = expires_in
+        self.expiration_time = time.time() + expires_in
+        logging.info(f"New access token fetched successfully. Expires in {expires_in} seconds.")
+        return self.access_token
+
+    async def _background_refresh(self):
+        """在令牌过期前主动刷新"""
+        if self.shared_consumer:
+            await self._background_sync()
+            return
+        while True:
+            try:
+                if self.access_token is None:
+                    delay = 0
+                else:
+                    # 有效期很短时按一半寿命提前刷新，避免空转
+                    ahead = min(REFRESH_AHEAD, self.expires_in / 2)
+                    delay = max(0, self.expiration_time - ahead - time.time())
+                await asyncio.sleep(delay)
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"后台刷新 access token 失败: {str(e)}")
+                await asyncio.sleep(RETRY_INTERVAL)
+
+    async def _background_sync(self):
+        """分片进程：定期从共享存储同步监督进程刷新的令牌"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self._adopt_shared)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"同步共享 access token 失败: {str(e)}")
+            await asyncio.sleep(SHARED_POLL_INTERVAL)
+
+
+# 全局令牌管理器
+token_manager = AccessTokenManager()
+
+async def fetch_access_token():
+    """获取当前有效的 access_token（兼容原有调用方式）"""
+    return await token_manager.get_token()
@@ -1,29 +1,136 @@
 import asyncio
-from websocket_handler import websocket_listener
-from utils.logger import setup_logging
-from utils.plugin_loader import PluginManager
+import logging
+import os
+from typing import Any, Dict
+from utils.logger import setup_logging, stop_logging
 
-def main():
-    # 配置日志
-    setup_logging({
-        'log_dir': 'logs',
-        'debug_keep_days': 7,
-        'error_keep_weeks': 4,
-        'console_level': 'INFO'
+# WebSocket 连接地址
+URI = "wss://+连接地址+/ws/+秘钥"
+# 分片数量；大于1时每个分片运行在独立进程中，由监督进程负责拉起和重启
+SHARD_COUNT = 1
+
+LOG_CONFIG = {
+    'log_dir': 'logs',
+    'debug_keep_days': 7,
+    'error_keep_weeks': 4,
+    'console_level': 'INFO',
+    'queue_size': 10000,       # 日志队列容量，写盘跟不上时丢弃并计数
+    'json': False,             # 文件日志输出为 JSON Lines
+    'info_per_second': 20      # 同一处 INFO 日志每秒最多输出条数
+}
+
+# 性能指标：关闭时各处埋点直接返回；http_port 为空则只能通过 /性能指标 命令查看
+METRICS_CONFIG = {
+    'enabled': True,
+    'http_host': '127.0.0.1',
+    'http_port': None,         # 例如 9100，开启后可通过 http://127.0.0.1:9100/metrics 抓取
+    'lag_interval': 0.5        # 事件循环延迟探测间隔（秒）
+}
+
+# 发件箱：回复先写入 SQLite 再发送，收到 200 后删除；重启时补发仍在被动回复窗口内的回复。
+# 每条回复多一次落盘，默认关闭，填写文件路径（如 'outbox.db'）开启
+OUTBOX_PATH = None
+
+# 入站事件去重：断线重连后网关可能重投事件，窗口内重复的事件 ID 直接跳过
+DEDUP_CONFIG = {
+    'enabled': True,
+    'ttl': 600,                # 去重窗口（秒）
+    'max_entries': 100000,     # 内存中最多保留的事件 ID 数
+    'persist_path': 'dedup.db' # 持久化文件，重启后仍能识别重投；为空时只在内存中去重
+}
+
+# 入站限流：每项写作 (次数, 秒数)，插件可通过 RATE_LIMITS 按命令追加更严格的限额
+ADMISSION_CONFIG = {
+    'enabled': True,
+    'member': (10, 30),        # 每个成员（单聊为用户）30 秒内最多 10 条
+    'group': (30, 30),         # 每个群 30 秒内最多 30 条
+    'global': (100, 1),        # 全部会话每秒最多 100 条
+    'notify_interval': 60      # 被限流的成员每 60 秒最多收到一次提示，0 表示静默丢弃
+}
+
+def _shard_path(path: str, gateway_config: Dict[str, Any] = None) -> str:
+    """分片运行时各分片处理的事件互不重叠，本地数据文件按分片序号区分"""
+    if path and gateway_config and 'shard' in gateway_config:
+        root, ext = os.path.splitext(path)
+        return f"{root}-shard{gateway_config['shard'][0]}{ext}"
+    return path
+
+async def run(uri: str, gateway_config: Dict[str, Any] = None):
+    """在同一事件循环中管理发送器生命周期并运行监听"""
+    # 延迟导入：分片监督进程只负责管理子进程，不需要加载插件和网络栈
+    from websocket_handler import websocket_listener
+    from message_sender import init_sender, close_sender
+    from fetch_access_token import fetch_access_token, token_manager
+    from message_processor import admission
+    from utils.metrics import metrics
+
+    admission.configure(ADMISSION_CONFIG)
+
+    if METRICS_CONFIG['enabled']:
+        http_port = METRICS_CONFIG['http_port']
+        if http_port and gateway_config and 'shard' in gateway_config:
+            # 每个分片进程各自导出，端口依分片序号顺延
+            http_port += gateway_config['shard'][0]
+        await metrics.start(METRICS_CONFIG['http_host'], http_port, METRICS_CONFIG['lag_interval'])
+
+    # 创建共享HTTP连接池
+    sender = await init_sender({
+        'limit': 100,
+        'limit_per_host': 30,
+        'ttl_dns_cache': 300,
+        'keepalive_timeout': 60,
+        'outbox_path': _shard_path(OUTBOX_PATH, gateway_config)
     })
+    # 令牌管理器复用同一连接池，并在后台提前刷新
+    await token_manager.start(sender.session)
+    dedup_config = {**DEDUP_CONFIG, 'persist_path': _shard_path(DEDUP_CONFIG['persist_path'], gateway_config)}
+    if sender.outbox:
+        try:
+            # 补发上次退出时未送达的回复
+            await sender.replay_outbox(await fetch_access_token())
+        except Exception as e:
+            logging.error(f"发件箱重放失败: {e}", exc_info=True)
+    try:
+        await websocket_listener(uri, {
+            'workers': 10,
+            'max_size': 1000,
+            'overflow': 'block',
+            'conversation_concurrency': 1,   # 每个群/单聊同时只处理一条，保证会话内顺序
+            'conversation_backlog': 200      # 单个会话积压超过该值时丢弃其最旧消息
+        }, gateway_config, dedup_config)
+    finally:
+        await token_manager.close()
+        await close_sender()
+        await metrics.stop()
 
-    # 初始化插件系统
-    plugin_manager = PluginManager()
+def serve(uri: str, gateway_config: Dict[str, Any] = None):
+    """初始化插件系统并阻塞运行，直到连接结束或收到中断信号"""
+    from utils.plugin_loader import get_plugin_manager
+
+    # 初始化插件系统（消息处理模块导入时取到的是同一个实例）
+    plugin_manager = get_plugin_manager()
 
     try:
         # 启动WebSocket监听
-        uri = "wss://+连接地址+/ws/+秘钥"
-        asyncio.run(websocket_listener(uri))
+        asyncio.run(run(uri, gateway_config))
     except KeyboardInterrupt:
         logging.info("收到中断信号，正在关闭...")
     finally:
         plugin_manager.shutdown()
         logging.info("系统已安全关闭")
 
+def main():
+    # 配置日志（写入在后台线程完成，退出前需停止以写完剩余日志）
+    log_listener = setup_logging(LOG_CONFIG)
+
+    try:
+        if SHARD_COUNT > 1:
+            from shard_manager import ShardSupervisor
+            ShardSupervisor(URI, SHARD_COUNT, LOG_CONFIG).run()
+        else:
+            serve(URI)
+    finally:
+        stop_logging(log_listener)
+
 if __name__ == "__main__":
     main()
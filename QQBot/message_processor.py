@@ -1,76 +1,165 @@
-import json
-import random
+import asyncio
 import logging
-from message_sender import send_group_message_async, send_user_message_async
-from utils.plugin_loader import load_plugins
+from message_sender import send_group_reply, send_user_reply
+from fetch_access_token import fetch_access_token
+from utils.plugin_loader import PluginTimeoutError, get_plugin_manager, split_command
+from utils.response_cache import MISS, ResponseCache
+from utils.admission import REJECT_NOTICE, AdmissionController
+from utils.metrics import metrics
+from utils.codec import MessageEvent, as_frame
 
-# 初始化插件
-plugins = load_plugins()
+# 与 main.py 共用同一个插件管理器（热更新替换的注册表即为分发所用的注册表）
+plugin_manager = get_plugin_manager()
 
-async def process_message(data: dict, access_token: str):
-    """处理消息主逻辑"""
+# 只读命令的回复缓存（插件通过 CACHE 清单按命令开启）
+response_cache = ResponseCache(max_entries=1000)
+metrics.register_gauge('qqbot_response_cache_entries', lambda: response_cache.stats()['size'], '回复缓存中的条目数')
+
+# 插件分发前的入站限流（main.py 启动时按 ADMISSION_CONFIG 重新配置）
+admission = AdmissionController()
+
+def _cache_key(plugin_name: str, command: str, args: list, policy: dict, context: dict):
+    """按插件声明的 key 规则生成缓存键"""
+    command = command.lower()
+    key = policy.get('key', 'args')
+    if callable(key):
+        return (plugin_name, command, key(command, args, **context))
+    if key == 'command':
+        return (plugin_name, command)
+    if key == 'group':
+        return (plugin_name, command, tuple(args), context.get('group_openid') or context.get('user_openid'))
+    return (plugin_name, command, tuple(args))
+
+def invalidate_cache(plugin_name: str) -> int:
+    """使某个插件的全部缓存回复失效"""
+    return response_cache.invalidate(plugin_name)
+
+# 插件热更新或卸载后，旧版本生成的缓存回复随之失效
+plugin_manager.add_swap_listener(invalidate_cache)
+
+async def process_message(data) -> bool:
+    """处理消息主逻辑（data 为网关帧，也兼容原始 dict）
+
+    返回 False 表示处理未能完成（如获取令牌失败），网关重投该消息时应再次处理；
+    单个插件的异常已在分发时记录，不算处理失败。
+    """
     try:
-        event_type = data['t']
-        content = data['d']['content'].strip()
-        msg_id = data['d']['id']
-        
+        event = MessageEvent.from_frame(as_frame(data))
+        event_type = event.event_type
+        content = event.content
+        msg_id = event.msg_id
+
         # 获取上下文信息
-        group_openid = data['d'].get('group_openid')
-        member_openid = data['d']['author'].get('member_openid')
-        user_openid = data['d']['author'].get('user_openid')
+        group_openid = event.group_openid
+        member_openid = event.member_openid
+        user_openid = event.user_openid
 
+        # 通过命令索引定位插件，未命中时才轮询声明了兜底的插件
+        command, args = split_command(content)
         response_content = None
-        for plugin_name, plugin in plugins.items():
-            try:
-                response_content = plugin.handle_command(
-                    content,
-                    group_openid=group_openid,
-                    member_openid=member_openid,
-                    user_openid=user_openid
-                )
-                if response_content:
-                    logging.info(f"插件 {plugin_name} 处理了消息")
-                    break
-            except Exception as e:
-                logging.error(f"插件 {plugin_name} 处理异常: {str(e)}", exc_info=True)
-
-        # 发送回复
+        context = {
+            'group_openid': group_openid,
+            'member_openid': member_openid,
+            'user_openid': user_openid
+        }
+        plugin_names = plugin_manager.resolve(command)
+        # 刷屏的成员或群在分发前被拦下，不再调用插件；提示按间隔最多回复一次
+        if plugin_names and admission.enabled:
+            command_limits = plugin_manager.rate_limit_policy(plugin_names[0], command)
+            if admission.admit(command.lower(), member_openid or user_openid, group_openid, command_limits):
+                plugin_names = ()
+                if admission.should_notify(member_openid or user_openid):
+                    response_content = REJECT_NOTICE
+        with metrics.time('qqbot_stage_duration_seconds', {'stage': 'dispatch'}):
+            for plugin_name in plugin_names:
+                try:
+                    policy = plugin_manager.cache_policy(plugin_name, command)
+                    if policy:
+                        cache_key = _cache_key(plugin_name, command, args, policy, context)
+                        cached = response_cache.get(cache_key)
+                        if cached is not MISS:
+                            response_content = cached
+                            logging.info(f"插件 {plugin_name} 命中回复缓存")
+                            break
+                        # 调用期间收到事件使缓存失效时，这次的回复不再写入
+                        generation = response_cache.generation(plugin_name)
+
+                    response_content = await plugin_manager.invoke(
+                        plugin_name,
+                        'handle_command',
+                        content,
+                        command=command,
+                        args=args,
+                        **context
+                    )
+                    if response_content and policy:
+                        response_cache.set(cache_key, response_content, policy.get('ttl', 10), plugin_name, generation)
+                    if response_content:
+                        logging.info(f"插件 {plugin_name} 处理了消息")
+                        break
+                except PluginTimeoutError as e:
+                    logging.error(f"插件 {plugin_name} 处理超时: {str(e)}")
+                except Exception as e:
+                    logging.error(f"插件 {plugin_name} 处理异常: {str(e)}", exc_info=True)
+
+        # 发送回复（仅在确实需要回复时才获取 access_token）；插件返回列表时逐条回复
         if response_content:
-            if event_type == 'GROUP_AT_MESSAGE_CREATE':
-                await send_group_message_async(
-                    access_token, 
-                    group_openid, 
-                    response_content, 
-                    msg_id, 
-                    str(random.randint(1, 1000))
-                )
-            elif event_type == 'C2C_MESSAGE_CREATE':
-                await send_user_message_async(
-                    access_token,
-                    user_openid,
-                    response_content,
-                    msg_id,
-                    str(random.randint(1, 1000))
-                )
+            with metrics.time('qqbot_stage_duration_seconds', {'stage': 'token'}):
+                access_token = await fetch_access_token()
+            with metrics.time('qqbot_stage_duration_seconds', {'stage': 'reply'}):
+                if event_type == 'GROUP_AT_MESSAGE_CREATE':
+                    await send_group_reply(
+                        access_token,
+                        group_openid,
+                        response_content,
+                        msg_id,
+                        event.timestamp
+                    )
+                elif event_type == 'C2C_MESSAGE_CREATE':
+                    await send_user_reply(
+                        access_token,
+                        user_openid,
+                        response_content,
+                        msg_id,
+                        event.timestamp
+                    )
+        return True
 
     except Exception as e:
         logging.error(f"消息处理失败: {str(e)}", exc_info=True)
+        return False
 
-async def handle_event(data: dict):
-    """处理事件消息（新增函数）"""
+async def handle_event(data) -> bool:
+    """处理事件消息（data 为网关帧，也兼容原始 dict）
+
+    有插件处理失败时返回 False，网关重投该事件时应再次处理；插件超时不算失败，
+    线程池中的调用可能仍会完成，重复处理会重复记录。
+    """
     try:
-        event_type = data['t']
-        event_data = data['d']
+        frame = as_frame(data)
+        event_type = frame.t
+        event_data = frame.d
         
-        # 调用插件的 handle_event 方法
-        for plugin in plugins.values():
-            if hasattr(plugin, 'handle_event'):
-                try:
-                    plugin.handle_event(event_type, event_data)
-                except Exception as e:
-                    logging.error(f"插件事件处理失败: {str(e)}", exc_info=True)
-                    
+        # 并发调用订阅了该事件的插件，单个插件变慢不影响其他插件
+        plugin_names = plugin_manager.event_handlers(event_type)
+        results = await asyncio.gather(
+            *(plugin_manager.invoke(name, 'handle_event', event_type, event_data) for name in plugin_names),
+            return_exceptions=True
+        )
+        ok = True
+        for name, result in zip(plugin_names, results):
+            # 事件改变了插件的数据，其缓存的回复随之失效
+            invalidate_cache(name)
+            if isinstance(result, PluginTimeoutError):
+                logging.error(f"插件 {name} 事件处理超时: {str(result)}")
+            elif isinstance(result, Exception):
+                logging.error(f"插件 {name} 事件处理失败: {str(result)}", exc_info=result)
+                ok = False
+        return ok
+
     except KeyError as e:
         logging.error(f"事件数据格式错误: {str(e)}")
+        return False
     except Exception as e:
         logging.error(f"事件处理异常: {str(e)}", exc_info=True)
+        return False
@@ -1,5 +1,14 @@
+import asyncio
+import itertools
+import time
 import aiohttp
 import logging
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple, Union
+from utils.rate_limit import BucketRegistry, TokenBucket
+from utils.metrics import metrics
+from utils.outbox import Outbox
+from utils import codec
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -7,42 +16,401 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 SEND_GROUP_MESSAGE_API_URL = 'https://api.sgroup.qq.com/v2/groups/{}/messages'
 SEND_USER_MESSAGE_API_URL = 'https://api.sgroup.qq.com/v2/users/{}/messages'
 
-async def send_group_message_async(access_token, group_openid, content, msg_id, msg_seq):
-    logging.info(f"Sending message to group {group_openid}: {content}")
-    headers = {
-        "Authorization": f"QQBot {access_token}",
-        "Content-Type": "application/json"
-    }
-    data = {
-        "content": content,
-        "msg_type": 0,  # 文本消息类型
-        "msg_id": msg_id,
-        "msg_seq": msg_seq
-    }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(SEND_GROUP_MESSAGE_API_URL.format(group_openid), headers=headers, json=data) as response:
-            if response.status != 200:
-                text = await response.text()
-                logging.error(f"Failed to send message: {text}")
-            else:
-                logging.info("Message sent successfully.")
-
-async def send_user_message_async(access_token, user_openid, content, msg_id, msg_seq):
-    logging.info(f"Sending message to user {user_openid}: {content}")
-    headers = {
-        "Authorization": f"QQBot {access_token}",
-        "Content-Type": "application/json"
-    }
-    data = {
-        "content": content,
-        "msg_type": 0,  # 文本消息类型
-        "msg_id": msg_id,
-        "msg_seq": msg_seq
-    }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(SEND_USER_MESSAGE_API_URL.format(user_openid), headers=headers, json=data) as response:
-            if response.status != 200:
+# 发送优先级：数值越小越先发送，命令回复优先于批量通知
+PRIORITY_REPLY = 0
+PRIORITY_NOTICE = 10
+
+# 平台表示频率限制的业务错误码
+RATE_LIMIT_CODES = {22009}
+
+# 被动回复窗口：msg_id 在该时间内可用于回复（秒）
+PASSIVE_REPLY_WINDOW = 300
+# msg_seq 分配表最多跟踪的 msg_id 数量
+MSG_SEQ_MAX_ENTRIES = 10000
+
+# 连接池默认配置
+DEFAULT_SENDER_CONFIG = {
+    'api_base': 'https://api.sgroup.qq.com',  # 可指向本地模拟服务
+    'limit': 100,              # 连接池总连接数
+    'limit_per_host': 30,      # 单个主机最大连接数
+    'ttl_dns_cache': 300,      # DNS缓存时间（秒）
+    'keepalive_timeout': 60,   # 空闲连接保持时间（秒）
+    'request_timeout': 10,     # 单次请求超时（秒）
+    'workers': 8,              # 发送协程数量
+    'route_rate': 5,           # 每个群/用户每秒可发送条数
+    'route_burst': 5,          # 每个群/用户允许的突发条数
+    'global_rate': 50,         # 全局每秒可发送条数
+    'global_burst': 50,        # 全局允许的突发条数
+    'max_retries': 3,          # 失败后最多重试次数
+    'retry_base_delay': 1,     # 重试退避基数（秒）
+    'retry_max_delay': 30,     # 重试退避上限（秒）
+    'outbox_path': None        # 发件箱数据库路径；设置后回复先落盘再发送，重启时重放未送达的回复
+}
+
+
+class SendJob:
+    """一条待发送的消息"""
+
+    __slots__ = ('route', 'url', 'access_token', 'payload', 'body', 'priority', 'future', 'enqueued_at', 'attempts',
+                 'outbox_id')
+
+    def __init__(self, route: str, url: str, access_token: str, payload: Dict[str, Any], priority: int,
+                 future: asyncio.Future, body: bytes = None):
+        self.route = route
+        self.url = url
+        self.access_token = access_token
+        self.payload = payload
+        # 入队时序列化一次，重试时直接复用
+        self.body = body if body is not None else codec.dumps(payload)
+        self.priority = priority
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        # 发件箱中的记录 ID，未开启发件箱时为 None
+        self.outbox_id: Optional[int] = None
+
+
+class MsgSeqAllocator:
+    """按 msg_id 分配递增的 msg_seq
+
+    同一条消息的多次回复依次得到 1, 2, 3...，不会因随机数碰撞被平台当作重复回复拒绝。
+    分配表容量有上限，条目按首次分配的顺序排列，超过被动回复窗口或容量时从最旧的开始淘汰。
+    """
+
+    def __init__(self, ttl: float = PASSIVE_REPLY_WINDOW, max_entries: int = MSG_SEQ_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # msg_id -> (最后一次分配的序号, 首次分配时间)
+        self._entries: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+
+    def next(self, msg_id: str) -> int:
+        """为 msg_id 分配下一个序号"""
+        now = time.monotonic()
+        self._expire(now)
+        seq, created_at = self._entries.get(msg_id, (0, now))
+        seq += 1
+        self._entries[msg_id] = (seq, created_at)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return seq
+
+    def _expire(self, now: float):
+        # 条目按创建顺序排列，遇到第一个未过期的即可停止
+        while self._entries:
+            msg_id, (_, created_at) = next(iter(self._entries.items()))
+            if now - created_at < self.ttl:
+                break
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class MessageSender:
+    """消息发送器
+
+    持有一个长连接复用的 aiohttp 会话，并通过优先级队列调度发送：
+    每个群/用户一个令牌桶限速，遇到限流或服务端错误时按退避重试。
+    """
+
+    def __init__(self, config: Dict[str, Any] = None):
+        self.config = {**DEFAULT_SENDER_CONFIG, **(config or {})}
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.group_url = self.config['api_base'] + '/v2/groups/{}/messages'
+        self.user_url = self.config['api_base'] + '/v2/users/{}/messages'
+        self.route_buckets = BucketRegistry(self.config['route_rate'], self.config['route_burst'])
+        self.global_bucket = TokenBucket(self.config['global_rate'], self.config['global_burst'])
+        self.msg_seq = MsgSeqAllocator()
+        self.outbox: Optional[Outbox] = Outbox(self.config['outbox_path']) if self.config['outbox_path'] else None
+        self.queue: Optional[asyncio.PriorityQueue] = None
+        self._workers: List[asyncio.Task] = []
+        self._counter = itertools.count()
+        # 等待限流或退避后重新入队的消息
+        self._delayed: Dict[SendJob, asyncio.TimerHandle] = {}
+        # 运行指标
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def start(self):
+        """创建连接池、会话和发送协程（需在事件循环中调用）"""
+        if self.session and not self.session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.config['limit'],
+            limit_per_host=self.config['limit_per_host'],
+            ttl_dns_cache=self.config['ttl_dns_cache'],
+            use_dns_cache=True,
+            keepalive_timeout=self.config['keepalive_timeout']
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.config['request_timeout'])
+        )
+        self.queue = asyncio.PriorityQueue()
+        if self.outbox is not None:
+            await self.outbox.open()
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"sender-worker-{i}")
+            for i in range(self.config['workers'])
+        ]
+        logging.info("消息发送器已启动")
+
+    async def close(self):
+        """停止发送协程，关闭会话并释放连接池"""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        # 未发送的消息通知调用方失败
+        pending = list(self._delayed)
+        for handle in self._delayed.values():
+            handle.cancel()
+        self._delayed.clear()
+        if self.queue is not None:
+            while not self.queue.empty():
+                pending.append(self.queue.get_nowait()[2])
+        for job in pending:
+            if not job.future.done():
+                job.future.set_result(False)
+        if self.outbox is not None:
+            # 未送达的回复留在发件箱中，下次启动时重放
+            await self.outbox.close()
+        if self.session and not self.session.closed:
+            await self.session.close()
+            logging.info(f"消息发送器已关闭: {self.stats()}")
+        self.session = None
+
+    async def post_message(self, url: str, access_token: str, content: str, msg_id: str, msg_seq: str,
+                           route: str = None, priority: int = PRIORITY_REPLY, msg_time: float = None) -> bool:
+        """将一条文本消息放入发送队列，等待发送完成，返回是否成功
+
+        msg_time 为所回复消息的发出时间，发件箱据此判断重启后是否仍在被动回复窗口内。
+        """
+        if self.session is None or self.session.closed:
+            await self.start()
+        payload = {
+            "content": content,
+            "msg_type": 0,  # 文本消息类型
+            "msg_id": msg_id,
+            "msg_seq": msg_seq
+        }
+        future = asyncio.get_running_loop().create_future()
+        job = SendJob(route or url, url, access_token, payload, priority, future)
+        if self.outbox is not None:
+            # 先落盘再发送，发送途中进程退出也能在重启后补发
+            job.outbox_id = await self.outbox.record(job.route, url, job.body, priority, msg_time)
+        self._enqueue(job)
+        return await future
+
+    async def replay_outbox(self, access_token: str) -> int:
+        """重新发送上次运行中未确认送达的回复，超出被动回复窗口的直接丢弃，返回重放条数"""
+        if self.outbox is None:
+            return 0
+        if self.session is None or self.session.closed:
+            await self.start()
+        expired = self.outbox.expired
+        records = await self.outbox.pending(PASSIVE_REPLY_WINDOW)
+        expired = self.outbox.expired - expired
+        loop = asyncio.get_running_loop()
+        for record in records:
+            # 沿用原来的 msg_seq：若上次其实已送达，平台会按重复回复拒绝，不会发出两条
+            job = SendJob(record.route, record.url, access_token, codec.loads(record.body), record.priority,
+                          loop.create_future(), body=record.body)
+            job.outbox_id = record.id
+            self._enqueue(job)
+        if records or expired:
+            logging.info(f"发件箱重放 {len(records)} 条未送达回复，{expired} 条已超出被动回复窗口被丢弃")
+        return len(records)
+
+    def _enqueue(self, job: SendJob):
+        self._delayed.pop(job, None)
+        self.queue.put_nowait((job.priority, next(self._counter), job))
+
+    def _requeue_later(self, job: SendJob, delay: float):
+        self._delayed[job] = asyncio.get_running_loop().call_later(delay, self._enqueue, job)
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self.queue.get()
+            try:
+                # 路由或全局令牌不足时延后重新入队，不阻塞其他路由的发送
+                wait = max(
+                    self.route_buckets.get(job.route).time_until_available(),
+                    self.global_bucket.time_until_available()
+                )
+                if wait > 0:
+                    self._requeue_later(job, wait)
+                    continue
+                self.route_buckets.get(job.route).try_acquire()
+                self.global_bucket.try_acquire()
+
+                if job.attempts == 0:
+                    waited = time.monotonic() - job.enqueued_at
+                    self.wait_count += 1
+                    self.wait_total += waited
+                    self.wait_max = max(self.wait_max, waited)
+                    metrics.observe('qqbot_stage_duration_seconds', waited, {'stage': 'send_queue'})
+                await self._send(job)
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.set_result(False)
+                raise
+            except Exception as e:
+                logging.error(f"发送消息异常: {str(e)}", exc_info=True)
+                self._finish(job, False)
+
+    async def _send(self, job: SendJob):
+        job.attempts += 1
+        headers = {
+            "Authorization": f"QQBot {job.access_token}",
+            "Content-Type": "application/json"
+        }
+        retry_after = None
+        started = time.perf_counter()
+        try:
+            async with self.session.post(job.url, headers=headers, data=job.body) as response:
+                if response.status == 200:
+                    # 读完响应体，连接才能归还连接池复用
+                    await response.read()
+                    metrics.observe('qqbot_stage_duration_seconds', time.perf_counter() - started, {'stage': 'send'})
+                    logging.debug("Message sent successfully.")
+                    self._finish(job, True)
+                    return
                 text = await response.text()
+                rate_limited = response.status == 429 or self._error_code(text) in RATE_LIMIT_CODES
+                retryable = rate_limited or response.status >= 500
+                if rate_limited:
+                    self.rate_limited += 1
+                    metrics.inc('qqbot_sends_total', {'result': 'rate_limited'})
+                    retry_after = self._retry_after(response.headers.get('Retry-After'))
+                    # 服务端已限流，暂停该路由，避免其他消息继续撞限制
+                    self.route_buckets.get(job.route).pause(retry_after or self._backoff(job))
                 logging.error(f"Failed to send message: {text}")
-            else:
-                logging.info("Message sent successfully.")
\ No newline at end of file
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            retryable = True
+            logging.error(f"Failed to send message: {e}")
+
+        if retryable and job.attempts <= self.config['max_retries']:
+            delay = retry_after or self._backoff(job)
+            self.retried += 1
+            metrics.inc('qqbot_sends_total', {'result': 'retried'})
+            logging.info(f"{delay:.1f} 秒后重试发送（第 {job.attempts} 次）")
+            self._requeue_later(job, delay)
+        else:
+            self._finish(job, False)
+
+    def _finish(self, job: SendJob, success: bool):
+        if job.outbox_id is not None:
+            # 已送达或确定无法送达（重试用尽、不可重试的错误）都不再重放
+            self.outbox.done(job.outbox_id)
+        if success:
+            self.sent += 1
+        else:
+            self.failed += 1
+        metrics.inc('qqbot_sends_total', {'result': 'sent' if success else 'failed'})
+        if not job.future.done():
+            job.future.set_result(success)
+
+    def _backoff(self, job: SendJob) -> float:
+        return min(self.config['retry_max_delay'], self.config['retry_base_delay'] * (2 ** (job.attempts - 1)))
+
+    @staticmethod
+    def _retry_after(value: Optional[str]) -> Optional[float]:
+        try:
+            return max(0.0, float(value)) if value else None
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _error_code(text: str) -> Optional[int]:
+        try:
+            return codec.loads(text).get('code')
+        except (ValueError, AttributeError):
+            return None
+
+    def stats(self) -> Dict[str, Any]:
+        """返回发送队列指标"""
+        return {
+            'queued': self.queue.qsize() if self.queue is not None else 0,
+            'delayed': len(self._delayed),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'rate_limited': self.rate_limited,
+            'wait_avg': self.wait_total / self.wait_count if self.wait_count else 0.0,
+            'wait_max': self.wait_max,
+            'outbox': self.outbox.stats() if self.outbox is not None else None
+        }
+
+
+# 全局发送器实例，由 main.py 在启动时创建、退出时关闭
+sender: Optional[MessageSender] = None
+
+async def init_sender(config: Dict[str, Any] = None) -> MessageSender:
+    """初始化全局发送器"""
+    global sender
+    if sender is None:
+        sender = MessageSender(config)
+    await sender.start()
+    return sender
+
+async def close_sender():
+    """关闭全局发送器"""
+    global sender
+    if sender is not None:
+        await sender.close()
+        sender = None
+
+def _get_sender() -> MessageSender:
+    global sender
+    if sender is None:
+        # 未显式初始化时懒创建，会话在首次发送时建立
+        sender = MessageSender()
+    return sender
+
+async def send_group_message_async(access_token, group_openid, content, msg_id, msg_seq, priority=PRIORITY_REPLY,
+                                   msg_time=None):
+    logging.debug("Sending message to group %s: %s", group_openid, content)
+    current = _get_sender()
+    return await current.post_message(
+        current.group_url.format(group_openid),
+        access_token, content, msg_id, msg_seq,
+        route=f"group:{group_openid}", priority=priority, msg_time=msg_time
+    )
+
+async def send_user_message_async(access_token, user_openid, content, msg_id, msg_seq, priority=PRIORITY_REPLY,
+                                  msg_time=None):
+    logging.debug("Sending message to user %s: %s", user_openid, content)
+    current = _get_sender()
+    return await current.post_message(
+        current.user_url.format(user_openid),
+        access_token, content, msg_id, msg_seq,
+        route=f"user:{user_openid}", priority=priority, msg_time=msg_time
+    )
+
+async def send_group_reply(access_token, group_openid, contents: Union[str, List[str]], msg_id, msg_time=None) -> bool:
+    """回复群消息，contents 为列表时按顺序发送多条，msg_seq 自动按 msg_id 递增分配"""
+    current = _get_sender()
+    parts = [contents] if isinstance(contents, str) else list(contents)
+    success = True
+    for part in parts:
+        success = await send_group_message_async(
+            access_token, group_openid, part, msg_id, str(current.msg_seq.next(msg_id)), msg_time=msg_time
+        ) and success
+    return success
+
+async def send_user_reply(access_token, user_openid, contents: Union[str, List[str]], msg_id, msg_time=None) -> bool:
+    """回复单聊消息，contents 为列表时按顺序发送多条，msg_seq 自动按 msg_id 递增分配"""
+    current = _get_sender()
+    parts = [contents] if isinstance(contents, str) else list(contents)
+    success = True
+    for part in parts:
+        success = await send_user_message_async(
+            access_token, user_openid, part, msg_id, str(current.msg_seq.next(msg_id)), msg_time=msg_time
+        ) and success
+    return success
@@ -1,19 +1,170 @@
 # plugins/事件统计_plugin.py
 import logging
 import sqlite3
-from datetime import datetime
+import time
+from bisect import bisect_right
+from collections import Counter
+from datetime import datetime, timedelta
 from typing import Optional, Dict, List, Tuple, Any
-from threading import Lock
+from threading import Condition, Lock, Thread
 
 logger = logging.getLogger("EventStats")
 
+# 本插件处理的命令（用于插件管理器构建分发索引）
+COMMANDS = ['/群聊总数', '/用户总数', '/群聊统计', '/单聊统计', '/群聊趋势', '/好友趋势']
+# 本插件处理的事件（未声明时任何事件都会触发导入和调用）
+EVENTS = ['GROUP_ADD_ROBOT', 'GROUP_DEL_ROBOT', 'FRIEND_ADD', 'FRIEND_DEL']
+# SQLite 读写会阻塞，放到插件线程池中执行
+BLOCKING = True
+TIMEOUT = 15
+MAX_CONCURRENCY = 4
+# 回复缓存：统计数据在收到事件时会整体失效，TTL 只兜底时效
+CACHE = {
+    '/群聊总数': {'ttl': 30, 'key': 'args'},
+    '/用户总数': {'ttl': 30, 'key': 'args'},
+    '/群聊统计': {'ttl': 30, 'key': 'command'},
+    '/单聊统计': {'ttl': 30, 'key': 'command'},
+    '/群聊趋势': {'ttl': 60, 'key': 'args'},
+    '/好友趋势': {'ttl': 60, 'key': 'args'}
+}
+# 入站限额 (次数, 秒数)：带参数的查询会绕过缓存直接读库，按成员和群额外限制
+RATE_LIMITS = {
+    '/群聊总数': {'member': (5, 60), 'group': (10, 60)},
+    '/用户总数': {'member': (5, 60), 'group': (10, 60)},
+    '/群聊趋势': {'member': (3, 60), 'group': (6, 60)},
+    '/好友趋势': {'member': (3, 60), 'group': (6, 60)}
+}
+
+# 事件写入配置
+WRITE_CONFIG = {
+    # immediate: 每个事件立即提交；batched: 写入缓冲区，由后台线程批量提交
+    'mode': 'batched',
+    'batch_size': 200,        # 缓冲事件数达到该值时立即刷盘
+    'flush_interval': 1.0,    # 最长刷盘间隔（秒）
+    'synchronous': 'NORMAL'   # SQLite 同步级别：OFF / NORMAL / FULL
+}
+
+# 事件历史保留配置
+RETENTION_CONFIG = {
+    'raw_days': 30,            # 原始事件流水保留天数
+    'hourly_days': 90,         # 小时汇总保留天数（日汇总永久保留）
+    'compact_interval': 3600   # 清理过期数据的间隔（秒）
+}
+
+# 趋势命令允许查询的最大范围
+TREND_MAX_DAYS = 90
+TREND_MAX_HOURS = 72
+# 每张表最多记住的分页游标数，超出时淘汰最早记住的
+PAGE_ANCHOR_LIMIT = 256
+
+EVENT_LOG_SQL = '''
+    INSERT INTO event_log (kind, target_id, action, operator_id, timestamp)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+ROLLUP_UPSERT_SQL = '''
+    INSERT INTO {table} (bucket, kind, action, count)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(bucket, kind, action) DO UPDATE SET
+        count = count + excluded.count
+'''
+
+COUNTER_INCREMENT_SQL = '''
+    UPDATE stat_counters SET value = value + ? WHERE name = ?
+'''
+
+GROUP_UPSERT_SQL = '''
+    INSERT INTO groups 
+    (group_id, last_action, operator_id, timestamp)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(group_id) DO UPDATE SET
+        last_action = excluded.last_action,
+        operator_id = excluded.operator_id,
+        timestamp = excluded.timestamp
+'''
+
+FRIEND_UPSERT_SQL = '''
+    INSERT INTO friends 
+    (user_id, last_action, timestamp)
+    VALUES (?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        last_action = excluded.last_action,
+        timestamp = excluded.timestamp
+'''
+
+# 分页的表 -> (主键列, 计入分页的状态)
+PAGE_TABLES = {'groups': ('group_id', '加入'), 'friends': ('user_id', '添加')}
+
+# 分页查询：(首页查询, 游标之后的查询, 游标之前的查询)。last_action 必须写成字面量，查询才能命中部分索引
+PAGE_QUERIES = {
+    'groups': (
+        '''
+            SELECT group_id, timestamp FROM groups
+            WHERE last_action = '加入'
+            ORDER BY timestamp DESC, group_id DESC
+            LIMIT ? OFFSET ?
+        ''',
+        '''
+            SELECT group_id, timestamp FROM groups
+            WHERE last_action = '加入' AND (timestamp, group_id) < (?, ?)
+            ORDER BY timestamp DESC, group_id DESC
+            LIMIT ? OFFSET ?
+        ''',
+        '''
+            SELECT group_id, timestamp FROM groups
+            WHERE last_action = '加入' AND (timestamp, group_id) > (?, ?)
+            ORDER BY timestamp ASC, group_id ASC
+            LIMIT ? OFFSET ?
+        '''
+    ),
+    'friends': (
+        '''
+            SELECT user_id, timestamp FROM friends
+            WHERE last_action = '添加'
+            ORDER BY timestamp DESC, user_id DESC
+            LIMIT ? OFFSET ?
+        ''',
+        '''
+            SELECT user_id, timestamp FROM friends
+            WHERE last_action = '添加' AND (timestamp, user_id) < (?, ?)
+            ORDER BY timestamp DESC, user_id DESC
+            LIMIT ? OFFSET ?
+        ''',
+        '''
+            SELECT user_id, timestamp FROM friends
+            WHERE last_action = '添加' AND (timestamp, user_id) > (?, ?)
+            ORDER BY timestamp ASC, user_id ASC
+            LIMIT ? OFFSET ?
+        '''
+    )
+}
+
 class EventStatistics:
     """事件统计核心类，提供完整的事件记录和查询功能"""
     
-    def __init__(self):
+    def __init__(self, config: Dict[str, Any] = None):
+        self.config = {**WRITE_CONFIG, **(config or {})}
+        # 保护数据库连接：写事务与查询不能交错在同一个连接上
         self.lock = Lock()
+        # 取出缓冲区和提交必须连在一起，否则后台线程与查询前的刷盘可能乱序提交
+        self._flush_lock = Lock()
         self.conn = self._create_connection()
         self._init_db()
+        self._last_compact = 0.0
+        # 分页游标缓存：表 -> {行在排序结果中的位置: 该行的 (timestamp, id)}
+        self._page_anchors: Dict[str, Dict[int, Tuple[str, str]]] = {}
+        # 建立游标时数据库的 data_version，其他连接（如其他分片）提交后会变化
+        self._data_version: Optional[int] = None
+
+        # 写缓冲区（batched 模式），由后台线程批量刷入数据库
+        self._pending_groups: List[Tuple[str, str, str, str]] = []
+        self._pending_friends: List[Tuple[str, str, str]] = []
+        self._buffer_cond = Condition()
+        self._closed = False
+        self._writer: Optional[Thread] = None
+        if self.config['mode'] == 'batched':
+            self._writer = Thread(target=self._writer_loop, name="event-stats-writer", daemon=True)
+            self._writer.start()
 
     def _create_connection(self) -> sqlite3.Connection:
         """创建并配置数据库连接"""
@@ -24,13 +175,22 @@ class EventStatistics:
             isolation_level=None  # 自动提交模式
         )
         conn.execute("PRAGMA journal_mode = WAL")
-        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA synchronous = {self._synchronous_level()}")
         conn.execute("PRAGMA cache_size = -10000")  # 10MB缓存
         return conn
 
+    def _synchronous_level(self) -> str:
+        level = str(self.config['synchronous']).upper()
+        if level not in ('OFF', 'NORMAL', 'FULL'):
+            raise ValueError(f"无效的同步级别: {level}")
+        return level
+
     def _init_db(self):
         """初始化数据库表结构"""
         with self.conn:
+            # 连接为自动提交模式，须显式开启事务；IMMEDIATE 立即取得写锁，
+            # 多个分片同时启动时只有一个能看到空的计数器表并完成初始化
+            self.conn.execute("BEGIN IMMEDIATE")
             # 群组事件表（包含当前状态标记）
             self.conn.execute('''
                 CREATE TABLE IF NOT EXISTS groups (
@@ -50,14 +210,92 @@ class EventStatistics:
                 )
             ''')
 
-            # 创建优化索引
+            # 按状态计数的物化计数器，由触发器在同一事务内维护
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS stat_counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )
+            ''')
+            if self.conn.execute("SELECT COUNT(*) FROM stat_counters").fetchone()[0] == 0:
+                # 首次建表时从现有数据初始化一次
+                self.conn.execute('''
+                    INSERT OR IGNORE INTO stat_counters (name, value)
+                    SELECT 'groups:' || action, (SELECT COUNT(*) FROM groups WHERE last_action = action)
+                    FROM (SELECT '加入' AS action UNION ALL SELECT '退出')
+                    UNION ALL
+                    SELECT 'friends:' || action, (SELECT COUNT(*) FROM friends WHERE last_action = action)
+                    FROM (SELECT '添加' AS action UNION ALL SELECT '删除')
+                ''')
+            for table in ('groups', 'friends'):
+                self.conn.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS trg_{table}_insert AFTER INSERT ON {table}
+                    BEGIN
+                        UPDATE stat_counters SET value = value + 1 WHERE name = '{table}:' || NEW.last_action;
+                    END
+                ''')
+                self.conn.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS trg_{table}_update AFTER UPDATE OF last_action ON {table}
+                    WHEN OLD.last_action IS NOT NEW.last_action
+                    BEGIN
+                        UPDATE stat_counters SET value = value - 1 WHERE name = '{table}:' || OLD.last_action;
+                        UPDATE stat_counters SET value = value + 1 WHERE name = '{table}:' || NEW.last_action;
+                    END
+                ''')
+                self.conn.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS trg_{table}_delete AFTER DELETE ON {table}
+                    BEGIN
+                        UPDATE stat_counters SET value = value - 1 WHERE name = '{table}:' || OLD.last_action;
+                    END
+                ''')
+
+            # 追加写入的事件流水，当前状态表只保留每个对象的最新动作
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS event_log (
+                    id INTEGER PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    target_id TEXT,
+                    action TEXT NOT NULL,
+                    operator_id TEXT,
+                    timestamp DATETIME NOT NULL
+                )
+            ''')
             self.conn.execute('''
-                CREATE INDEX IF NOT EXISTS idx_groups_time 
-                ON groups(timestamp DESC)
+                CREATE INDEX IF NOT EXISTS idx_event_log_time
+                ON event_log(timestamp)
             ''')
+
+            # 按小时/天增量汇总的事件数，趋势查询直接读取汇总桶
+            for table in ('event_rollup_hourly', 'event_rollup_daily'):
+                self.conn.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        bucket TEXT NOT NULL,
+                        kind TEXT NOT NULL,
+                        action TEXT NOT NULL,
+                        count INTEGER NOT NULL,
+                        PRIMARY KEY (kind, bucket, action)
+                    ) WITHOUT ROWID
+                ''')
+
+            # 历史累计计数；首次建立时只能以当前状态作为起点
             self.conn.execute('''
-                CREATE INDEX IF NOT EXISTS idx_friends_time 
-                ON friends(timestamp DESC)
+                INSERT OR IGNORE INTO stat_counters (name, value)
+                SELECT 'history:' || name, value FROM stat_counters
+                WHERE name NOT LIKE 'history:%'
+            ''')
+
+            # 分页查询使用的部分覆盖索引：只包含当前有效的行；带上 last_action 使查询无需回表
+            self.conn.execute("DROP INDEX IF EXISTS idx_groups_time")
+            self.conn.execute("DROP INDEX IF EXISTS idx_friends_time")
+            self.conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_groups_active
+                ON groups(timestamp DESC, group_id DESC, last_action)
+                WHERE last_action = '加入'
+            ''')
+            self.conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_friends_active
+                ON friends(timestamp DESC, user_id DESC, last_action)
+                WHERE last_action = '添加'
             ''')
 
     def _parse_page_param(self, param: str) -> int:
@@ -70,48 +308,246 @@ class EventStatistics:
 
     def record_group_event(self, action: str, group_id: str, operator: str):
         """记录群组事件"""
-        with self.lock:
-            self.conn.execute('''
-                INSERT INTO groups 
-                (group_id, last_action, operator_id, timestamp)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(group_id) DO UPDATE SET
-                    last_action = excluded.last_action,
-                    operator_id = excluded.operator_id,
-                    timestamp = excluded.timestamp
-            ''', (group_id, action, operator, datetime.now().isoformat()))
+        row = (group_id, action, operator, datetime.now().isoformat())
+        if self._writer is None:
+            self._write_batch([row], [])
+            self._maybe_compact()
+            return
+        with self._buffer_cond:
+            self._pending_groups.append(row)
+            self._notify_if_full()
 
     def record_friend_event(self, action: str, user_id: str):
         """记录好友事件"""
+        row = (user_id, action, datetime.now().isoformat())
+        if self._writer is None:
+            self._write_batch([], [row])
+            self._maybe_compact()
+            return
+        with self._buffer_cond:
+            self._pending_friends.append(row)
+            self._notify_if_full()
+
+    def _notify_if_full(self):
+        if len(self._pending_groups) + len(self._pending_friends) >= self.config['batch_size']:
+            self._buffer_cond.notify()
+
+    def _write_batch(self, group_rows: List[tuple], friend_rows: List[tuple]):
+        """在一个事务中批量写入事件"""
         with self.lock:
-            self.conn.execute('''
-                INSERT INTO friends 
-                (user_id, last_action, timestamp)
-                VALUES (?, ?, ?)
-                ON CONFLICT(user_id) DO UPDATE SET
-                    last_action = excluded.last_action,
-                    timestamp = excluded.timestamp
-            ''', (user_id, action, datetime.now().isoformat()))
+            try:
+                self.conn.execute("BEGIN")
+                # 写入前记下受影响的行原来的位置，提交后据此平移分页游标
+                changes = {
+                    kind: self._position_changes(kind, rows)
+                    for kind, rows in (('groups', group_rows), ('friends', friend_rows))
+                    if rows and self._page_anchors.get(kind)
+                }
+                if group_rows:
+                    self.conn.executemany(GROUP_UPSERT_SQL, group_rows)
+                if friend_rows:
+                    self.conn.executemany(FRIEND_UPSERT_SQL, friend_rows)
+                self._append_history(group_rows, friend_rows)
+                self.conn.execute("COMMIT")
+                for kind, (removed, added) in changes.items():
+                    self._shift_anchors(kind, removed, added)
+            except sqlite3.Error:
+                if self.conn.in_transaction:
+                    self.conn.execute("ROLLBACK")
+                raise
+
+    def _position_changes(self, kind: str, rows: List[tuple]) -> Tuple[List[tuple], List[tuple]]:
+        """返回本批写入从分页结果中移走的 (timestamp, id) 和写入后新增的 (timestamp, id)"""
+        key_column, active = PAGE_TABLES[kind]
+        latest = {row[0]: (row[1], row[-1]) for row in rows}
+        keys = list(latest)
+        removed = []
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            removed += [
+                (timestamp, key) for key, timestamp in self.conn.execute(
+                    f"SELECT {key_column}, timestamp FROM {kind} "
+                    f"WHERE last_action = '{active}' AND {key_column} IN ({', '.join('?' * len(chunk))})",
+                    chunk
+                )
+            ]
+        added = [(timestamp, key) for key, (action, timestamp) in latest.items() if action == active]
+        return removed, added
+
+    def _shift_anchors(self, kind: str, removed: List[tuple], added: List[tuple]):
+        """按排在游标之前的行的增减平移游标位置，游标所在的行本身变化时丢弃该游标"""
+        anchors = self._page_anchors.get(kind)
+        if not anchors:
+            return
+        removed.sort()
+        added.sort()
+        moved = set(removed)
+        shifted = {}
+        for index, cursor in anchors.items():
+            if cursor in moved:
+                continue
+            # 排序为倒序，比游标大的行排在它前面
+            index += (len(added) - bisect_right(added, cursor)) - (len(removed) - bisect_right(removed, cursor))
+            shifted[index] = cursor
+        self._page_anchors[kind] = shifted
+
+    def _append_history(self, group_rows: List[tuple], friend_rows: List[tuple]):
+        """追加事件流水，并在同一事务中累加小时/天汇总和历史计数"""
+        events = [('groups', gid, action, operator, ts) for gid, action, operator, ts in group_rows]
+        events += [('friends', uid, action, None, ts) for uid, action, ts in friend_rows]
+        self.conn.executemany(EVENT_LOG_SQL, events)
+
+        # 先在内存中按桶聚合，每个桶只写一次
+        hourly = Counter((ts[:13], kind, action) for kind, _, action, _, ts in events)
+        daily = Counter((ts[:10], kind, action) for kind, _, action, _, ts in events)
+        totals = Counter(f"history:{kind}:{action}" for kind, _, action, _, _ in events)
+        self.conn.executemany(
+            ROLLUP_UPSERT_SQL.format(table='event_rollup_hourly'),
+            [(*key, count) for key, count in hourly.items()]
+        )
+        self.conn.executemany(
+            ROLLUP_UPSERT_SQL.format(table='event_rollup_daily'),
+            [(*key, count) for key, count in daily.items()]
+        )
+        self.conn.executemany(COUNTER_INCREMENT_SQL, [(count, name) for name, count in totals.items()])
+
+    def compact(self):
+        """删除超过保留期的原始事件和小时汇总"""
+        now = datetime.now()
+        raw_cutoff = (now - timedelta(days=RETENTION_CONFIG['raw_days'])).isoformat()
+        hourly_cutoff = (now - timedelta(days=RETENTION_CONFIG['hourly_days'])).isoformat()[:13]
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN")
+                raw_deleted =self.conn.execute(
+                    "DELETE FROM event_log WHERE timestamp < ?", (raw_cutoff,)
+                ).rowcount
+                hourly_deleted = self.conn.execute(
+                    "DELETE FROM event_rollup_hourly WHERE bucket < ?", (hourly_cutoff,)
+                ).rowcount
+        if raw_deleted or hourly_deleted:
+            logger.info(f"已清理过期事件 {raw_deleted} 条、小时汇总 {hourly_deleted} 条")
+
+    def _maybe_compact(self):
+        now = time.monotonic()
+        if now - self._last_compact < RETENTION_CONFIG['compact_interval']:
+            return
+        self._last_compact = now
+        try:
+            self.compact()
+        except sqlite3.Error as e:
+            logger.error(f"清理过期事件失败: {str(e)}")
+
+    def flush(self):
+        """把缓冲区中的事件立即写入数据库"""
+        with self._flush_lock:
+            with self._buffer_cond:
+                group_rows, self._pending_groups = self._pending_groups, []
+                friend_rows, self._pending_friends = self._pending_friends, []
+            if not group_rows and not friend_rows:
+                return
+            try:
+                self._write_batch(group_rows, friend_rows)
+            except sqlite3.Error as e:
+                logger.error(f"批量写入事件失败，将在下次刷盘时重试: {str(e)}")
+                # 放回缓冲区头部，保证同一对象的事件顺序不变
+                with self._buffer_cond:
+                    self._pending_groups[:0] = group_rows
+                    self._pending_friends[:0] = friend_rows
+
+    def _writer_loop(self):
+        """后台写线程：缓冲区满或到达刷盘间隔时批量提交"""
+        while True:
+            with self._buffer_cond:
+                if not self._closed and len(self._pending_groups) + len(self._pending_friends) < self.config['batch_size']:
+                    self._buffer_cond.wait(self.config['flush_interval'])
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+            self._maybe_compact()
+
+    def close(self):
+        """停止后台写线程，刷完缓冲区后关闭数据库连接"""
+        with self._buffer_cond:
+            self._closed = True
+            self._buffer_cond.notify()
+        if self._writer is not None:
+            self._writer.join()
+        self.flush()
+        self.conn.close()
+
+    def _counter(self, name: str) -> int:
+        """读取计数器（调用方须持有 lock）"""
+        row = self.conn.execute(
+            "SELECT value FROM stat_counters WHERE name = ?", (name,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def _get_page(self, kind: str, page: int, per_page: int) -> List[Tuple[str, str]]:
+        """按游标（timestamp, id）分页（调用方须持有 lock）
+
+        记住读到的行及其在排序结果中的位置作为游标，顺序翻页只需读取一页大小的索引；
+        跳到较深的页时从前后最近的已知游标定位。本连接写入时按变更的行平移游标位置，
+        不会清空，持续写入下深翻页也只需跳过游标与目标之间的少量行。
+        其他连接（分片运行时各分片共用同一个数据库）的写入无法平移，发现后清空重建。
+        """
+        version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._data_version:
+            self._page_anchors.clear()
+            self._data_version = version
+        first_page_sql, keyset_sql, reverse_sql = PAGE_QUERIES[kind]
+        anchors = self._page_anchors.setdefault(kind, {})
+        start = (page - 1) * per_page
+        cursor = None
+
+        if start > 0:
+            # 定位到目标页前一行作为游标
+            target = start - 1
+            below = max((index for index in anchors if index <= target), default=-1)
+            above = min((index for index in anchors if index > target), default=None)
+            if below == target:
+                cursor = anchors[target]
+            else:
+                if above is not None and above - target < target - below:
+                    row = self.conn.execute(reverse_sql, (*anchors[above], 1, above - target - 1)).fetchone()
+                elif below < 0:
+                    row = self.conn.execute(first_page_sql, (1, target)).fetchone()
+                else:
+                    row = self.conn.execute(keyset_sql, (*anchors[below], 1, target - below - 1)).fetchone()
+                if row is None:
+                    return []
+                cursor = (row[1], row[0])
+                self._remember_anchor(anchors, target, cursor)
+
+        if cursor is None:
+            rows = self.conn.execute(first_page_sql, (per_page, 0)).fetchall()
+        else:
+            rows = self.conn.execute(keyset_sql, (*cursor, per_page, 0)).fetchall()
+        if len(rows) == per_page:
+            self._remember_anchor(anchors, start + per_page - 1, (rows[-1][1], rows[-1][0]))
+        return rows
+
+    @staticmethod
+    def _remember_anchor(anchors: Dict[int, Tuple[str, str]], index: int, cursor: Tuple[str, str]):
+        anchors.pop(index, None)
+        anchors[index] = cursor
+        while len(anchors) > PAGE_ANCHOR_LIMIT:
+            del anchors[next(iter(anchors))]
 
     def get_groups(self, page: int = 1, per_page: int = 10) -> Tuple[int, List[Tuple[str, str]]]:
         """获取当前群组分页数据"""
         try:
-            offset = (page - 1) * per_page
-            
-            # 获取有效群组总数（最后动作为加入的群组）
-            total = self.conn.execute('''
-                SELECT COUNT(*) FROM groups 
-                WHERE last_action = '加入'
-            ''').fetchone()[0]
+            self.flush()
+            with self.lock, self.conn:
+                # 读事务：总数、数据版本检查和分页查询看到同一个快照
+                self.conn.execute("BEGIN")
+                # 有效群组总数（最后动作为加入的群组）直接读取计数器
+                total = self._counter('groups:加入')
+                page = min(page, max(1, (total + per_page - 1) // per_page))
 
-            # 获取分页数据（按最后活跃时间倒序）
-            data = self.conn.execute('''
-                SELECT group_id, timestamp 
-                FROM groups 
-                WHERE last_action = '加入'
-                ORDER BY timestamp DESC 
-                LIMIT ? OFFSET ?
-            ''', (per_page, offset)).fetchall()
+                # 获取分页数据（按最后活跃时间倒序）
+                data = self._get_page('groups', page, per_page)
 
             return total, data
         except sqlite3.Error as e:
@@ -121,22 +557,16 @@ class EventStatistics:
     def get_friends(self, page: int = 1, per_page: int = 10) -> Tuple[int, List[Tuple[str, str]]]:
         """获取当前好友分页数据"""
         try:
-            offset = (page - 1) * per_page
-            
-            # 获取有效好友总数（最后动作为添加的好友）
-            total = self.conn.execute('''
-                SELECT COUNT(*) FROM friends 
-                WHERE last_action = '添加'
-            ''').fetchone()[0]
+            self.flush()
+            with self.lock, self.conn:
+                # 读事务：总数、数据版本检查和分页查询看到同一个快照
+                self.conn.execute("BEGIN")
+                # 有效好友总数（最后动作为添加的好友）直接读取计数器
+                total = self._counter('friends:添加')
+                page = min(page, max(1, (total + per_page - 1) // per_page))
 
-            # 获取分页数据（按最后活跃时间倒序）
-            data = self.conn.execute('''
-                SELECT user_id, timestamp 
-                FROM friends 
-                WHERE last_action = '添加'
-                ORDER BY timestamp DESC 
-                LIMIT ? OFFSET ?
-            ''', (per_page, offset)).fetchall()
+                # 获取分页数据（按最后活跃时间倒序）
+                data = self._get_page('friends', page, per_page)
 
             return total, data
         except sqlite3.Error as e:
@@ -146,21 +576,13 @@ class EventStatistics:
     def get_group_stats(self) -> Dict[str, Any]:
         """获取群组统计概览"""
         try:
-            total_joined = self.conn.execute('''
-                SELECT COUNT(*) FROM groups 
-                WHERE last_action = '加入'
-            ''').fetchone()[0]
-
-            total_left = self.conn.execute('''
-                SELECT COUNT(*) FROM groups 
-                WHERE last_action = '退出'
-            ''').fetchone()[0]
-
-            return {
-                "total_joined": total_joined,
-                "total_left": total_left,
-                "current_count": total_joined - total_left
-            }
+            self.flush()
+            with self.lock:
+                return {
+                    "total_joined": self._counter('history:groups:加入'),
+                    "total_left": self._counter('history:groups:退出'),
+                    "current_count": self._counter('groups:加入')
+                }
         except sqlite3.Error as e:
             logger.error(f"群组统计失败: {str(e)}")
             return {}
@@ -168,27 +590,77 @@ class EventStatistics:
     def get_friend_stats(self) -> Dict[str, Any]:
         """获取好友统计概览"""
         try:
-            total_added = self.conn.execute('''
-                SELECT COUNT(*) FROM friends 
-                WHERE last_action = '添加'
-            ''').fetchone()[0]
-
-            total_removed = self.conn.execute('''
-                SELECT COUNT(*) FROM friends 
-                WHERE last_action = '删除'
-            ''').fetchone()[0]
-
-            return {
-                "total_added": total_added,
-                "total_removed": total_removed,
-                "current_count": total_added - total_removed
-            }
+            self.flush()
+            with self.lock:
+                return {
+                    "total_added": self._counter('history:friends:添加'),
+                    "total_removed": self._counter('history:friends:删除'),
+                    "current_count": self._counter('friends:添加')
+                }
         except sqlite3.Error as e:
             logger.error(f"好友统计失败: {str(e)}")
             return {}
 
+    def get_trend(self, kind: str, unit: str, span: int) -> List[Tuple[str, Dict[str, int]]]:
+        """从汇总桶读取最近 span 个小时（unit='h'）或天（unit='d'）的事件数"""
+        try:
+            self.flush()
+            now = datetime.now()
+            if unit == 'h':
+                table, width, step = 'event_rollup_hourly', 13, timedelta(hours=1)
+            else:
+                table, width, step = 'event_rollup_daily', 10, timedelta(days=1)
+            buckets = [(now - step * i).isoformat()[:width] for i in range(span - 1, -1, -1)]
+            with self.lock:
+                rows = self.conn.execute(f'''
+                    SELECT bucket, action, count FROM {table}
+                    WHERE kind = ? AND bucket >= ?
+                ''', (kind, buckets[0])).fetchall()
+
+            counts: Dict[str, Dict[str, int]] = {bucket: {} for bucket in buckets}
+            for bucket, action, count in rows:
+                if bucket in counts:
+                    counts[bucket][action] = count
+            return [(bucket, counts[bucket]) for bucket in buckets]
+        except sqlite3.Error as e:
+            logger.error(f"趋势查询失败: {str(e)}")
+            return []
+
 stats = EventStatistics()
 
+def _parse_span(arg: Optional[str]) -> Optional[Tuple[str, int]]:
+    """解析趋势范围参数，如 7d、24h，默认 7d"""
+    if not arg:
+        return 'd', 7
+    unit = arg[-1].lower()
+    try:
+        span = int(arg[:-1])
+    except ValueError:
+        return None
+    if unit == 'd' and 1 <= span <= TREND_MAX_DAYS:
+        return unit, span
+    if unit == 'h' and 1 <= span <= TREND_MAX_HOURS:
+        return unit, span
+    return None
+
+def _format_trend(title: str, kind: str, actions: Tuple[str, str], arg: Optional[str]) -> str:
+    parsed = _parse_span(arg)
+    if parsed is None:
+        return f"⚠️ 范围格式应为 天数d（最多{TREND_MAX_DAYS}d）或 小时数h（最多{TREND_MAX_HOURS}h），如 7d、24h"
+    unit, span = parsed
+    trend = stats.get_trend(kind, unit, span)
+    added, removed = actions
+    total_added = sum(counts.get(added, 0) for _, counts in trend)
+    total_removed = sum(counts.get(removed, 0) for _, counts in trend)
+    response = [
+        f"{title}（最近{span}{'小时' if unit == 'h' else '天'}）",
+        f"▫️ {added} {total_added} / {removed} {total_removed}"
+    ]
+    for bucket, counts in trend:
+        label = bucket[5:].replace('T', ' ') + ('时' if unit == 'h' else '')
+        response.append(f"{label}: +{counts.get(added, 0)} / -{counts.get(removed, 0)}")
+    return "\n".join(response)
+
 def on_load():
     """插件加载初始化"""
     try:
@@ -202,7 +674,8 @@ def on_load():
 def on_unload():
     """插件卸载处理"""
     try:
-        stats.conn.close()
+        # 先刷完缓冲区中尚未落盘的事件，再关闭连接
+        stats.close()
         logger.info("数据库连接已安全关闭")
     except Exception as e:
         logger.error(f"关闭连接时出错: {str(e)}")
@@ -210,17 +683,28 @@ def on_unload():
 def handle_command(content: str, **kwargs) -> Optional[str]:
     """处理所有统计命令"""
     try:
-        parts = content.strip().split()
-        if not parts:
-            return None
+        # 优先使用分发器已解析好的命令和参数，避免重复拆分
+        if 'command' in kwargs:
+            command, args = kwargs['command'], kwargs.get('args') or []
+        else:
+            parts = content.strip().split()
+            if not parts:
+                return None
+            command, args = parts[0], parts[1:]
+        command = command.lower()
+
+        # 趋势查询（参数为时间范围）
+        if command == '/群聊趋势':
+            return _format_trend("📈 群聊变动趋势", 'groups', ('加入', '退出'), args[0] if args else None)
+        elif command == '/好友趋势':
+            return _format_trend("📈 好友变动趋势", 'friends', ('添加', '删除'), args[0] if args else None)
 
-        command = parts[0].lower()
         page = 1
 
         # 解析分页参数
-        if len(parts) > 1:
+        if args:
             try:
-                page = max(1, int(parts[1]))
+                page = max(1, int(args[0]))
             except ValueError:
                 return "⚠️ 页码必须是大于0的整数"
 
@@ -285,24 +769,23 @@ def handle_command(content: str, **kwargs) -> Optional[str]:
     return None
 
 def handle_event(event_type: str, event_data: dict):
-    """处理所有事件"""
-    try:
-        # 群组事件处理
-        if event_type in ('GROUP_ADD_ROBOT', 'GROUP_DEL_ROBOT'):
-            action = '加入' if 'ADD' in event_type else '退出'
-            stats.record_group_event(
-                action=action,
-                group_id=event_data.get('group_openid'),
-                operator=event_data.get('op_member_openid', '未知')
-            )
-
-        # 好友事件处理
-        elif event_type in ('FRIEND_ADD', 'FRIEND_DEL'):
-            action = '添加' if 'ADD' in event_type else '删除'
-            stats.record_friend_event(
-                action=action,
-                user_id=event_data.get('openid')
-            )
+    """处理所有事件
+
+    记录失败时异常交给分发器处理：分发器记录日志并撤销该事件的去重登记，网关重投时会再次记录。
+    """
+    # 群组事件处理
+    if event_type in ('GROUP_ADD_ROBOT', 'GROUP_DEL_ROBOT'):
+        action = '加入' if 'ADD' in event_type else '退出'
+        stats.record_group_event(
+            action=action,
+            group_id=event_data.get('group_openid'),
+            operator=event_data.get('op_member_openid', '未知')
+        )
 
-    except Exception as e:
-        logger.error(f"事件处理失败: {str(e)}", exc_info=True)
+    # 好友事件处理
+    elif event_type in ('FRIEND_ADD', 'FRIEND_DEL'):
+        action = '添加' if 'ADD' in event_type else '删除'
+        stats.record_friend_event(
+            action=action,
+            user_id=event_data.get('openid')
+        )
@@ -1,5 +1,8 @@
 import logging
 
+# 本插件处理的命令（用于插件管理器构建分发索引）
+COMMANDS = ['/帮助', '/获取ID']
+
 def on_load():
     logging.info("基本指令插件已加载")
 
@@ -19,6 +22,8 @@ def handle_command(content, **kwargs):
 /单聊统计 - 查看好友变动记录
 /群聊总数 - 查看群聊总数统计
 /用户总数 - 查看好友用户数量
+/群聊趋势 7d - 查看群聊变动趋势（支持 d/h）
+/好友趋势 24h - 查看好友变动趋势（支持 d/h）
 /服务统计 - 查看服务运行状态
 
 ▫️ 管理功能
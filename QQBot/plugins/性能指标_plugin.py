@@ -0,0 +1,129 @@
+import logging
+import sys
+from utils.metrics import metrics
+
+# 本插件处理的命令（用于插件管理器构建分发索引）
+COMMANDS = ['/性能指标']
+TIMEOUT = 5
+
+# 允许查看性能指标的用户/成员 openid；为空时任何人都不能查看（报告含其他会话的 openid）
+ADMINS = []
+
+# 阶段名称对应的中文说明
+STAGE_NAMES = {
+    'parse': 'JSON解析',
+    'queue': '会话排队',
+    'dispatch': '插件分发',
+    'token': '获取令牌',
+    'reply': '回复发送',
+    'outbox': '发件箱落盘',
+    'send_queue': '发送排队',
+    'send': 'HTTP发送',
+    'total': '端到端'
+}
+
+def on_load():
+    logging.info("性能指标插件已加载")
+
+def on_unload():
+    logging.info("性能指标插件已卸载")
+
+def _ms(value):
+    if value is None:
+        return "-"
+    if value == float('inf'):
+        return ">10s"
+    return f"{value * 1000:.1f}"
+
+def _current_pipeline():
+    # 不直接导入网关模块，避免插件加载时引入循环依赖
+    handler = sys.modules.get('websocket_handler')
+    return getattr(handler, 'pipeline', None) if handler else None
+
+def get_conversation_report(limit: int = 10):
+    pipeline = _current_pipeline()
+    if pipeline is None:
+        return "⚠️ 消息管道未运行"
+    rows = pipeline.conversation_stats(limit)
+    if not rows:
+        return "暂无会话统计"
+    lines = [f"🐢 平均耗时最高的 {len(rows)} 个会话（单位 ms）"]
+    for row in rows:
+        lines.append(
+            f"▫️ {str(row['conversation'])[:12]}: {row['count']}条 排队{_ms(row['avg_wait'])} "
+            f"平均{_ms(row['avg_latency'])} 最大{_ms(row['max_latency'])} 积压{row['pending']}"
+        )
+    return "\n".join(lines)
+
+def get_metrics_report(detail: str = None):
+    if not metrics.enabled:
+        return "⚠️ 性能指标未开启（main.py 中 METRICS_CONFIG['enabled']）"
+
+    stages, plugins, lag = [], [], None
+    for name, labels, count, avg, p50, p99 in metrics.summary():
+        labels = dict(labels)
+        line = f"{count}次 平均{_ms(avg)} p50≤{_ms(p50)} p99≤{_ms(p99)}"
+        if name == 'qqbot_stage_duration_seconds':
+            stage = labels.get('stage', '')
+            stages.append(f"▫️ {STAGE_NAMES.get(stage, stage)}: {line}")
+        elif name == 'qqbot_plugin_duration_seconds':
+            plugins.append(f"▫️ {labels.get('plugin')}.{labels.get('func')}: {line}")
+        elif name == 'qqbot_event_loop_lag_seconds':
+            lag = line
+
+    counters = {}
+    for (name, labels), value in metrics.counters.items():
+        key = dict(labels).get('result') or dict(labels).get('reason')
+        counters[(name, key)] = counters.get((name, key), 0) + value
+
+    lines = ["📈 性能指标（耗时单位 ms）"]
+    if lag:
+        lines.append(f"⏱️ 事件循环延迟: {lag}")
+    lines.append(
+        f"📥 消息: 处理{counters.get(('qqbot_messages_total', 'processed'), 0):.0f} "
+        f"失败{counters.get(('qqbot_messages_total', 'failed'), 0):.0f} "
+        f"丢弃{counters.get(('qqbot_messages_total', 'dropped'), 0):.0f}"
+    )
+    lines.append(
+        f"📨 发送: 成功{counters.get(('qqbot_sends_total', 'sent'), 0):.0f} "
+        f"失败{counters.get(('qqbot_sends_total', 'failed'), 0):.0f} "
+        f"重试{counters.get(('qqbot_sends_total', 'retried'), 0):.0f} "
+        f"限流{counters.get(('qqbot_sends_total', 'rate_limited'), 0):.0f}"
+    )
+    hits = counters.get(('qqbot_response_cache_total', 'hit'), 0)
+    misses = counters.get(('qqbot_response_cache_total', 'miss'), 0)
+    lines.append(
+        f"🗃️ 回复缓存: 命中{hits:.0f} 未命中{misses:.0f} "
+        f"命中率{f'{hits / (hits + misses):.0%}' if hits + misses else '-'} "
+        f"失效放弃写入{counters.get(('qqbot_response_cache_total', 'stale'), 0):.0f}"
+    )
+    rejected = sum(value for (name, _), value in counters.items() if name == 'qqbot_admission_rejected_total')
+    lines.append(f"🚦 限流: 拒绝{rejected:.0f}")
+    lines.append(
+        f"🔁 去重: 拦截重复事件{counters.get(('qqbot_dedup_total', 'duplicate'), 0):.0f} "
+        f"新事件{counters.get(('qqbot_dedup_total', 'new'), 0):.0f}"
+    )
+    lines.append(
+        f"🧩 插件: 超时{counters.get(('qqbot_plugin_errors_total', 'timeout'), 0):.0f} "
+        f"异常{counters.get(('qqbot_plugin_errors_total', 'error'), 0):.0f} "
+        f"进程重启{sum(v for (n, _), v in counters.items() if n == 'qqbot_plugin_worker_restarts_total'):.0f}"
+    )
+    if stages:
+        lines.append("▫️ 各阶段耗时")
+        lines.extend(stages)
+    if detail == '插件' and plugins:
+        lines.append("▫️ 插件耗时")
+        lines.extend(plugins)
+    elif plugins:
+        lines.append("（发送“/性能指标 插件”查看各插件耗时，“/性能指标 会话”查看各会话延迟）")
+    return "\n".join(lines)
+
+def handle_command(content, **kwargs):
+    if kwargs.get('command', content) == '/性能指标':
+        caller = kwargs.get('member_openid') or kwargs.get('user_openid')
+        if caller not in ADMINS:
+            return "⚠️ 仅管理员可查看性能指标"
+        args = kwargs.get('args') or []
+        if args and args[0] == '会话':
+            return get_conversation_report()
+        return get_metrics_report(args[0] if args else None)
@@ -1,15 +1,151 @@
 import psutil
+import sys
 import time
 import logging
+import threading
+from collections import deque
 from datetime import datetime
 
+# 本插件处理的命令（用于插件管理器构建分发索引）
+COMMANDS = ['/运行状态']
+TIMEOUT = 5
+# 启动即加载：运行时间和采样历史都从插件加载时开始计算
+LAZY = False
+# 短时间内重复查询直接复用最近一次结果
+CACHE = {'/运行状态': {'ttl': 5, 'key': 'args'}}
+# 入站限额 (次数, 秒数)：在全局默认限额之外，单个成员每分钟最多查询 3 次
+RATE_LIMITS = {'/运行状态': {'member': (3, 60)}}
+
+# 后台采样配置
+SAMPLE_INTERVAL = 5       # 采样间隔（秒）
+HISTORY_MINUTES = 30      # 环形缓冲区保留的时长（分钟）
+DEFAULT_WINDOW = 5        # /运行状态 默认统计最近几分钟
+
 start_time = time.time()
 process = psutil.Process()
 
+
+class Sample:
+    """一次系统指标采样"""
+
+    __slots__ = ('timestamp', 'cpu', 'rss', 'mem_used', 'mem_total', 'disk_used', 'disk_total',
+                 'load_avg', 'loop_lag', 'queue_depth', 'msg_rate')
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+
+class MetricsSampler:
+    """后台线程定时采样，结果写入环形缓冲区，查询时不再触碰 psutil"""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL, history_minutes: int = HISTORY_MINUTES):
+        self.interval = interval
+        self.samples = deque(maxlen=int(history_minutes * 60 / interval))
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_processed = None
+        self._last_time = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        # cpu_percent 第一次调用只建立基准，之后每次返回两次调用之间的平均值
+        psutil.cpu_percent(interval=None)
+        self._thread = threading.Thread(target=self._run, name="status-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval + 1)
+        self._thread = None
+
+    def _run(self):
+        # 首次采样稍等片刻，让 CPU 基准有意义
+        delay = min(1.0, self.interval)
+        while not self._stop.wait(delay):
+            try:
+                sample = self._take_sample()
+                with self.lock:
+                    self.samples.append(sample)
+            except Exception as e:
+                logging.error(f"系统指标采样失败: {str(e)}")
+            delay = self.interval
+
+    def _take_sample(self) -> Sample:
+        mem = psutil.virtual_memory()
+        disk = psutil.disk_usage('/')
+        pipeline = _current_pipeline()
+        loop_lag = queue_depth = msg_rate = None
+        if pipeline is not None:
+            queue_depth = pipeline.stats()['depth']
+            msg_rate = self._message_rate(pipeline.processed)
+            if pipeline.loop is not None:
+                loop_lag = _measure_loop_lag(pipeline.loop)
+        return Sample(
+            timestamp=time.time(),
+            cpu=psutil.cpu_percent(interval=None),
+            rss=process.memory_info().rss,
+            mem_used=mem.used,
+            mem_total=mem.total,
+            disk_used=disk.used,
+            disk_total=disk.total,
+            load_avg=psutil.getloadavg(),
+            loop_lag=loop_lag,
+            queue_depth=queue_depth,
+            msg_rate=msg_rate
+        )
+
+    def _message_rate(self, processed: int):
+        now = time.monotonic()
+        rate = None
+        if self._last_processed is not None and now > self._last_time:
+            rate = max(0, processed - self._last_processed) / (now - self._last_time)
+        self._last_processed, self._last_time = processed, now
+        return rate
+
+    def window(self, minutes: float):
+        """返回最近 minutes 分钟内的采样"""
+        cutoff = time.time() - minutes * 60
+        with self.lock:
+            return [s for s in self.samples if s.timestamp >= cutoff]
+
+
+def _current_pipeline():
+    # 只读取已加载的网关模块，不在插件中主动导入网络栈
+    handler = sys.modules.get('websocket_handler')
+    return getattr(handler, 'pipeline', None) if handler else None
+
+def _measure_loop_lag(loop, timeout: float = 1.0):
+    """向事件循环投递一个回调，测量其被执行前的排队时间（秒）"""
+    executed = threading.Event()
+    scheduled_at = time.perf_counter()
+    result = {}
+
+    def _callback():
+        result['lag'] = time.perf_counter() - scheduled_at
+        executed.set()
+
+    try:
+        loop.call_soon_threadsafe(_callback)
+    except RuntimeError:
+        return None  # 事件循环已关闭
+    if not executed.wait(timeout):
+        return timeout
+    return result['lag']
+
+
+sampler = MetricsSampler()
+
 def on_load():
+    sampler.start()
     logging.info("运行状态插件已加载")
 
 def on_unload():
+    sampler.stop()
     logging.info("运行状态插件已卸载")
 
 def format_uptime(seconds):
@@ -18,19 +154,42 @@ def format_uptime(seconds):
     minutes = (seconds % 3600) // 60
     return f"{int(days)}天{int(hours)}小时{int(minutes)}分"
 
-def get_system_status():
-    mem = psutil.virtual_memory()
-    disk = psutil.disk_usage('/')
-    load_avg = psutil.getloadavg()
-    
+def _summary(samples, field, scale=1.0, fmt="{:.1f}"):
+    """当前值及窗口内的 最小/平均/最大"""
+    values = [getattr(s, field) for s in samples if getattr(s, field) is not None]
+    if not values:
+        return "-"
+    current = fmt.format(values[-1] * scale)
+    low, avg, high = (fmt.format(v * scale) for v in (min(values), sum(values) / len(values), max(values)))
+    return f"{current}（{low}/{avg}/{high}）"
+
+def get_system_status(window_minutes: float = DEFAULT_WINDOW):
+    samples = sampler.window(window_minutes)
+    if not samples:
+        return "⏳ 正在采集系统指标，请稍后再试"
+
+    latest = samples[-1]
+    mb = 1 / 1024 / 1024
     return (
         f"🕒 运行时间: {format_uptime(time.time() - start_time)}\n"
-        f"💻 CPU使用率: {psutil.cpu_percent()}%\n"
-        f"🧠 内存使用: {mem.used/1024/1024:.1f}MB / {mem.total/1024/1024:.1f}MB\n"
-        f"💾 磁盘使用: {disk.used/1024/1024/1024:.1f}GB / {disk.total/1024/1024/1024:.1f}GB\n"
-        f"📊 系统负载: {load_avg[0]:.2f} (1分钟), {load_avg[1]:.2f} (5分钟)"
+        f"📐 最近{window_minutes:g}分钟 {len(samples)} 个采样，括号内为 最小/平均/最大\n"
+        f"💻 CPU使用率: {_summary(samples, 'cpu')}%\n"
+        f"🧠 内存使用: {latest.mem_used*mb:.1f}MB / {latest.mem_total*mb:.1f}MB\n"
+        f"📦 进程内存: {_summary(samples, 'rss', mb)}MB\n"
+        f"💾 磁盘使用: {latest.disk_used/1024/1024/1024:.1f}GB / {latest.disk_total/1024/1024/1024:.1f}GB\n"
+        f"📊 系统负载: {latest.load_avg[0]:.2f} (1分钟), {latest.load_avg[1]:.2f} (5分钟)\n"
+        f"⏱️ 事件循环延迟: {_summary(samples, 'loop_lag', 1000)}ms\n"
+        f"📥 消息队列深度: {_summary(samples, 'queue_depth', fmt='{:.0f}')}\n"
+        f"📨 消息速率: {_summary(samples, 'msg_rate')}条/秒"
     )
 
 def handle_command(content, **kwargs):
-    if content == '/运行状态':
-        return get_system_status()
+    if kwargs.get('command', content) == '/运行状态':
+        args = kwargs.get('args') or []
+        window = DEFAULT_WINDOW
+        if args:
+            try:
+                window = min(HISTORY_MINUTES, max(1, int(args[0])))
+            except ValueError:
+                return f"⚠️ 统计时长应为 1-{HISTORY_MINUTES} 分钟的整数"
+        return get_system_status(window)
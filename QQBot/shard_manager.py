@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from multiprocessing.managers import SyncManager
+from typing import Any, Dict, List, Optional
+from utils.logger import setup_logging, stop_logging
+
+DEFAULT_SUPERVISOR_CONFIG = {
+    'check_interval': 2,         # 检查分片存活的间隔（秒）
+    'restart_delay': 1,          # 分片退出后的初始重启等待（秒）
+    'max_restart_delay': 60,     # 连续崩溃时的最大重启等待（秒）
+    'stable_after': 60,          # 分片运行超过该时间后视为稳定，重置重启退避
+    'stop_timeout': 15           # 关闭时等待分片退出的时间（秒）
+}
+
+
+def _ignore_sigint():
+    # 共享状态服务进程忽略 Ctrl+C，由监督进程在分片退出后再关闭
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def run_shard(shard_id: int, shard_count: int, uri: str, log_config: Dict[str, Any], token_store, token_lock):
+    """分片子进程入口：独立的事件循环、插件和网络连接"""
+    # 每个分片写入独立的日志目录，避免多进程同时轮转同一个文件
+    log_listener = setup_logging({**log_config, 'log_dir': os.path.join(log_config['log_dir'], f"shard-{shard_id}")})
+
+    from fetch_access_token import token_manager
+    from main import serve
+
+    # access_token 由监督进程统一刷新，分片只从共享存储读取
+    token_manager.attach_shared_store(token_store, token_lock, consumer=True)
+    logging.info(f"分片 {shard_id}/{shard_count} 已启动 (pid={os.getpid()})")
+    try:
+        serve(uri, {'shard': [shard_id, shard_count]})
+    finally:
+        stop_logging(log_listener)
+
+
+class ShardProcess:
+    """单个分片进程的运行状态"""
+
+    def __init__(self, shard_id: int):
+        self.shard_id = shard_id
+        self.process: Optional[multiprocessing.Process] = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.next_start = 0.0
+
+
+class ShardSupervisor:
+    """分片监督进程：为每个分片拉起独立进程，分片异常退出后按退避策略重启
+
+    跨进程共享的状态：
+    - access_token：监督进程刷新后写入 Manager 共享字典，分片按需读取
+    - 统计数据库：各分片通过 SQLite WAL 的文件锁和 busy timeout 串行化写入
+    """
+
+    def __init__(self, uri: str, shard_count: int, log_config: Dict[str, Any], config: Dict[str, Any] = None):
+        self.uri = uri
+        self.shard_count = shard_count
+        self.log_config = log_config
+        self.config = {**DEFAULT_SUPERVISOR_CONFIG, **(config or {})}
+        # 使用 spawn，避免子进程继承监督进程的线程和文件句柄
+        self.context = multiprocessing.get_context('spawn')
+        self.shards: List[ShardProcess] = [ShardProcess(i) for i in range(shard_count)]
+        self._stopping = False
+
+    def run(self):
+        """启动全部分片并持续监督，直到收到中断信号"""
+        manager = SyncManager(ctx=self.context)
+        manager.start(_ignore_sigint)
+        self.token_store = manager.dict()
+        self.token_lock = manager.Lock()
+        threading.Thread(target=self._token_refresher, name="token-refresher", daemon=True).start()
+
+        logging.info(f"分片监督进程已启动，共 {self.shard_count} 个分片")
+        try:
+            for shard in self.shards:
+                self._start_shard(shard)
+            while not self._stopping:
+                time.sleep(self.config['check_interval'])
+                self._check_shards()
+        except KeyboardInterrupt:
+            logging.info("收到中断信号，正在关闭所有分片...")
+        finally:
+            self._stopping = True
+            self._stop_shards()
+            manager.shutdown()
+            logging.info("分片监督进程已退出")
+
+    def _token_refresher(self):
+        """在独立线程的事件循环中刷新 access_token 并发布给所有分片"""
+        from fetch_access_token import token_manager
+
+        async def _refresh_forever():
+            token_manager.attach_shared_store(self.token_store, self.token_lock)
+            await token_manager.start()
+            await asyncio.Event().wait()
+
+        try:
+            asyncio.run(_refresh_forever())
+        except Exception as e:
+            logging.error(f"令牌刷新线程异常退出: {str(e)}", exc_info=True)
+
+    def _start_shard(self, shard: ShardProcess):
+        shard.process = self.context.Process(
+            target=run_shard,
+            args=(shard.shard_id, self.shard_count, self.uri, self.log_config, self.token_store, self.token_lock),
+            name=f"shard-{shard.shard_id}"
+        )
+        shard.process.start()
+        shard.started_at = time.time()
+        logging.info(f"分片 {shard.shard_id} 已拉起 (pid={shard.process.pid})")
+
+    def _check_shards(self):
+        now = time.time()
+        for shard in self.shards:
+            if shard.process is not None and shard.process.is_alive():
+                continue
+
+            if shard.process is not None:
+                exitcode = shard.process.exitcode
+                shard.process = None
+                # 稳定运行一段时间后再退出的分片，重启退避从头计算
+                if now - shard.started_at >= self.config['stable_after']:
+                    shard.restarts = 0
+                delay = min(
+                    self.config['max_restart_delay'],
+                    self.config['restart_delay'] * (2 ** shard.restarts)
+                )
+                shard.next_start = now + delay
+                shard.restarts += 1
+                logging.error(f"分片 {shard.shard_id} 已退出 (exitcode={exitcode})，{delay} 秒后重启")
+
+            if now >= shard.next_start:
+                self._start_shard(shard)
+
+    def _stop_shards(self):
+        deadline = time.time() + self.config['stop_timeout']
+        for shard in self.shards:
+            if shard.process is None:
+                continue
+            shard.process.join(max(0, deadline - time.time()))
+            if shard.process.is_alive():
+                logging.warning(f"分片 {shard.shard_id} 未能按时退出，强制结束")
+                shard.process.terminate()
+                shard.process.join()
@@ -0,0 +1,100 @@
+import logging
+from typing import Any, Dict, Optional, Tuple
+from utils.metrics import metrics
+from utils.rate_limit import BucketRegistry
+
+# 限流范围：按成员（单聊为用户）、按群、全局
+SCOPES = ('member', 'group', 'global')
+
+DEFAULT_ADMISSION_CONFIG = {
+    'enabled': True,
+    # 每个范围的限额写作 (次数, 秒数)：该时间内最多放行的消息数，可以一次性用完；None 表示不限制
+    'member': (10, 30),
+    'group': (30, 30),
+    'global': (100, 1),
+    'notify_interval': 60,     # 同一成员被限流时每隔多少秒最多提示一次，0 表示静默丢弃
+    'max_keys': 10000,         # 每个范围最多跟踪的成员/群数量
+    'idle_seconds': 300        # 空闲多久的令牌桶会被回收
+}
+
+# 被限流时回复的提示
+REJECT_NOTICE = "⚠️ 操作太频繁，请稍后再试"
+
+
+class AdmissionController:
+    """插件分发前的入站限流：成员、群、全局三级令牌桶，插件可按命令追加更严格的限额
+
+    插件在清单中声明 RATE_LIMITS = {"/命令": {"member": (次数, 秒数), ...}}，
+    命令级限额与全局默认限额同时生效。只有所有相关的桶都有余量时才会扣减，
+    被拒绝的消息不会消耗其他范围的额度。
+    """
+
+    def __init__(self, config: Dict[str, Any] = None):
+        self.configure(config)
+
+    def configure(self, config: Dict[str, Any] = None):
+        """应用新配置，已有的令牌桶全部重置"""
+        self.config = {**DEFAULT_ADMISSION_CONFIG, **(config or {})}
+        # (命令, 范围, 次数, 秒数) -> 令牌桶集合；默认限额的命令为 None
+        self._registries: Dict[Tuple, BucketRegistry] = {}
+        interval = self.config['notify_interval']
+        self._notices = BucketRegistry(1 / interval, 1, self.config['max_keys'], interval) if interval else None
+        self.admitted = 0
+        # (范围, 命令) -> 拒绝次数
+        self.rejected: Dict[Tuple[str, Optional[str]], int] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.config['enabled']
+
+    def admit(self, command: str, member: Optional[str], group: Optional[str],
+              command_limits: Optional[Dict[str, Tuple[float, float]]] = None) -> Optional[str]:
+        """放行返回 None，被拒绝时返回触发限流的范围"""
+        keys = {'member': member, 'group': group, 'global': 'global'}
+        buckets = []
+        for limited_command, limits in ((None, self.config), (command, command_limits or {})):
+            for scope in SCOPES:
+                limit, key = limits.get(scope), keys[scope]
+                if not limit or key is None:
+                    continue
+                bucket = self._registry(limited_command, scope, limit).get(key)
+                if bucket.time_until_available() > 0:
+                    self._reject(scope, limited_command)
+                    return scope
+                buckets.append(bucket)
+        for bucket in buckets:
+            bucket.try_acquire()
+        self.admitted += 1
+        return None
+
+    def should_notify(self, member: Optional[str]) -> bool:
+        """被限流的成员在提示间隔内只提示一次，避免提示本身消耗发送额度"""
+        if self._notices is None or member is None:
+            return False
+        return self._notices.get(member).try_acquire()
+
+    def _registry(self, command: Optional[str], scope: str, limit: Tuple[float, float]) -> BucketRegistry:
+        count, seconds = limit
+        key = (command, scope, count, seconds)
+        registry = self._registries.get(key)
+        if registry is None:
+            registry = self._registries[key] = BucketRegistry(
+                count / seconds, count, self.config['max_keys'], self.config['idle_seconds']
+            )
+        return registry
+
+    def _reject(self, scope: str, command: Optional[str]):
+        key = (scope, command)
+        count = self.rejected[key] = self.rejected.get(key, 0) + 1
+        metrics.inc('qqbot_admission_rejected_total', {'scope': scope, 'command': command or '*'})
+        # 刷屏时每 100 次只记录一次
+        if count % 100 == 1:
+            target = f"命令 {command} 的" if command else ""
+            logging.warning(f"入站限流：{target}{scope} 限额已用完（累计拒绝 {count} 次）")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'admitted': self.admitted,
+            'rejected': sum(self.rejected.values()),
+            'tracked': {f"{c or '*'}:{s}": len(r) for (c, s, _, _), r in self._registries.items()}
+        }
@@ -0,0 +1,159 @@
+import json
+from datetime import datetime
+from typing import Any, Optional, Union
+
+# 按 orjson > msgspec > 标准库 的顺序选择 JSON 实现，均未安装时退回标准库
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+if orjson is not None:
+    BACKEND = 'orjson'
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+elif msgspec is not None:
+    BACKEND = 'msgspec'
+    _encoder = msgspec.json.Encoder()
+    _decoder = msgspec.json.Decoder()
+
+    def loads(data: Union[str, bytes]) -> Any:
+        try:
+            return _decoder.decode(data)
+        except msgspec.DecodeError as e:
+            # 与其他实现保持一致，解析失败统一抛出 ValueError
+            raise ValueError(str(e)) from None
+
+    def dumps(obj: Any) -> bytes:
+        return _encoder.encode(obj)
+
+else:
+    BACKEND = 'json'
+    _json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+    def dumps(obj: Any) -> bytes:
+        return _json_encoder.encode(obj).encode('utf-8')
+
+
+def dumps_str(obj: Any) -> str:
+    """序列化为 str（websocket 文本帧使用）"""
+    return dumps(obj).decode('utf-8')
+
+
+class Frame:
+    """网关帧：只取出路由需要的字段，事件内容 d 保持原样
+
+    id 为分发事件的全局事件 ID（如 "GROUP_AT_MESSAGE_CREATE:xxx"），非分发帧没有该字段。
+    """
+
+    __slots__ = ('op', 's', 't', 'd', 'id')
+
+    def __init__(self, op: Optional[int], s: Optional[int], t: Optional[str], d: Any, id: Optional[str] = None):
+        self.op = op
+        self.s = s
+        self.t = t
+        self.d = d
+        self.id = id
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Frame':
+        return cls(data.get('op'), data.get('s'), data.get('t'), data.get('d'), data.get('id'))
+
+    def to_dict(self) -> dict:
+        data = {'op': self.op, 's': self.s, 't': self.t, 'd': self.d}
+        if self.id is not None:
+            data['id'] = self.id
+        return data
+
+    def event_key(self) -> Optional[str]:
+        """事件去重键：优先使用全局事件 ID，缺失时退回消息 ID（d.id）"""
+        if self.id:
+            return self.id
+        if isinstance(self.d, dict) and self.d.get('id'):
+            return f"{self.t}:{self.d['id']}"
+        return None
+
+    def __repr__(self) -> str:
+        return f"Frame(op={self.op}, s={self.s}, t={self.t}, id={self.id}, d={self.d})"
+
+
+class MessageEvent:
+    """群聊/单聊消息事件中 process_message 用到的字段"""
+
+    __slots__ = ('event_type', 'msg_id', 'content', 'group_openid', 'member_openid', 'user_openid', 'timestamp')
+
+    def __init__(self, event_type: str, msg_id: str, content: str,
+                 group_openid: Optional[str], member_openid: Optional[str], user_openid: Optional[str],
+                 timestamp: Optional[float] = None):
+        self.event_type = event_type
+        self.msg_id = msg_id
+        self.content = content
+        self.group_openid = group_openid
+        self.member_openid = member_openid
+        self.user_openid = user_openid
+        # 消息发出的时间（Unix 时间戳），被动回复窗口从此时开始计算；缺失或无法解析时为 None
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_frame(cls, frame: Frame) -> 'MessageEvent':
+        """缺少 id/content/author 时抛出 KeyError"""
+        d = frame.d
+        author = d['author']
+        return cls(
+            frame.t,
+            d['id'],
+            d['content'].strip(),
+            d.get('group_openid'),
+            author.get('member_openid'),
+            author.get('user_openid'),
+            parse_timestamp(d.get('timestamp'))
+        )
+
+    def __repr__(self) -> str:
+        return f"MessageEvent(t={self.event_type}, id={self.msg_id}, content={self.content!r})"
+
+
+def parse_timestamp(value: Any) -> Optional[float]:
+    """事件中的时间：ISO 8601 字符串（如 2023-11-06T13:37:18+08:00）或 Unix 时间戳，无法解析时返回 None"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, str) and value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            return None
+    return None
+
+
+def decode_frame(message: Union[str, bytes]) -> Frame:
+    """解析一条网关消息，非 JSON 对象时抛出 ValueError"""
+    data = loads(message)
+    if not isinstance(data, dict):
+        raise ValueError(f"网关消息不是 JSON 对象: {type(data).__name__}")
+    return Frame.from_dict(data)
+
+
+def as_frame(data: Union[Frame, dict, str, bytes]) -> Frame:
+    """兼容旧调用方式：接受已解析的帧、dict 或原始文本"""
+    if isinstance(data, Frame):
+        return data
+    if isinstance(data, dict):
+        return Frame.from_dict(data)
+    return decode_frame(data)
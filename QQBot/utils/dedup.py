@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from utils.metrics import metrics
+
+DEFAULT_DEDUP_CONFIG = {
+    'enabled': True,
+    'ttl': 600,              # 去重窗口（秒），网关断线重连后的重投通常在此时间内
+    'max_entries': 100000,   # 内存中最多保留的事件 ID 数，超出时淘汰最早的
+    'persist_path': None,    # SQLite 文件路径，设置后重启也能识别重投的事件
+    'flush_interval': 1.0    # 持久化的批量写入间隔（秒）
+}
+
+
+class DedupIndex:
+    """带时间窗口和容量上限的事件去重索引
+
+    事件 ID 按到达顺序存放在 OrderedDict 中，窗口固定，因此最早到达的也最早过期，
+    查询、插入和过期清理均为 O(1)（均摊）。开启持久化时新增的 ID 先缓冲在内存中，
+    由后台任务在线程池中批量写入 SQLite，启动时载入仍在窗口内的记录。
+    """
+
+    def __init__(self, config: Dict[str, Any] = None):
+        self.config = {**DEFAULT_DEDUP_CONFIG, **(config or {})}
+        # 事件 ID -> 过期时间（墙钟时间，重启后仍然有效）
+        self._entries: "OrderedDict[str, float]" = OrderedDict()
+        # 待写入的变更：事件 ID -> 过期时间，None 表示删除
+        self._pending: Dict[str, Optional[float]] = {}
+        self._conn: Optional[sqlite3.Connection] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        # 运行指标
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    async def start(self):
+        """打开持久化文件并载入未过期的记录，启动批量写入任务"""
+        path = self.config['persist_path']
+        if not path:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            rows = await loop.run_in_executor(None, self._open, path)
+        except sqlite3.Error as e:
+            logging.error(f"去重索引持久化文件打开失败，仅在内存中去重: {e}")
+            self._conn = None
+            return
+        for key, expires in rows:
+            self._entries[key] = expires
+        self._trim()
+        self._flush_task = asyncio.create_task(self._flush_loop(), name="dedup-flush")
+        logging.info(f"去重索引已载入 {len(self._entries)} 条未过期记录（{path}）")
+
+    async def close(self):
+        """停止后台任务，写完剩余变更并关闭数据库"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        if self._conn is not None:
+            await self.flush()
+            self._conn.close()
+            self._conn = None
+
+    def seen(self, key: str) -> bool:
+        """检查事件是否已处理过；未处理过时登记并返回 False"""
+        now = time.time()
+        self._expire(now)
+        if key in self._entries:
+            self.hits += 1
+            metrics.inc('qqbot_dedup_total', {'result': 'duplicate'})
+            return True
+        expires = now + self.config['ttl']
+        self._entries[key] = expires
+        self._trim()
+        if self._conn is not None:
+            self._pending[key] = expires
+        self.misses += 1
+        metrics.inc('qqbot_dedup_total', {'result': 'new'})
+        return False
+
+    def forget(self, key: str):
+        """处理失败时撤销登记，使重投的同一事件可以再次处理"""
+        if self._entries.pop(key, None) is not None and self._conn is not None:
+            self._pending[key] = None
+
+    def _expire(self, now: float):
+        entries = self._entries
+        while entries:
+            key, expires = next(iter(entries.items()))
+            if expires > now:
+                break
+            entries.popitem(last=False)
+            self.expired += 1
+
+    def _trim(self):
+        while len(self._entries) > self.config['max_entries']:
+            self._entries.popitem(last=False)
+            self.evicted += 1
+
+    def _open(self, path: str) -> List[Tuple[str, float]]:
+        conn = sqlite3.connect(path, check_same_thread=False, timeout=15, isolation_level=None)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS seen_events (
+                event_id TEXT PRIMARY KEY,
+                expires REAL NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        now = time.time()
+        conn.execute("DELETE FROM seen_events WHERE expires <= ?", (now,))
+        rows = conn.execute(
+            "SELECT event_id, expires FROM seen_events ORDER BY expires DESC LIMIT ?",
+            (self.config['max_entries'],)
+        ).fetchall()
+        self._conn = conn
+        # 按过期时间从早到晚放入，保持与运行时相同的顺序
+        rows.reverse()
+        return rows
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.config['flush_interval'])
+            await self.flush()
+
+    async def flush(self):
+        """把缓冲的变更批量写入数据库，失败时保留到下次写入"""
+        if self._conn is None or not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, pending)
+        except Exception as e:
+            logging.error(f"去重索引写入失败，将在下次写入时重试: {e}")
+            # 写入期间同一事件又有新的变更（如处理失败后撤销登记）时以新的为准
+            self._pending = {**pending, **self._pending}
+
+    def _write(self, pending: Dict[str, Optional[float]]):
+        added = [(key, expires) for key, expires in pending.items() if expires is not None]
+        removed = [(key,) for key, expires in pending.items() if expires is None]
+        with self._conn:
+            self._conn.execute("BEGIN")
+            if added:
+                self._conn.executemany("INSERT OR REPLACE INTO seen_events VALUES (?, ?)", added)
+            if removed:
+                self._conn.executemany("DELETE FROM seen_events WHERE event_id = ?", removed)
+            self._conn.execute("DELETE FROM seen_events WHERE expires <= ?", (time.time(),))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evicted': self.evicted
+        }
@@ -1,16 +1,116 @@
+import atexit
 import logging
 import os
-from logging.handlers import TimedRotatingFileHandler
-from typing import Dict, Any
-
-def setup_logging(config: Dict[str, Any] = None):
-    """配置多级日志系统"""
-    config = config or {
-        'log_dir': 'logs',
-        'debug_keep_days': 7,
-        'error_keep_weeks': 4,
-        'console_level': 'INFO'
-    }
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+from typing import Dict, Any, Optional
+from utils.metrics import metrics
+
+DEFAULT_LOG_CONFIG = {
+    'log_dir': 'logs',
+    'debug_keep_days': 7,
+    'error_keep_weeks': 4,
+    'console_level': 'INFO',
+    'queue_size': 10000,      # 日志队列容量，写盘跟不上时丢弃并计数，不阻塞业务
+    'json': False,            # 文件日志是否输出为 JSON Lines
+    'info_per_second': 20     # 同一行代码每秒最多输出的 INFO/DEBUG 日志条数，0 表示不限制
+}
+
+
+class DroppingQueueHandler(QueueHandler):
+    """队列满时直接丢弃并计数，恢复后补记一条丢弃汇总"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._unreported = 0
+        self._lock = threading.Lock()
+
+    def enqueue(self, record: logging.LogRecord):
+        if self._unreported:
+            self._report_dropped()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                self._unreported += 1
+
+    def _report_dropped(self):
+        count = self._unreported
+        notice = logging.LogRecord(
+            'utils.logger', logging.WARNING, __file__, 0,
+            f"日志队列已满，丢弃了 {count} 条日志（累计 {self.dropped} 条）", None, None
+        )
+        try:
+            self.queue.put_nowait(notice)
+        except queue.Full:
+            return
+        with self._lock:
+            self._unreported -= count
+
+
+class SamplingFilter(logging.Filter):
+    """按调用位置对 INFO 及以下日志限速，WARNING 及以上始终保留
+
+    每个调用位置每秒最多放行 per_second 条，被省略的条数附加在下一条放行的日志上。
+    """
+
+    def __init__(self, per_second: int):
+        super().__init__()
+        self.per_second = per_second
+        # (文件, 行号) -> [窗口开始时间, 本窗口已放行数, 已省略数]
+        self._windows: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO or self.per_second <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                window = self._windows[key] = [now, 0, 0]
+            if now - window[0] >= 1:
+                window[0], window[1] = now, 0
+            if window[1] >= self.per_second:
+                window[2] += 1
+                return False
+            window[1] += 1
+            suppressed, window[2] = window[2], 0
+        if suppressed:
+            record.msg = f"{record.msg}（此前省略同类日志 {suppressed} 条）"
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行 JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        # 延迟导入，避免日志模块依赖编解码模块的加载顺序
+        from utils.codec import dumps_str
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return dumps_str(entry)
+
+
+def setup_logging(config: Dict[str, Any] = None) -> QueueListener:
+    """配置多级日志系统
+
+    业务线程只把日志放入有界队列，由后台线程写文件和控制台。
+    返回的 QueueListener 需要在退出前调用 stop() 以写完剩余日志。
+    """
+    config = {**DEFAULT_LOG_CONFIG, **(config or {})}
 
     if not os.path.exists(config['log_dir']):
         os.makedirs(config['log_dir'])
@@ -42,16 +142,52 @@ def setup_logging(config: Dict[str, Any] = None):
     formatter = logging.Formatter(
         '%(asctime)s [%(threadName)s] %(name)s - %(levelname)s - %(message)s'
     )
-    for handler in [debug_handler, error_handler, console_handler]:
-        handler.setFormatter(formatter)
+    file_formatter = JsonFormatter() if config['json'] else formatter
+    debug_handler.setFormatter(file_formatter)
+    error_handler.setFormatter(file_formatter)
+    console_handler.setFormatter(formatter)
+
+    # 业务侧只挂队列处理器，实际写入由监听线程完成
+    log_queue = queue.Queue(maxsize=config['queue_size'])
+    queue_handler = DroppingQueueHandler(log_queue)
+    # 入队前只拼接消息本身，时间、级别等由各输出端的格式化器处理
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    if config['info_per_second']:
+        queue_handler.addFilter(SamplingFilter(config['info_per_second']))
+    listener = QueueListener(
+        log_queue, debug_handler, error_handler, console_handler,
+        respect_handler_level=True
+    )
 
     # 配置根日志
     logging.basicConfig(
         level=logging.DEBUG,
-        handlers=[debug_handler, error_handler, console_handler],
+        handlers=[queue_handler],
         force=True
     )
+    listener.start()
+    metrics.register_counter('qqbot_log_dropped_total', lambda: queue_handler.dropped, '因日志队列已满丢弃的日志条数')
+    # 兜底：未显式停止时在解释器退出前写完队列中的日志
+    atexit.register(_stop_listener, listener)
 
     # 设置第三方库日志级别
     logging.getLogger('websockets').setLevel(logging.WARNING)
     logging.getLogger('aiohttp').setLevel(logging.WARNING)
+    return listener
+
+
+def _stop_listener(listener: Optional[QueueListener]):
+    # QueueListener.stop 重复调用会出错，这里只停止仍在运行的监听器
+    for _ in range(100):
+        if listener is None or getattr(listener, '_thread', None) is None:
+            return
+        try:
+            listener.stop()
+        except queue.Full:
+            # 队列满时结束标记放不进去，稍等监听线程消化后重试
+            time.sleep(0.05)
+
+
+def stop_logging(listener: Optional[QueueListener]):
+    """停止日志监听线程，写完队列中剩余的日志"""
+    _stop_listener(listener)
@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Set, Tuple
+from utils.metrics import metrics
+
+# 队列满时的处理策略
+OVERFLOW_BLOCK = 'block'     # 阻塞接收循环，形成背压
+OVERFLOW_DROP = 'drop'       # 丢弃新到达的消息
+OVERFLOW_OLDEST = 'oldest'   # 丢弃积压最多的会话中最旧的消息，保留新消息
+
+DEFAULT_PIPELINE_CONFIG = {
+    'workers': 10,           # 消费协程数量
+    'max_size': 1000,        # 队列容量（所有会话合计）
+    'overflow': OVERFLOW_BLOCK,
+    'drain_timeout': 10,     # 关闭时等待队列排空的时间（秒）
+    'conversation_concurrency': 1,  # 单个会话同时处理的消息数，为 1 时会话内严格按到达顺序处理
+    'conversation_backlog': 200,    # 单个会话最多积压的消息数，超出时丢弃该会话最旧的消息；0 表示不限制
+    'stats_conversations': 1000     # 保留延迟统计的会话数（按最近活跃淘汰）
+}
+
+
+class MessagePipeline:
+    """事件循环内的有界消息处理管道：接收循环入队，N 个工作协程按会话轮转消费
+
+    每个会话（群或单聊用户，由 key 函数给出）有自己的子队列，工作协程按轮转顺序
+    每次从一个会话取一条，单个会话同时占用的工作协程不超过 conversation_concurrency，
+    刷屏的群只会拉长自己的排队时间，不会挤占其他会话。key 返回 None 的消息
+    （无法识别会话）不受单会话并发限制，也不保证顺序。
+    handler 抛出异常或返回 False 时计为处理失败。
+    """
+
+    def __init__(self, handler: Callable[[Any], Awaitable[Optional[bool]]], config: Dict[str, Any] = None,
+                 key: Callable[[Any], Optional[Hashable]] = None):
+        self.handler = handler
+        self.config = {**DEFAULT_PIPELINE_CONFIG, **(config or {})}
+        if self.config['overflow'] not in (OVERFLOW_BLOCK, OVERFLOW_DROP, OVERFLOW_OLDEST):
+            raise ValueError(f"未知的队列溢出策略: {self.config['overflow']}")
+        self.key = key or (lambda item: None)
+        # 管道所在的事件循环，供其他线程测量循环延迟
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        # 会话 -> 待处理的 (消息, 入队时间)
+        self._pending: Dict[Hashable, Deque[Tuple[Any, float]]] = {}
+        # 会话 -> 正在处理的消息数
+        self._active: Dict[Hashable, int] = {}
+        # 轮转队列：有待处理消息且未达到并发上限的会话，每个会话最多出现一次
+        self._ready: Optional[asyncio.Queue] = None
+        self._scheduled: Set[Hashable] = set()
+        # block 策略下的剩余容量
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self._accepting = False
+        # 会话 -> [处理条数, 排队总耗时, 总耗时, 最大耗时]
+        self._latency: "OrderedDict[Hashable, List[float]]" = OrderedDict()
+        # 运行指标
+        self.depth = 0
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.in_flight = 0
+
+    async def start(self):
+        """创建轮转队列并启动工作协程"""
+        self._ready = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.config['max_size'])
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.loop = asyncio.get_running_loop()
+        self._accepting = True
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"pipeline-worker-{i}")
+            for i in range(self.config['workers'])
+        ]
+        logging.info(
+            f"消息管道已启动: {self.config['workers']} 个工作协程, "
+            f"队列容量 {self.config['max_size']}, 溢出策略 {self.config['overflow']}, "
+            f"单会话并发 {self.config['conversation_concurrency']}"
+        )
+
+    @property
+    def saturated(self) -> bool:
+        """block 策略下队列已满，put 将等待空位"""
+        return self.config['overflow'] == OVERFLOW_BLOCK and self._slots is not None and self._slots.locked()
+
+    async def put(self, item) -> bool:
+        """按溢出策略入队，返回是否成功入队"""
+        if not self._accepting:
+            self.dropped += 1
+            metrics.inc('qqbot_messages_total', {'result': 'dropped'})
+            return False
+
+        overflow = self.config['overflow']
+        if overflow == OVERFLOW_BLOCK:
+            await self._slots.acquire()
+        elif self.depth >= self.config['max_size']:
+            if overflow == OVERFLOW_DROP:
+                self._record_drop("丢弃新消息")
+                return False
+            # 从积压最多的会话丢弃最旧的一条，为新消息腾出位置
+            self._drop_oldest(max(self._pending, key=lambda k: len(self._pending[k])), "丢弃最旧消息")
+
+        key = self.key(item)
+        queue = self._pending.get(key)
+        if queue is None:
+            queue = self._pending[key] = deque()
+        backlog = self.config['conversation_backlog']
+        if backlog and key is not None and len(queue) >= backlog:
+            # 单个会话积压过多时只牺牲它自己的旧消息，不占满全局队列
+            self._drop_oldest(key, f"会话 {key} 积压过多，丢弃其最旧消息")
+        queue.append((item, time.monotonic()))
+
+        self.enqueued += 1
+        self.depth += 1
+        self._idle.clear()
+        if self.depth > self.max_depth:
+            self.max_depth = self.depth
+        self._schedule(key)
+        return True
+
+    def _drop_oldest(self, key: Hashable, action: str):
+        queue = self._pending.get(key)
+        if not queue:
+            return
+        queue.popleft()
+        if not queue:
+            del self._pending[key]
+        self._take_slot()
+        self._record_drop(action)
+
+    def _take_slot(self):
+        """一条消息离开队列（被取出或丢弃）"""
+        self.depth -= 1
+        if self.config['overflow'] == OVERFLOW_BLOCK:
+            self._slots.release()
+
+    def _record_drop(self, action: str):
+        self.dropped += 1
+        metrics.inc('qqbot_messages_total', {'result': 'dropped'})
+        # 洪峰期间每 100 条只记录一次，避免日志本身成为瓶颈
+        if self.dropped % 100 == 1:
+            logging.warning(f"消息队列已满，{action}（累计丢弃 {self.dropped} 条）")
+
+    def _schedule(self, key: Hashable):
+        """会话有待处理消息且未达到并发上限时，排到轮转队列末尾"""
+        if key in self._scheduled or not self._pending.get(key):
+            return
+        if key is not None and self._active.get(key, 0) >= self.config['conversation_concurrency']:
+            return
+        self._scheduled.add(key)
+        self._ready.put_nowait(key)
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            self._scheduled.discard(key)
+            queue = self._pending.get(key)
+            if not queue:
+                # 排队期间该会话的消息已被丢弃
+                continue
+            item, enqueued_at = queue.popleft()
+            if not queue:
+                del self._pending[key]
+            self._take_slot()
+            self._active[key] = self._active.get(key, 0) + 1
+            self.in_flight += 1
+            # 并发未满时让该会话排到轮转队尾，而不是连续占用工作协程
+            self._schedule(key)
+            started = time.monotonic()
+            metrics.observe('qqbot_stage_duration_seconds', started - enqueued_at, {'stage': 'queue'})
+            try:
+                if await self.handler(item) is False:
+                    # 处理函数已记录失败原因
+                    self.failed += 1
+                    metrics.inc('qqbot_messages_total', {'result': 'failed'})
+                else:
+                    self.processed += 1
+                    metrics.inc('qqbot_messages_total', {'result': 'processed'})
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                metrics.inc('qqbot_messages_total', {'result': 'failed'})
+                logging.error(f"管道处理消息失败: {str(e)}", exc_info=True)
+            finally:
+                self.in_flight -= 1
+                active = self._active[key] - 1
+                if active:
+                    self._active[key] = active
+                else:
+                    del self._active[key]
+                self._record_latency(key, started - enqueued_at, time.monotonic() - enqueued_at)
+                self._schedule(key)
+                if not self.depth and not self.in_flight:
+                    self._idle.set()
+
+    def _record_latency(self, key: Hashable, wait: float, total: float):
+        entry = self._latency.get(key)
+        if entry is None:
+            entry = self._latency[key] = [0, 0.0, 0.0, 0.0]
+            while len(self._latency) > self.config['stats_conversations']:
+                self._latency.popitem(last=False)
+        else:
+            self._latency.move_to_end(key)
+        entry[0] += 1
+        entry[1] += wait
+        entry[2] += total
+        if total > entry[3]:
+            entry[3] = total
+
+    def conversation_stats(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """按平均耗时从高到低返回各会话的延迟统计（秒）"""
+        rows = [
+            {
+                'conversation': key,
+                'count': count,
+                'avg_wait': wait / count,
+                'avg_latency': total / count,
+                'max_latency': peak,
+                'pending': len(self._pending.get(key, ())),
+            }
+            for key, (count, wait, total, peak) in self._latency.items()
+        ]
+        rows.sort(key=lambda row: row['avg_latency'], reverse=True)
+        return rows[:limit]
+
+    async def stop(self):
+        """停止接收新消息，等待队列排空后关闭工作协程"""
+        self._accepting = False
+        if self._idle is not None and self._workers:
+            try:
+                await asyncio.wait_for(self._idle.wait(), self.config['drain_timeout'])
+            except asyncio.TimeoutError:
+                logging.warning(f"消息队列未能在限定时间内排空，剩余 {self.depth} 条")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logging.info(f"消息管道已关闭: {self.stats()}")
+
+    def stats(self) -> Dict[str, int]:
+        """返回队列深度等运行指标"""
+        return {
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'in_flight': self.in_flight,
+            'conversations': len(self._pending),
+            'enqueued': self.enqueued,
+            'processed': self.processed,
+            'failed': self.failed,
+            'dropped': self.dropped
+        }
@@ -0,0 +1,240 @@
+import asyncio
+import bisect
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# 默认延迟分桶（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# 指标说明，用于文本导出的 HELP/TYPE 行
+METRIC_HELP = {
+    'qqbot_stage_duration_seconds': ('histogram', '消息处理各阶段耗时'),
+    'qqbot_plugin_duration_seconds': ('histogram', '插件调用耗时'),
+    'qqbot_event_loop_lag_seconds': ('histogram', '事件循环调度延迟'),
+    'qqbot_messages_total': ('counter', '消息处理结果计数'),
+    'qqbot_plugin_errors_total': ('counter', '插件调用失败与超时计数'),
+    'qqbot_sends_total': ('counter', '消息发送结果计数'),
+    'qqbot_response_cache_total': ('counter', '回复缓存命中、未命中及因失效放弃写入的计数'),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class _Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个为 +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """按分桶估算分位数（取所在桶的上界）"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+class _Timer:
+    __slots__ = ('registry', 'name', 'labels', 'start')
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, labels: Labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry._observe(self.name, self.labels, time.perf_counter() - self.start)
+        return False
+
+
+class _NoopTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+def _labels(labels: Optional[Dict[str, str]]) -> Labels:
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+class MetricsRegistry:
+    """进程内指标注册表
+
+    未启用时所有记录方法立即返回，对热路径几乎没有开销。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], _Histogram] = {}
+        # 导出时读取当前值的指标：名称 -> (读取函数, 说明, 类型)
+        self.gauges: Dict[str, Tuple[Callable[[], Optional[float]], str, str]] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._lag_task: Optional[asyncio.Task] = None
+
+    def enable(self):
+        self.enabled = True
+
+    def inc(self, name: str, labels: Dict[str, str] = None, value: float = 1):
+        """计数器加 value"""
+        if not self.enabled:
+            return
+        key = (name, _labels(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: Dict[str, str] = None):
+        """向直方图记录一个观测值"""
+        if not self.enabled:
+            return
+        self._observe(name, _labels(labels), value)
+
+    def _observe(self, name: str, labels: Labels, value: float):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = _Histogram(DEFAULT_BUCKETS)
+        histogram.observe(value)
+
+    def time(self, name: str, labels: Dict[str, str] = None):
+        """计时上下文管理器：with metrics.time('...', {'stage': 'send'}): ..."""
+        if not self.enabled:
+            return _NOOP_TIMER
+        return _Timer(self, name, _labels(labels))
+
+    def register_gauge(self, name: str, fn: Callable[[], Optional[float]], help_text: str = ''):
+        """注册在导出时读取当前值的仪表（如队列深度）"""
+        self.gauges[name] = (fn, help_text, 'gauge')
+
+    def register_counter(self, name: str, fn: Callable[[], Optional[float]], help_text: str = ''):
+        """注册在导出时读取的计数器：值由其他组件自行累加（如日志线程），只增不减"""
+        self.gauges[name] = (fn, help_text, 'counter')
+
+    def render(self) -> str:
+        """按 Prometheus 文本格式导出全部指标"""
+        lines: List[str] = []
+        described = set()
+
+        def describe(name: str, kind: str, help_text: str = ''):
+            if name in described:
+                return
+            described.add(name)
+            help_text = help_text or METRIC_HELP.get(name, (kind, ''))[1]
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def fmt_labels(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+            pairs = labels + extra
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+        for (name, labels), value in sorted(self.counters.items()):
+            describe(name, 'counter')
+            lines.append(f"{name}{fmt_labels(labels)} {value}")
+
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            describe(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{fmt_labels(labels, (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{fmt_labels(labels, (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"{name}_sum{fmt_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{fmt_labels(labels)} {histogram.count}")
+
+        for name, (fn, help_text, kind) in sorted(self.gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                value = None
+            if value is None:
+                continue
+            describe(name, kind, help_text)
+            lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> List[Tuple[str, Labels, int, float, Optional[float], Optional[float]]]:
+        """各直方图的 (名称, 标签, 次数, 平均, p50, p99)，供管理命令展示"""
+        result = []
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            avg = histogram.sum / histogram.count if histogram.count else 0.0
+            result.append((name, labels, histogram.count, avg, histogram.quantile(0.5), histogram.quantile(0.99)))
+        return result
+
+    async def start(self, http_host: str = '127.0.0.1', http_port: Optional[int] = None, lag_interval: float = 0.5):
+        """启动事件循环延迟探针，http_port 不为空时同时开启本地导出端点"""
+        self.enable()
+        self._lag_task = asyncio.create_task(self._probe_loop_lag(lag_interval))
+        if http_port:
+            self._server = await asyncio.start_server(self._handle_http, http_host, http_port)
+            logging.info(f"指标导出端点已启动: http://{http_host}:{http_port}/metrics")
+
+    async def stop(self):
+        if self._lag_task:
+            self._lag_task.cancel()
+            await asyncio.gather(self._lag_task, return_exceptions=True)
+            self._lag_task = None
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _probe_loop_lag(self, interval: float):
+        loop = asyncio.get_running_loop()
+        while True:
+            scheduled = loop.time()
+            await asyncio.sleep(interval)
+            # 实际唤醒时间超出预定时间的部分即事件循环延迟
+            self.observe('qqbot_event_loop_lag_seconds', max(0.0, loop.time() - scheduled - interval))
+
+    async def _handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+# 全局指标注册表
+metrics = MetricsRegistry()
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+from utils.metrics import metrics
+
+DEFAULT_OUTBOX_CONFIG = {
+    'batch_size': 500,         # 单个事务最多写入的变更数
+    'synchronous': 'NORMAL'    # SQLite 同步级别：NORMAL 在 WAL 模式下进程崩溃不丢数据，FULL 可防断电
+}
+
+
+class OutboxRecord:
+    """发件箱中一条尚未确认送达的回复"""
+
+    __slots__ = ('id', 'route', 'url', 'body', 'priority', 'created_at')
+
+    def __init__(self, id: int, route: str, url: str, body: bytes, priority: int, created_at: float):
+        self.id = id
+        self.route = route
+        self.url = url
+        self.body = body
+        self.priority = priority
+        self.created_at = created_at
+
+
+class Outbox:
+    """持久化发件箱：回复在发送前写入 SQLite，收到 200 后删除，重启时重放未送达的回复
+
+    写入由后台任务在线程池中批量提交（组提交）：上一批写盘期间到达的记录合并到下一个事务，
+    不需要固定的攒批等待。登记回复的调用方会等到记录落盘后再发送；删除不需要等待。
+    """
+
+    def __init__(self, path: str, config: dict = None):
+        self.path = path
+        self.config = {**DEFAULT_OUTBOX_CONFIG, **(config or {})}
+        self._conn: Optional[sqlite3.Connection] = None
+        # 重放读取与后台写入可能同时在线程池中使用同一个连接
+        self._lock = threading.Lock()
+        self._next_id = 1
+        # 待写入的新记录及等待其落盘的 future
+        self._inserts: List[Tuple[tuple, asyncio.Future]] = []
+        self._deletes: List[int] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._closing = False
+        # 运行指标
+        self.recorded = 0
+        self.completed = 0
+        self.replayed = 0
+        self.expired = 0
+
+    async def open(self):
+        """打开数据库并启动后台写入任务"""
+        loop = asyncio.get_running_loop()
+        self._next_id = await loop.run_in_executor(None, self._open)
+        self._wakeup = asyncio.Event()
+        self._writer = asyncio.create_task(self._writer_loop(), name="outbox-writer")
+
+    def _open(self) -> int:
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=15, isolation_level=None)
+        conn.execute("PRAGMA journal_mode = WAL")
+        level = str(self.config['synchronous']).upper()
+        if level not in ('OFF', 'NORMAL', 'FULL'):
+            raise ValueError(f"无效的同步级别: {level}")
+        conn.execute(f"PRAGMA synchronous = {level}")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY,
+                route TEXT NOT NULL,
+                url TEXT NOT NULL,
+                body BLOB NOT NULL,
+                priority INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''')
+        self._conn = conn
+        return (conn.execute("SELECT MAX(id) FROM outbox").fetchone()[0] or 0) + 1
+
+    async def close(self):
+        """写完剩余变更并关闭数据库（未送达的记录保留到下次启动重放）"""
+        if self._writer is not None:
+            # 不直接取消写入任务，避免正在写盘的批次的等待方永远得不到结果
+            self._closing = True
+            self._wakeup.set()
+            await asyncio.gather(self._writer, return_exceptions=True)
+            self._writer = None
+        if self._conn is not None:
+            await self._flush()
+            self._conn.close()
+            self._conn = None
+            logging.info(f"发件箱已关闭: {self.stats()}")
+
+    async def record(self, route: str, url: str, body: bytes, priority: int, created_at: float = None) -> int:
+        """登记一条待发送的回复，落盘后返回记录 ID
+
+        created_at 为被动回复窗口的起点，即所回复的消息发出的时间；未知时按登记时间计算。
+        """
+        now = time.time()
+        created_at = min(created_at, now) if created_at else now
+        record_id = self._next_id
+        self._next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inserts.append(((record_id, route, url, body, priority, created_at), future))
+        self._wakeup.set()
+        started = time.perf_counter()
+        await future
+        metrics.observe('qqbot_stage_duration_seconds', time.perf_counter() - started, {'stage': 'outbox'})
+        self.recorded += 1
+        return record_id
+
+    def done(self, record_id: int):
+        """回复已送达（或确定无法送达），从发件箱移除"""
+        self._deletes.append(record_id)
+        self.completed += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def pending(self, max_age: float) -> List[OutboxRecord]:
+        """取出仍在被动回复窗口内的未送达记录，超出窗口的直接删除"""
+        rows, expired = await asyncio.get_running_loop().run_in_executor(None, self._load_pending, max_age)
+        self.expired += expired
+        self.replayed += len(rows)
+        return [OutboxRecord(*row) for row in rows]
+
+    def _load_pending(self, max_age: float) -> Tuple[list, int]:
+        cutoff = time.time() - max_age
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            expired = self._conn.execute("DELETE FROM outbox WHERE created_at < ?", (cutoff,)).rowcount
+            rows = self._conn.execute(
+                "SELECT id, route, url, body, priority, created_at FROM outbox ORDER BY id"
+            ).fetchall()
+        return rows, expired
+
+    async def _writer_loop(self):
+        while not self._closing:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            await self._flush()
+
+    async def _flush(self):
+        batch_size = self.config['batch_size']
+        # 写入失败的删除留到下次刷盘重试，否则已送达的回复会在重启后被重放
+        failed_deletes: List[int] = []
+        while self._inserts or self._deletes:
+            inserts, self._inserts = self._inserts[:batch_size], self._inserts[batch_size:]
+            deletes, self._deletes = self._deletes[:batch_size], self._deletes[batch_size:]
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._write, [row for row, _ in inserts], deletes
+                )
+            except Exception as e:
+                # 写盘失败时照常发送，只是这批回复失去了崩溃保护；
+                # 任何异常都不能结束写入任务，否则之后登记的回复会一直等待落盘
+                logging.error(f"发件箱写入失败: {e}", exc_info=not isinstance(e, sqlite3.Error))
+                failed_deletes += deletes
+            finally:
+                # 无论成败都放行等待落盘的发送方
+                for _, future in inserts:
+                    if not future.done():
+                        future.set_result(None)
+        if failed_deletes:
+            self._deletes[:0] = failed_deletes
+
+    def _write(self, inserts: List[tuple], deletes: List[int]):
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            if inserts:
+                self._conn.executemany("INSERT INTO outbox VALUES (?, ?, ?, ?, ?, ?)", inserts)
+            if deletes:
+                self._conn.executemany("DELETE FROM outbox WHERE id = ?", [(record_id,) for record_id in deletes])
+
+    def stats(self) -> dict:
+        return {
+            'recorded': self.recorded,
+            'completed': self.completed,
+            'replayed': self.replayed,
+            'expired': self.expired,
+            'backlog': len(self._inserts) + len(self._deletes)
+        }
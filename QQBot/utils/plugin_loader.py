@@ -1,34 +1,317 @@
+import ast
 import os
 import sys
+import asyncio
+import functools
+import inspect
 import importlib.util
+import itertools
 import logging
 import time
-from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock, RLock, Timer
+from typing import Callable, Dict, List, Optional, Set, Tuple
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+from utils.metrics import metrics
+from utils.plugin_workers import PluginWorkerPool
+
+# 插件未声明 TIMEOUT 时的单次调用超时（秒）
+DEFAULT_PLUGIN_TIMEOUT = 10
+# 插件未声明 MAX_CONCURRENCY 时允许的并发调用数
+DEFAULT_PLUGIN_CONCURRENCY = 8
+# 热更新防抖：同一文件的变更停止该时长后才重载（秒）
+RELOAD_DEBOUNCE = 1.0
+# 热更新时等待旧版本上正在执行的调用结束的最长时间（秒）
+RELOAD_DRAIN_TIMEOUT = 30
+
+
+class PluginTimeoutError(Exception):
+    """插件调用超出时间预算"""
+
+    def __init__(self, plugin_name: str, func_name: str, timeout: float):
+        self.plugin_name = plugin_name
+        self.func_name = func_name
+        self.timeout = timeout
+        super().__init__(f"插件 {plugin_name}.{func_name} 超时（超过 {timeout} 秒）")
+
+
+class PluginManifest:
+    """插件清单：不导入模块即可得知的声明（命令、事件、调用约束等）
+
+    从源码的模块级常量赋值中静态读取；清单中含有非字面量（如 CACHE 的 key 为函数）时
+    无法静态读取，插件会在启动时直接导入，清单改为从模块属性获取。
+    """
+
+    # 清单字段 -> (模块变量名, 默认值)
+    FIELDS = {
+        'commands': ('COMMANDS', None),
+        'catch_all': ('CATCH_ALL', False),
+        'events': ('EVENTS', None),
+        'cache': ('CACHE', None),
+        'rate_limits': ('RATE_LIMITS', None),
+        'lazy': ('LAZY', True),
+        'timeout': ('TIMEOUT', DEFAULT_PLUGIN_TIMEOUT),
+        'isolation': ('ISOLATION', None),
+        'workers': ('WORKERS', 1),
+    }
+
+    __slots__ = ('commands', 'catch_all', 'events', 'cache', 'rate_limits', 'lazy', 'timeout', 'isolation', 'workers',
+                 'functions', 'static')
+
+    def __init__(self, values: Dict[str, object], functions: Set[str], static: bool = True):
+        for field, (_, default) in self.FIELDS.items():
+            setattr(self, field, values.get(field, default))
+        self.functions = functions
+        self.static = static
+
+    @classmethod
+    def from_source(cls, path: str) -> 'PluginManifest':
+        """解析插件源码读取清单，语法错误时抛出 SyntaxError"""
+        with open(path, 'r', encoding='utf-8') as f:
+            tree = ast.parse(f.read(), filename=path)
+        names = {var: field for field, (var, _) in cls.FIELDS.items()}
+        values, functions, static = {}, set(), True
+        for node in tree.body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                functions.add(node.name)
+            elif isinstance(node, ast.Assign):
+                for target in node.targets:
+                    if not isinstance(target, ast.Name):
+                        continue
+                    functions.add(target.id)
+                    if target.id in names:
+                        try:
+                            values[names[target.id]] = ast.literal_eval(node.value)
+                        except (ValueError, TypeError, SyntaxError):
+                            static = False
+        return cls(values, functions, static)
+
+    @classmethod
+    def from_module(cls, module) -> 'PluginManifest':
+        values = {field: getattr(module, var, default) for field, (var, default) in cls.FIELDS.items()}
+        functions = {name for name in ('handle_command', 'handle_event') if hasattr(module, name)}
+        return cls(values, functions)
+
+    @property
+    def isolated(self) -> bool:
+        """声明 ISOLATION = 'process' 的插件在工作进程中运行；清单须能静态读取，否则主进程必须导入才能得知"""
+        return self.isolation == 'process' and self.static
+
+    @property
+    def handles_commands(self) -> bool:
+        return 'handle_command' in self.functions
+
+    def handles_event(self, event_type: str) -> bool:
+        """未声明 EVENTS 的插件视为订阅全部事件"""
+        if 'handle_event' not in self.functions:
+            return False
+        return self.events is None or event_type in self.events
+
+
+class PluginEntry:
+    """插件的一个版本：未导入时只有清单，导入后记录正在执行的调用数，热更新时据此排空
+
+    进程隔离的插件不在主进程导入，module 为空，由 pool 中的工作进程执行。
+    声明 BLOCKING 的插件版本各有一个线程池（executor），卸载时关闭。
+    """
+
+    __slots__ = ('name', 'filename', 'manifest', 'module', 'pool', 'executor', 'version', 'failed', 'in_flight',
+                 '_cond')
+
+    def __init__(self, name: str, filename: str, manifest: PluginManifest, module, version: int,
+                 pool: Optional[PluginWorkerPool] = None):
+        self.name = name
+        self.filename = filename
+        self.manifest = manifest
+        self.module = module
+        self.pool = pool
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.version = version
+        # 导入失败后不再重试，直到文件再次变更
+        self.failed = False
+        self.in_flight = 0
+        self._cond = Condition()
+
+    @property
+    def loaded(self) -> bool:
+        return self.module is not None or self.pool is not None
+
+    def enter(self):
+        with self._cond:
+            self.in_flight += 1
+
+    def exit(self):
+        with self._cond:
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self._cond.notify_all()
+
+    def wait_idle(self, timeout: float) -> bool:
+        """等待所有调用结束，超时返回 False"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.in_flight == 0, timeout)
+
+
+class PluginRegistry:
+    """插件注册表快照：创建后不再修改，加载/卸载插件时整体替换
+
+    分发方每次只读取一次当前快照，因此总能看到一致的插件集合和命令索引。
+    """
+
+    __slots__ = ('version', 'entries', 'modules', 'command_index', 'catch_all')
+
+    def __init__(self, version: int, entries: Dict[str, PluginEntry]):
+        self.version = version
+        self.entries = entries
+        # 已导入的插件模块
+        self.modules = {name: entry.module for name, entry in entries.items() if entry.module is not None}
+        self.command_index, self.catch_all = self._build_index()
+
+    def _build_index(self) -> Tuple[Dict[str, str], Tuple[str, ...]]:
+        """根据插件清单中的 COMMANDS / CATCH_ALL 构建分发索引"""
+        command_index = {}
+        catch_all = []
+        for module_name in sorted(self.entries):
+            manifest = self.entries[module_name].manifest
+            if not manifest.handles_commands:
+                continue
+            commands = manifest.commands
+            if commands is None:
+                # 兼容旧插件：未声明命令的插件按兜底插件处理
+                logging.warning(f"插件 {module_name} 未声明 COMMANDS，将作为兜底插件轮询")
+                catch_all.append(module_name)
+                continue
+            for command in commands:
+                key = command.lower()
+                if key in command_index:
+                    logging.warning(
+                        f"命令 {command} 冲突: {command_index[key]} 与 {module_name}，保留前者"
+                    )
+                    continue
+                command_index[key] = module_name
+            if manifest.catch_all:
+                catch_all.append(module_name)
+        return command_index, tuple(catch_all)
+
+    def event_handlers(self, event_type: str) -> List[str]:
+        """返回订阅了该事件的插件名（包括尚未导入的插件）"""
+        return [name for name in sorted(self.entries) if self.entries[name].manifest.handles_event(event_type)]
+
 
 class PluginManager:
     def __init__(self):
-        self.plugins = {}
-        self.lock = Lock()
+        # 当前生效的注册表快照，只在持有 lock 时整体替换
+        self.registry = PluginRegistry(0, {})
+        self._versions = itertools.count(1)
+        self.lock = RLock()
+        # 每个插件的并发限制，首次调用时按插件声明创建
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        # 插件版本被替换或卸载后的回调（如清理该插件的回复缓存）
+        self._swap_listeners: List[Callable[[str], None]] = []
+        # 分发所在的事件循环，切换回调投递到该循环中执行
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
         self.observer = Observer()
+        self.watcher = None
         self.plugin_dir = "plugins"
         self._init_plugins()
         self._start_watching()
 
+    @property
+    def plugins(self) -> Dict[str, object]:
+        """当前生效的插件模块"""
+        return self.registry.modules
+
+    @property
+    def command_index(self) -> Dict[str, str]:
+        return self.registry.command_index
+
+    @property
+    def catch_all(self) -> Tuple[str, ...]:
+        return self.registry.catch_all
+
+    def event_handlers(self, event_type: str) -> List[str]:
+        """返回应处理该事件的插件名"""
+        return self.registry.event_handlers(event_type)
+
+    def add_swap_listener(self, callback: Callable[[str], None]):
+        """注册插件被替换或卸载时的回调，参数为插件名；事件循环运行中时回调在循环线程执行"""
+        self._swap_listeners.append(callback)
+
+    def _notify_swap(self, module_name: str):
+        for callback in self._swap_listeners:
+            if self.loop is not None and self.loop.is_running():
+                try:
+                    self.loop.call_soon_threadsafe(self._run_swap_listener, callback, module_name)
+                    continue
+                except RuntimeError:
+                    pass  # 事件循环已关闭，直接执行
+            self._run_swap_listener(callback, module_name)
+
+    @staticmethod
+    def _run_swap_listener(callback: Callable[[str], None], module_name: str):
+        try:
+            callback(module_name)
+        except Exception as e:
+            logging.error(f"插件切换回调失败 {module_name}: {str(e)}")
+
     def _init_plugins(self):
-        """初始化加载所有插件"""
+        """读取所有插件清单并发布注册表，只预先导入声明 LAZY = False 或清单无法静态读取的插件"""
+        started = time.perf_counter()
+        entries = {}
+        for filename in sorted(os.listdir(self.plugin_dir)):
+            if filename.endswith(".py") and filename != "__init__.py":
+                entry = self._read_manifest(filename)
+                if entry is None:
+                    continue
+                if not entry.manifest.lazy or not entry.manifest.static:
+                    entry = self._materialize(entry)
+                    if entry is None:
+                        continue
+                entries[entry.name] = entry
         with self.lock:
-            for filename in os.listdir(self.plugin_dir):
-                if filename.endswith(".py") and filename != "__init__.py":
-                    self._load_plugin(filename)
+            self.registry = PluginRegistry(next(self._versions), entries)
+        loaded = [name for name, entry in entries.items() if entry.loaded]
+        logging.info(
+            f"✅ 插件注册完成: 共 {len(entries)} 个，预加载 {len(loaded)} 个"
+            f"（{', '.join(loaded) or '无'}），其余按需加载，耗时 {(time.perf_counter() - started) * 1000:.1f}ms"
+        )
+
+    def _read_manifest(self, filename: str) -> Optional[PluginEntry]:
+        """只解析源码得到未导入的插件条目；失败返回 None"""
+        try:
+            manifest = PluginManifest.from_source(os.path.join(self.plugin_dir, filename))
+        except (OSError, SyntaxError, ValueError) as e:
+            logging.error(f"❌ 读取插件清单失败 {filename}: {str(e)}")
+            return None
+        return PluginEntry(filename[:-3], filename, manifest, None, next(self._versions))
 
-    def _load_plugin(self, filename: str):
-        """加载单个插件"""
+    def _materialize(self, entry: PluginEntry) -> Optional[PluginEntry]:
+        """导入插件；声明进程隔离的插件改为拉起工作进程，主进程不导入其模块"""
+        if entry.manifest.isolated:
+            return self._spawn_plugin(entry)
+        if entry.manifest.isolation == 'process':
+            logging.warning(f"插件 {entry.name} 的清单无法静态读取，不能进程隔离，改为在主进程中运行")
+        return self._import_plugin(entry.filename)
+
+    def _spawn_plugin(self, entry: PluginEntry) -> Optional[PluginEntry]:
+        """拉起插件的工作进程池，不影响当前生效的版本；失败返回 None"""
+        pool = PluginWorkerPool(entry.name, os.path.join(self.plugin_dir, entry.filename), entry.manifest.workers)
+        try:
+            pool.start()
+        except Exception as e:
+            logging.error(f"❌ 加载插件失败 {entry.filename}: {str(e)}")
+            return None
+        return PluginEntry(entry.name, entry.filename, entry.manifest, None, next(self._versions), pool=pool)
+
+    def _import_plugin(self, filename: str) -> Optional[PluginEntry]:
+        """编译、执行并初始化插件模块，不影响当前生效的版本；失败返回 None"""
         module_name = filename[:-3]
+        previous = sys.modules.get(module_name)
+        started = time.perf_counter()
         try:
             spec = importlib.util.spec_from_file_location(
-                module_name, 
+                module_name,
                 os.path.join(self.plugin_dir, filename)
             )
             module = importlib.util.module_from_spec(spec)
@@ -37,67 +320,286 @@ class PluginManager:
 
             # 初始化插件
             if hasattr(module, "on_load"):
-                try:
-                    module.on_load()
-                except Exception as e:
-                    logging.error(f"插件初始化失败 {module_name}: {str(e)}")
-
-            self.plugins[module_name] = module
-            logging.info(f"✅ 成功加载插件: {module_name}")
+                module.on_load()
+            logging.info(f"✅ 成功加载插件: {module_name}，耗时 {(time.perf_counter() - started) * 1000:.1f}ms")
+            return PluginEntry(module_name, filename, PluginManifest.from_module(module), module, next(self._versions))
 
         except Exception as e:
+            # 新版本加载失败时恢复旧模块引用，旧版本继续提供服务
+            if previous is not None:
+                sys.modules[module_name] = previous
+            else:
+                sys.modules.pop(module_name, None)
             logging.error(f"❌ 加载插件失败 {filename}: {str(e)}", exc_info=True)
+            return None
+
+    def _activate(self, module_name: str) -> Optional[PluginEntry]:
+        """首次使用时导入插件（在线程池中执行，不阻塞事件循环），返回已导入的条目"""
+        with self.lock:
+            entry = self.registry.entries.get(module_name)
+            if entry is None or entry.loaded or entry.failed:
+                return entry
+            loaded = self._materialize(entry)
+            if loaded is None:
+                entry.failed = True
+                return entry
+            self.registry = PluginRegistry(
+                next(self._versions), {**self.registry.entries, module_name: loaded}
+            )
+            return loaded
+
+    def _load_plugin(self, filename: str) -> bool:
+        """加载或重新加载单个插件：新版本初始化成功后才替换旧版本，返回是否成功
+
+        插件尚未被使用过时只更新清单，仍然等到首次使用再导入。
+        """
+        module_name = filename[:-3]
+        current = self.registry.entries.get(module_name)
+        entry = self._read_manifest(filename)
+        if entry is None:
+            return False
+        if (current is not None and current.loaded) or not entry.manifest.lazy or not entry.manifest.static:
+            entry = self._materialize(entry)
+            if entry is None:
+                return False
+        with self.lock:
+            old = self.registry.entries.get(module_name)
+            self.registry = PluginRegistry(
+                next(self._versions), {**self.registry.entries, module_name: entry}
+            )
+            self._semaphores.pop(module_name, None)
+        logging.info(f"✅ 成功注册插件: {module_name} (v{entry.version})")
+        if old is not None:
+            self._notify_swap(module_name)
+            self._retire(old)
+        return True
 
-    def _unload_plugin(self, module_name: str):
+    def _unload_plugin(self, module_name: str, drain_timeout: float = RELOAD_DRAIN_TIMEOUT):
         """卸载单个插件"""
         with self.lock:
-            if module_name in self.plugins:
-                try:
-                    # 执行卸载回调
-                    if hasattr(self.plugins[module_name], "on_unload"):
-                        self.plugins[module_name].on_unload()
+            old = self.registry.entries.get(module_name)
+            if old is None:
+                return
+            entries = dict(self.registry.entries)
+            del entries[module_name]
+            self.registry = PluginRegistry(next(self._versions), entries)
+            self._semaphores.pop(module_name, None)
+            # 清理模块引用
+            if old.module is not None and sys.modules.get(module_name) is old.module:
+                del sys.modules[module_name]
+        self._notify_swap(module_name)
+        self._retire(old, drain_timeout)
+
+    def _retire(self, entry: PluginEntry, drain_timeout: float = RELOAD_DRAIN_TIMEOUT):
+        """等待已下线版本上的调用结束，再执行其卸载回调"""
+        if not entry.loaded:
+            return  # 从未导入，无需卸载
+        if not entry.wait_idle(drain_timeout):
+            logging.warning(
+                f"插件 {entry.name} v{entry.version} 仍有 {entry.in_flight} 个调用未结束，强制卸载"
+            )
+        if entry.executor is not None:
+            # 超时仍未结束的线程继续运行至结束，但不再接收新调用
+            entry.executor.shutdown(wait=False)
+        if entry.pool is not None:
+            # 工作进程各自执行 on_unload 后退出
+            entry.pool.stop()
+            logging.info(f"♻️ 成功卸载插件: {entry.name} (v{entry.version})")
+            return
+        try:
+            # 执行卸载回调
+            if hasattr(entry.module, "on_unload"):
+                entry.module.on_unload()
+            logging.info(f"♻️ 成功卸载插件: {entry.name} (v{entry.version})")
+        except Exception as e:
+            logging.error(f"❌ 卸载插件失败 {entry.name}: {str(e)}")
+
+    def resolve(self, command: str) -> Tuple[str, ...]:
+        """返回应处理该命令的插件名：命中索引时只有一个，否则为兜底插件"""
+        registry = self.registry
+        plugin_name = registry.command_index.get(command.lower())
+        if plugin_name is not None:
+            return (plugin_name,)
+        return registry.catch_all
+
+    def cache_policy(self, module_name: str, command: str) -> Optional[Dict]:
+        """返回插件为该命令声明的缓存策略（CACHE 清单），未声明返回 None"""
+        entry = self.registry.entries.get(module_name)
+        cache = entry.manifest.cache if entry else None
+        if not cache:
+            return None
+        return cache.get(command) or cache.get(command.lower())
 
-                    # 清理模块引用
-                    if module_name in sys.modules:
-                        del sys.modules[module_name]
-                    del self.plugins[module_name]
-                    logging.info(f"♻️ 成功卸载插件: {module_name}")
+    def rate_limit_policy(self, module_name: str, command: str) -> Optional[Dict]:
+        """返回插件为该命令声明的入站限额（RATE_LIMITS 清单），未声明返回 None"""
+        entry = self.registry.entries.get(module_name)
+        limits = entry.manifest.rate_limits if entry else None
+        if not limits:
+            return None
+        return limits.get(command) or limits.get(command.lower())
 
-                except Exception as e:
-                    logging.error(f"❌ 卸载插件失败 {module_name}: {str(e)}")
+    def _get_semaphore(self, module_name: str, module) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(module_name)
+        if semaphore is None:
+            limit = getattr(module, "MAX_CONCURRENCY", DEFAULT_PLUGIN_CONCURRENCY)
+            semaphore = self._semaphores[module_name] = asyncio.Semaphore(limit)
+        return semaphore
+
+    @staticmethod
+    def _get_executor(entry: PluginEntry) -> ThreadPoolExecutor:
+        """声明 BLOCKING 的插件各用一个线程池，大小与其并发上限相同，卡死的插件只会占满自己的线程"""
+        if entry.executor is None:
+            limit = getattr(entry.module, "MAX_CONCURRENCY", DEFAULT_PLUGIN_CONCURRENCY)
+            entry.executor = ThreadPoolExecutor(max_workers=limit, thread_name_prefix=f"plugin-{entry.name}")
+        return entry.executor
+
+    async def invoke(self, module_name: str, func_name: str, *args, **kwargs):
+        """在并发限制和超时预算内调用插件函数
+
+        - 协程函数直接在事件循环中等待
+        - 声明 BLOCKING = True 的同步函数放入该插件专用的线程池执行
+        - 其余同步函数视为轻量函数，直接调用
+        - 声明 ISOLATION = 'process' 的插件交给其工作进程池执行
+        超时抛出 PluginTimeoutError，插件不存在或未实现该函数时返回 None。
+        调用所用的插件版本在调用结束前不会执行 on_unload。
+        """
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        entry = self.registry.entries.get(module_name)
+        if entry is None or func_name not in entry.manifest.functions:
+            return None
+        if not entry.loaded:
+            # 首次使用，在默认线程池中导入，避免阻塞事件循环
+            entry = await self.loop.run_in_executor(None, self._activate, module_name)
+            if entry is None or not entry.loaded:
+                return None
+        if entry.pool is not None:
+            # 并发数即工作进程数；超时被放弃的调用所在进程会被终止并重启
+            timeout = entry.manifest.timeout
+            return await self._timed_call(entry, func_name, timeout, entry.pool.call(func_name, args, kwargs))
+
+        module = entry.module
+        func = getattr(module, func_name, None)
+        if func is None:
+            return None
+
+        timeout = getattr(module, "TIMEOUT", DEFAULT_PLUGIN_TIMEOUT)
+        semaphore = self._get_semaphore(module_name, module)
+
+        async def _call():
+            if getattr(module, "BLOCKING", False) and not inspect.iscoroutinefunction(func):
+                return await _call_blocking()
+            async with semaphore:
+                if inspect.iscoroutinefunction(func):
+                    return await func(*args, **kwargs)
+                return func(*args, **kwargs)
+
+        async def _call_blocking():
+            # 超时只放弃等待，线程仍在执行：并发名额和版本的忙碌计数都要到线程结束时才释放，
+            # 否则卡死的调用会不断占用新线程
+            await semaphore.acquire()
+            try:
+                future = self.loop.run_in_executor(
+                    self._get_executor(entry), functools.partial(func, *args, **kwargs)
+                )
+            except BaseException:
+                semaphore.release()
+                raise
+            entry.enter()
+
+            def _release(_):
+                semaphore.release()
+                entry.exit()
+
+            future.add_done_callback(_release)
+            # shield：超时取消的是等待方，不能让线程的 future 提前变为已完成
+            return await asyncio.shield(future)
+
+        return await self._timed_call(entry, func_name, timeout, _call())
+
+    async def _timed_call(self, entry: PluginEntry, func_name: str, timeout: float, call):
+        """在超时预算内等待一次插件调用，记录耗时和错误，调用期间该版本计为忙碌"""
+        labels = {'plugin': entry.name, 'func': func_name}
+        entry.enter()
+        try:
+            with metrics.time('qqbot_plugin_duration_seconds', labels):
+                return await asyncio.wait_for(call, timeout)
+        except asyncio.TimeoutError:
+            metrics.inc('qqbot_plugin_errors_total', {**labels, 'reason': 'timeout'})
+            # 线程池中的阻塞调用无法被中断，只能放弃等待其结果
+            raise PluginTimeoutError(entry.name, func_name, timeout) from None
+        except Exception:
+            metrics.inc('qqbot_plugin_errors_total', {**labels, 'reason': 'error'})
+            raise
+        finally:
+            entry.exit()
 
     class PluginWatcher(FileSystemEventHandler):
-        """文件系统监视器"""
+        """文件系统监视器：按文件防抖，同一文件的变更停止 RELOAD_DEBOUNCE 秒后才重载"""
         def __init__(self, manager):
             self.manager = manager
-            self.last_modified = 0  # 防抖处理
+            self._timers: Dict[str, Timer] = {}
+            self._lock = Lock()
 
         def on_modified(self, event):
-            if not event.is_directory and event.src_path.endswith(".py"):
-                current_time = time.time()
-                if current_time - self.last_modified > 1:  # 1秒防抖
-                    self.last_modified = current_time
-                    self._handle_plugin_change(event)
-
-        def _handle_plugin_change(self, event):
-            filename = os.path.basename(event.src_path)
-            if filename == "__init__.py":
+            if not event.is_directory:
+                self._schedule(event.src_path)
+
+        def on_created(self, event):
+            if not event.is_directory:
+                self._schedule(event.src_path)
+
+        def on_moved(self, event):
+            # 部分编辑器以“写临时文件再改名”的方式保存
+            if not event.is_directory:
+                self._schedule(event.dest_path)
+
+        def on_deleted(self, event):
+            if not event.is_directory:
+                self._schedule(event.src_path)
+
+        def _schedule(self, path: str):
+            filename = os.path.basename(path)
+            if not filename.endswith(".py") or filename == "__init__.py":
                 return
+            with self._lock:
+                timer = self._timers.get(filename)
+                if timer is not None:
+                    timer.cancel()
+                timer = self._timers[filename] = Timer(
+                    RELOAD_DEBOUNCE, self._handle_plugin_change, (filename,)
+                )
+                timer.daemon = True
+                timer.start()
 
+        def _handle_plugin_change(self, filename: str):
+            with self._lock:
+                self._timers.pop(filename, None)
             module_name = filename[:-3]
             logging.info(f"🔄 检测到插件变更: {filename}")
-            
+
             try:
-                self.manager._unload_plugin(module_name)
-                self.manager._load_plugin(filename)
-                logging.info(f"🔄 成功热更新插件: {module_name}")
+                if not os.path.exists(os.path.join(self.manager.plugin_dir, filename)):
+                    self.manager._unload_plugin(module_name)
+                elif self.manager._load_plugin(filename):
+                    logging.info(f"🔄 成功热更新插件: {module_name}")
+                else:
+                    logging.error(f"热更新失败，继续使用旧版本: {module_name}")
             except Exception as e:
                 logging.error(f"热更新失败: {str(e)}", exc_info=True)
 
+        def cancel(self):
+            """取消尚未触发的重载"""
+            with self._lock:
+                for timer in self._timers.values():
+                    timer.cancel()
+                self._timers.clear()
+
     def _start_watching(self):
         """启动文件监视"""
+        self.watcher = self.PluginWatcher(self)
         self.observer.schedule(
-            self.PluginWatcher(self),
+            self.watcher,
             self.plugin_dir,
             recursive=False
         )
@@ -107,8 +609,31 @@ class PluginManager:
         """关闭插件系统"""
         self.observer.stop()
         self.observer.join()
-        for module_name in list(self.plugins.keys()):
-            self._unload_plugin(module_name)
+        if self.watcher is not None:
+            self.watcher.cancel()
+        loaded = [name for name, entry in self.registry.entries.items() if entry.loaded]
+        for module_name in loaded:
+            # 事件循环已退出，不再有新调用，只为线程池中的调用留少量时间
+            self._unload_plugin(module_name, drain_timeout=5)
+
+def split_command(content: str) -> Tuple[str, List[str]]:
+    """将消息拆分为命令和参数，只解析一次供所有插件复用"""
+    parts = content.split()
+    if not parts:
+        return "", []
+    return parts[0], parts[1:]
+
+# 进程内唯一的插件管理器，main.py 与消息处理共用同一个实例
+_plugin_manager: Optional[PluginManager] = None
+_plugin_manager_lock = Lock()
+
+def get_plugin_manager() -> PluginManager:
+    """返回进程内共享的插件管理器，首次调用时创建"""
+    global _plugin_manager
+    with _plugin_manager_lock:
+        if _plugin_manager is None:
+            _plugin_manager = PluginManager()
+        return _plugin_manager
 
 def load_plugins():
-    return PluginManager().plugins
+    return get_plugin_manager().plugins
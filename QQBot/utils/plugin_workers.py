@@ -0,0 +1,289 @@
+import asyncio
+import importlib.util
+import inspect
+import logging
+import multiprocessing
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Dict, List, Optional, Set
+from utils import codec
+from utils.metrics import metrics
+
+# 工作进程导入插件并完成 on_load 的最长等待时间（秒）
+WORKER_START_TIMEOUT = 30
+# 关闭时等待工作进程执行 on_unload 并退出的时间（秒）
+WORKER_STOP_TIMEOUT = 5
+# 工作进程重启失败后的退避上限（秒）
+WORKER_RESTART_MAX_DELAY = 30
+
+# 与分片进程一致使用 spawn：子进程不继承父进程的事件循环和线程
+_context = multiprocessing.get_context('spawn')
+
+
+class PluginWorkerError(Exception):
+    """插件工作进程启动失败、异常退出，或插件在工作进程中抛出了异常"""
+
+
+def _worker_main(conn, module_name: str, path: str):
+    """工作进程入口：导入插件后循环处理请求，收到空消息时执行 on_unload 并退出"""
+    # 中断信号由主进程统一处理，工作进程随后按正常流程关闭
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s [%(processName)s] %(name)s - %(levelname)s - %(message)s'
+    )
+    try:
+        spec = importlib.util.spec_from_file_location(module_name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+        if hasattr(module, "on_load"):
+            module.on_load()
+    except BaseException as e:
+        conn.send_bytes(codec.dumps({'ok': False, 'error': f"{type(e).__name__}: {e}"}))
+        return
+    conn.send_bytes(codec.dumps({'ok': True}))
+
+    loop = None
+    while True:
+        try:
+            data = conn.recv_bytes()
+        except (EOFError, OSError):
+            break  # 主进程已退出
+        if not data:
+            break
+        request = codec.loads(data)
+        try:
+            result = getattr(module, request['func'])(*request['args'], **request['kwargs'])
+            if inspect.isawaitable(result):
+                if loop is None:
+                    loop = asyncio.new_event_loop()
+                result = loop.run_until_complete(result)
+            response = {'ok': True, 'result': result}
+        except Exception as e:
+            logging.error(f"插件 {module_name}.{request['func']} 执行失败: {e}", exc_info=True)
+            response = {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+        try:
+            payload = codec.dumps(response)
+        except (TypeError, ValueError) as e:
+            payload = codec.dumps({'ok': False, 'error': f"返回值无法序列化: {e}"})
+        conn.send_bytes(payload)
+
+    if hasattr(module, "on_unload"):
+        try:
+            module.on_unload()
+        except Exception as e:
+            logging.error(f"插件 {module_name} 卸载失败: {e}")
+
+
+class _Worker:
+    """一个常驻的插件工作进程及与其通信的管道"""
+
+    __slots__ = ('process', 'conn', 'calls')
+
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.calls = 0
+
+
+class PluginWorkerPool:
+    """在独立进程中运行插件：CPU 密集的插件不占用主进程的事件循环和 GIL，崩溃也不会拖垮机器人
+
+    每个工作进程常驻并复用，同一时间只处理一个请求；请求和结果以 JSON 字节经管道传递，
+    因此插件函数的参数和返回值需要可以 JSON 序列化。工作进程异常退出或调用超时被放弃时，
+    该进程会被终止并在后台重新拉起。
+    """
+
+    def __init__(self, name: str, path: str, size: int = 1):
+        self.name = name
+        self.path = path
+        self.size = max(1, int(size))
+        self._workers: Set[_Worker] = set()
+        self._lock = Lock()
+        # 空闲的工作进程，首次调用时在事件循环中创建
+        self._idle: Optional[asyncio.Queue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # 每个工作进程一个线程负责阻塞的管道读写
+        self._io = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix=f"{name}-io")
+        self._closed = False
+        # 运行指标
+        self.calls = 0
+        self.errors = 0
+        self.restarts = 0
+
+    def start(self):
+        """拉起全部工作进程并等待插件初始化完成（阻塞，应在线程池中调用）"""
+        started = time.perf_counter()
+        try:
+            for _ in range(self.size):
+                worker = self._spawn()
+                with self._lock:
+                    self._workers.add(worker)
+        except Exception:
+            self.stop()
+            raise
+        logging.info(
+            f"✅ 插件 {self.name} 已在 {self.size} 个工作进程中加载，"
+            f"耗时 {(time.perf_counter() - started) * 1000:.1f}ms"
+        )
+
+    def _spawn(self) -> _Worker:
+        parent_conn, child_conn = _context.Pipe()
+        process = _context.Process(
+            target=_worker_main,
+            args=(child_conn, self.name, self.path),
+            name=f"plugin-{self.name}",
+            daemon=True
+        )
+        process.start()
+        child_conn.close()
+        try:
+            if not parent_conn.poll(WORKER_START_TIMEOUT):
+                raise PluginWorkerError(f"插件 {self.name} 工作进程启动超时")
+            ready = codec.loads(parent_conn.recv_bytes())
+            if not ready['ok']:
+                raise PluginWorkerError(f"插件 {self.name} 工作进程加载失败: {ready['error']}")
+        except (EOFError, OSError):
+            self._kill(_Worker(process, parent_conn))
+            raise PluginWorkerError(f"插件 {self.name} 工作进程在初始化时退出 (exitcode={process.exitcode})") from None
+        except Exception:
+            self._kill(_Worker(process, parent_conn))
+            raise
+        return _Worker(process, parent_conn)
+
+    async def call(self, func_name: str, args: tuple, kwargs: Dict[str, Any]) -> Any:
+        """在空闲的工作进程中执行插件函数并返回结果"""
+        if self._idle is None:
+            self._loop = asyncio.get_running_loop()
+            self._idle = asyncio.Queue()
+            with self._lock:
+                for worker in self._workers:
+                    self._idle.put_nowait(worker)
+        request = codec.dumps({'func': func_name, 'args': list(args), 'kwargs': kwargs})
+
+        while True:
+            worker = await self._idle.get()
+            if worker.process.is_alive():
+                break
+            # 空闲期间退出的进程，换一个并在后台重启
+            logging.warning(f"插件 {self.name} 工作进程 (pid={worker.process.pid}) 已退出，正在重启")
+            self._respawn(worker)
+
+        healthy = False
+        try:
+            data = await self._loop.run_in_executor(self._io, self._roundtrip, worker, request)
+            healthy = True
+        except (EOFError, OSError) as e:
+            self.errors += 1
+            raise PluginWorkerError(
+                f"插件 {self.name} 工作进程 (pid={worker.process.pid}) 异常退出 "
+                f"(exitcode={worker.process.exitcode}): {str(e) or type(e).__name__}"
+            ) from None
+        finally:
+            self.calls += 1
+            worker.calls += 1
+            if healthy:
+                self._idle.put_nowait(worker)
+            else:
+                # 进程已崩溃，或调用被放弃（超时）后进程仍在执行旧请求，都需要换一个新进程
+                self._respawn(worker)
+
+        response = codec.loads(data)
+        if not response['ok']:
+            self.errors += 1
+            raise PluginWorkerError(response['error'])
+        return response['result']
+
+    @staticmethod
+    def _roundtrip(worker: _Worker, request: bytes) -> bytes:
+        try:
+            worker.conn.send_bytes(request)
+            return worker.conn.recv_bytes()
+        except (EOFError, OSError):
+            # 管道断开说明进程已退出，稍等回收以便报告退出码
+            worker.process.join(1)
+            raise
+
+    def _respawn(self, worker: _Worker):
+        self.restarts += 1
+        metrics.inc('qqbot_plugin_worker_restarts_total', {'plugin': self.name})
+        with self._lock:
+            self._workers.discard(worker)
+        # 先终止旧进程，阻塞在管道读取上的线程随之返回
+        if worker.process.is_alive():
+            worker.process.kill()
+        self._loop.run_in_executor(None, self._replace, worker)
+
+    def _replace(self, worker: _Worker):
+        """回收旧进程并拉起新进程，失败时退避重试，直到成功或进程池关闭"""
+        self._kill(worker)
+        delay = 1
+        while not self._closed:
+            try:
+                replacement = self._spawn()
+            except Exception as e:
+                logging.error(f"插件 {self.name} 工作进程重启失败，{delay} 秒后重试: {e}")
+                time.sleep(delay)
+                delay = min(WORKER_RESTART_MAX_DELAY, delay * 2)
+                continue
+            with self._lock:
+                closed = self._closed
+                if not closed:
+                    self._workers.add(replacement)
+            if closed:
+                # 重启期间进程池已关闭
+                self._stop_worker(replacement)
+                return
+            logging.info(f"♻️ 插件 {self.name} 工作进程已重启 (pid={replacement.process.pid})")
+            try:
+                self._loop.call_soon_threadsafe(self._idle.put_nowait, replacement)
+            except RuntimeError:
+                pass  # 事件循环已关闭
+            return
+
+    @staticmethod
+    def _kill(worker: _Worker):
+        if worker.process.is_alive():
+            worker.process.kill()
+        worker.process.join(1)
+        try:
+            worker.conn.close()
+        except OSError:
+            pass
+
+    @staticmethod
+    def _stop_worker(worker: _Worker):
+        """通知工作进程执行 on_unload 后退出，超时未退出则强制终止"""
+        try:
+            worker.conn.send_bytes(b'')
+        except (OSError, ValueError):
+            pass
+        worker.process.join(WORKER_STOP_TIMEOUT)
+        if worker.process.is_alive():
+            logging.warning(f"工作进程 {worker.process.name} (pid={worker.process.pid}) 未能按时退出，强制终止")
+        PluginWorkerPool._kill(worker)
+
+    def stop(self):
+        """关闭全部工作进程（阻塞）"""
+        with self._lock:
+            self._closed = True
+            workers: List[_Worker] = list(self._workers)
+            self._workers.clear()
+        for worker in workers:
+            self._stop_worker(worker)
+        self._io.shutdown(wait=False)
+        if workers:
+            logging.info(f"插件 {self.name} 的 {len(workers)} 个工作进程已关闭: {self.stats()}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'workers': len(self._workers),
+            'idle': self._idle.qsize() if self._idle is not None else len(self._workers),
+            'calls': self.calls,
+            'errors': self.errors,
+            'restarts': self.restarts
+        }
@@ -0,0 +1,85 @@
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+
+class TokenBucket:
+    """令牌桶：以 rate 个/秒的速度补充，最多积攒 capacity 个"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated_at = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """尝试取出令牌，成功返回 True"""
+        self._refill(time.monotonic())
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def time_until_available(self, tokens: float = 1) -> float:
+        """距离可取出指定数量令牌还需等待的秒数"""
+        now = time.monotonic()
+        if self.updated_at > now:
+            # 处于限流暂停期
+            return self.updated_at - now + tokens / self.rate
+        self._refill(now)
+        if self.tokens >= tokens:
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    def pause(self, seconds: float):
+        """清空令牌并在 seconds 秒内不再补充（用于服务端返回限流时）"""
+        self.tokens = 0
+        self.updated_at = max(self.updated_at, time.monotonic() + seconds)
+
+    def is_idle(self, now: float) -> bool:
+        """令牌已补满，说明该桶近期没有被使用，可以安全回收"""
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class BucketRegistry:
+    """按键（群、用户等）管理令牌桶，超过上限或长时间空闲的桶会被回收"""
+
+    def __init__(self, rate: float, capacity: float, max_keys: int = 10000, idle_seconds: float = 300):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self.idle_seconds = idle_seconds
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+        self._last_sweep = time.monotonic()
+
+    def get(self, key: Hashable) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+            self._evict()
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def _evict(self):
+        now = time.monotonic()
+        # 超过容量时淘汰最久未使用的桶
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        # 定期清理空闲的桶
+        if now - self._last_sweep >= self.idle_seconds:
+            self._last_sweep = now
+            for key in [k for k, b in self._buckets.items() if b.is_idle(now)]:
+                del self._buckets[key]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
@@ -0,0 +1,95 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Set, Tuple
+from utils.metrics import metrics
+
+# 未命中时 get 返回的哨兵值（插件回复本身可能为 None 或空字符串）
+MISS = object()
+
+
+class ResponseCache:
+    """带 TTL 和容量上限的 LRU 回复缓存
+
+    每个条目带一个标签（插件名），插件收到事件时可按标签整体失效。
+    每次失效都会推进该标签的代数：调用插件前记下代数，写入时代数已变说明回复
+    是按失效前的数据算出的，不再写入，避免在整个 TTL 内返回旧数据。
+    """
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        # key -> (过期时间, 回复内容, 标签)
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any, str]]" = OrderedDict()
+        self._tags: Dict[str, Set[Hashable]] = {}
+        # 标签 -> 失效次数
+        self._generations: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable):
+        """命中返回缓存的回复，未命中或已过期返回 MISS"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            metrics.inc('qqbot_response_cache_total', {'result': 'miss'})
+            return MISS
+        self._entries.move_to_end(key)
+        self.hits += 1
+        metrics.inc('qqbot_response_cache_total', {'result': 'hit'})
+        return entry[1]
+
+    def generation(self, tag: str) -> int:
+        """标签当前的代数，在计算要缓存的回复之前读取"""
+        return self._generations.get(tag, 0)
+
+    def set(self, key: Hashable, value: Any, ttl: float, tag: str, generation: Optional[int] = None) -> bool:
+        """写入回复，返回是否写入；传入的代数已过期（期间发生过失效）时丢弃"""
+        if generation is not None and generation != self._generations.get(tag, 0):
+            metrics.inc('qqbot_response_cache_total', {'result': 'stale'})
+            return False
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, value, tag)
+        self._tags.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+        return True
+
+    def invalidate(self, tag: str) -> int:
+        """使某个标签下的全部条目失效，返回失效条数"""
+        self._generations[tag] = self._generations.get(tag, 0) + 1
+        keys = self._tags.pop(tag, set())
+        for key in keys:
+            self._entries.pop(key, None)
+        self.invalidations += len(keys)
+        return len(keys)
+
+    def clear(self):
+        for tag in set(self._tags) | set(self._generations):
+            self._generations[tag] = self._generations.get(tag, 0) + 1
+        self._entries.clear()
+        self._tags.clear()
+
+    def _remove(self, key: Hashable):
+        _, _, tag = self._entries.pop(key)
+        keys = self._tags.get(tag)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else None,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
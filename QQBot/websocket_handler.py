@@ -1,49 +1,319 @@
 import asyncio
+import random
 import websockets
-import json
 import logging
-from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
 from message_processor import process_message, handle_event
-from fetch_access_token import fetch_access_token
+from fetch_access_token import fetch_access_token, token_manager
+from utils.message_pipeline import MessagePipeline
+from utils.dedup import DedupIndex
+from utils.metrics import metrics
+from utils.codec import as_frame, decode_frame, dumps_str
 
 logging.getLogger().setLevel(logging.INFO)
-executor = ThreadPoolExecutor(max_workers=10)
 
-async def websocket_listener(uri):
-    logging.info(f"Connecting to WebSocket server at {uri}...")
-    async with websockets.connect(uri) as websocket:
-        logging.info("Connected to WebSocket server.")
-        while True:
+# 网关操作码
+OP_DISPATCH = 0
+OP_HEARTBEAT = 1
+OP_IDENTIFY = 2
+OP_RESUME = 6
+OP_RECONNECT = 7
+OP_INVALID_SESSION = 9
+OP_HELLO = 10
+OP_HEARTBEAT_ACK = 11
+
+# 无法恢复的关闭码（如机器人被封禁），收到后停止重连
+FATAL_CLOSE_CODES = {4914, 4915}
+# 会话已失效的关闭码，重连后需要重新鉴权而不是恢复会话
+SESSION_INVALID_CLOSE_CODES = {4006, 4007, 4009} | set(range(4900, 4914))
+# access_token 无效
+INVALID_TOKEN_CLOSE_CODE = 4004
+
+DEFAULT_GATEWAY_CONFIG = {
+    'intents': 1 << 25,         # GROUP_AND_C2C_EVENT
+    'shard': [0, 1],
+    'backoff_base': 1,          # 重连退避基数（秒）
+    'backoff_max': 60,          # 重连退避上限（秒）
+}
+
+# 当前运行中的消息管道（供状态查询使用）
+pipeline: Optional[MessagePipeline] = None
+# 入站事件去重索引（断线重连后网关可能重投已处理过的事件）
+dedup: Optional[DedupIndex] = None
+
+
+class GatewayClient:
+    """网关会话客户端：处理 Hello/心跳/鉴权/恢复，断线后按抖动指数退避自动重连
+
+    连接地址可指向本地的 websocket 替身服务，便于脱离真实网关测试。
+    对于不发送 Hello 的 webhook 转发服务，客户端只消费分发事件。
+
+    管道满（block 策略）时接收循环暂停读取，形成背压；此期间心跳照常发送，
+    但未读到的 ACK 不计为丢失，避免过载被误判为僵死连接而引发重连和事件重放。
+    """
+
+    def __init__(self, uri: str, pipeline: MessagePipeline, config: Dict[str, Any] = None):
+        self.uri = uri
+        self.pipeline = pipeline
+        self.config = {**DEFAULT_GATEWAY_CONFIG, **(config or {})}
+        self.session_id: Optional[str] = None
+        self.last_seq: Optional[int] = None
+        self.websocket = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._ack_received = True
+        # 接收循环正在等待管道空位 / 上次心跳以来曾因背压暂停读取
+        self._blocked = False
+        self._stalled = False
+        self._attempt = 0
+        self._running = False
+
+    async def run(self):
+        """保持网关连接，直到被关闭或遇到无法恢复的错误"""
+        self._running = True
+        while self._running:
             try:
-                message = await websocket.recv()
-                loop = asyncio.get_event_loop()
-                loop.run_in_executor(
-                    executor, 
-                    lambda: asyncio.run_coroutine_threadsafe(
-                        process_message_wrapper(message), 
-                        loop
-                    )
-                )
-            except websockets.exceptions.ConnectionClosedOK:
-                logging.info("Connection closed normally.")
-                break
+                logging.info(f"Connecting to WebSocket server at {self.uri}...")
+                # 网关协议自带心跳，关闭库的 ping：背压暂停读取时库读不到 pong，会误关连接
+                async with websockets.connect(self.uri, ping_interval=None) as websocket:
+                    self.websocket = websocket
+                    logging.info("Connected to WebSocket server.")
+                    await self._receive_loop(websocket)
+                close_code = websocket.close_code
+                logging.info(f"Connection closed (code={close_code}).")
+            except websockets.exceptions.ConnectionClosed as e:
+                close_code = e.rcvd.code if e.rcvd else None
+                logging.warning(f"WebSocket connection lost (code={close_code}).")
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.InvalidHandshake) as e:
+                close_code = None
+                logging.error(f"WebSocket connect failed: {e}")
             except Exception as e:
+                close_code = None
                 logging.error(f"WebSocket error: {e}", exc_info=True)
+            finally:
+                self.websocket = None
+                await self._stop_heartbeat()
+
+            if not self._running:
+                break
+            if close_code in FATAL_CLOSE_CODES:
+                logging.error(f"网关返回不可恢复的关闭码 {close_code}，停止重连")
                 break
+            if close_code in SESSION_INVALID_CLOSE_CODES:
+                self._reset_session()
+            elif close_code == INVALID_TOKEN_CLOSE_CODE:
+                self._reset_session()
+                try:
+                    await token_manager.refresh()
+                except Exception as e:
+                    logging.error(f"刷新 access token 失败: {e}")
+
+            delay = self._backoff_delay()
+            self._attempt += 1
+            logging.info(f"{delay:.1f} 秒后重连（第 {self._attempt} 次）...")
+            await asyncio.sleep(delay)
+
+    async def close(self):
+        """停止重连并关闭当前连接"""
+        self._running = False
+        if self.websocket is not None:
+            await self.websocket.close()
+
+    def _backoff_delay(self) -> float:
+        """抖动指数退避：上限内取 [d/2, d] 的随机值，避免大量实例同时重连"""
+        ceiling = min(self.config['backoff_max'], self.config['backoff_base'] * (2 ** self._attempt))
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+    def _reset_session(self):
+        self.session_id = None
+        self.last_seq = None
+
+    async def _receive_loop(self, websocket):
+        async for message in websocket:
+            try:
+                with metrics.time('qqbot_stage_duration_seconds', {'stage': 'parse'}):
+                    frame = decode_frame(message)
+            except ValueError:
+                logging.error(f"无法解析的网关消息: {message!r:.200}")
+                continue
+            op = frame.op
+
+            if op == OP_DISPATCH:
+                if frame.s is not None:
+                    self.last_seq = frame.s
+                event_type = frame.t
+                if event_type == 'READY':
+                    self.session_id = frame.d.get('session_id')
+                    self._attempt = 0
+                    logging.info(f"网关鉴权成功，session_id={self.session_id}")
+                elif event_type == 'RESUMED':
+                    self._attempt = 0
+                    logging.info(f"网关会话已恢复，seq={self.last_seq}")
+                else:
+                    # 不发送 Hello 的转发服务在收到首条事件时视为连接成功
+                    self._attempt = 0
+                    if self.pipeline.saturated:
+                        self._stalled = self._blocked = True
+                        try:
+                            await self.pipeline.put(frame)
+                        finally:
+                            self._blocked = False
+                    else:
+                        await self.pipeline.put(frame)
 
-async def process_message_wrapper(message):
+            elif op == OP_HELLO:
+                interval = frame.d['heartbeat_interval'] / 1000
+                self._start_heartbeat(websocket, interval)
+                if self.session_id and self.last_seq is not None:
+                    await self._resume(websocket)
+                else:
+                    await self._identify(websocket)
+
+            elif op == OP_HEARTBEAT_ACK:
+                self._ack_received = True
+
+            elif op == OP_HEARTBEAT:
+                await self._send_heartbeat(websocket)
+
+            elif op == OP_RECONNECT:
+                logging.info("网关要求重连，准备恢复会话")
+                await websocket.close()
+                return
+
+            elif op == OP_INVALID_SESSION:
+                logging.warning("网关会话无效，将重新鉴权")
+                if not frame.d:
+                    self._reset_session()
+                await websocket.close()
+                return
+
+    async def _identify(self, websocket):
+        access_token = await fetch_access_token()
+        await websocket.send(dumps_str({
+            "op": OP_IDENTIFY,
+            "d": {
+                "token": f"QQBot {access_token}",
+                "intents": self.config['intents'],
+                "shard": list(self.config['shard']),
+                "properties": {}
+            }
+        }))
+        logging.info(f"已发送鉴权请求，shard={self.config['shard']}")
+
+    async def _resume(self, websocket):
+        access_token = await fetch_access_token()
+        await websocket.send(dumps_str({
+            "op": OP_RESUME,
+            "d": {
+                "token": f"QQBot {access_token}",
+                "session_id": self.session_id,
+                "seq": self.last_seq
+            }
+        }))
+        logging.info(f"正在恢复会话 session_id={self.session_id}, seq={self.last_seq}")
+
+    async def _send_heartbeat(self, websocket):
+        await websocket.send(dumps_str({"op": OP_HEARTBEAT, "d": self.last_seq}))
+
+    def _start_heartbeat(self, websocket, interval: float):
+        if self._heartbeat_task and not self._heartbeat_task.done():
+            self._heartbeat_task.cancel()
+        self._ack_received = True
+        self._stalled = False
+        self._heartbeat_task = asyncio.create_task(self._heartbeat_loop(websocket, interval))
+
+    async def _heartbeat_loop(self, websocket, interval: float):
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                if not self._ack_received and not self._stalled:
+                    # 上一次心跳没有收到 ACK，连接可能已僵死，主动断开以触发恢复
+                    logging.warning("心跳超时未收到ACK，主动断开连接")
+                    await websocket.close(code=4000)
+                    return
+                # 仍在等待管道时，下一个周期继续视为暂停读取
+                self._stalled = self._blocked
+                self._ack_received = False
+                await self._send_heartbeat(websocket)
+        except asyncio.CancelledError:
+            pass
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def _stop_heartbeat(self):
+        if self._heartbeat_task and not self._heartbeat_task.done():
+            self._heartbeat_task.cancel()
+            await asyncio.gather(self._heartbeat_task, return_exceptions=True)
+        self._heartbeat_task = None
+
+
+async def websocket_listener(uri, pipeline_config: Dict[str, Any] = None, gateway_config: Dict[str, Any] = None,
+                             dedup_config: Dict[str, Any] = None):
+    global pipeline, dedup
+    dedup = DedupIndex(dedup_config)
+    if dedup.config['enabled']:
+        await dedup.start()
+        metrics.register_gauge('qqbot_dedup_entries', lambda: dedup.stats()['size'] if dedup else None, '去重索引中的事件数')
+    else:
+        dedup = None
+    pipeline = MessagePipeline(process_message_wrapper, pipeline_config, key=conversation_key)
+    await pipeline.start()
+    metrics.register_gauge('qqbot_pipeline_depth', lambda: pipeline.stats()['depth'] if pipeline else None, '消息队列当前深度')
+    metrics.register_gauge('qqbot_pipeline_in_flight', lambda: pipeline.in_flight if pipeline else None, '正在处理的消息数')
+    client = GatewayClient(uri, pipeline, gateway_config)
+    try:
+        await client.run()
+    finally:
+        await client.close()
+        # 停止接收后排空队列中已接收的消息
+        await pipeline.stop()
+        if dedup is not None:
+            logging.info(f"去重索引已关闭: {dedup.stats()}")
+            await dedup.close()
+
+def conversation_key(frame) -> Optional[str]:
+    """消息所属的会话：群聊按群，单聊和好友事件按用户；管道按会话轮转调度"""
+    d = getattr(frame, 'd', None)
+    if not isinstance(d, dict):
+        return None
+    group_openid = d.get('group_openid')
+    if group_openid:
+        return group_openid
+    author = d.get('author')
+    if isinstance(author, dict) and author.get('user_openid'):
+        return author['user_openid']
+    return d.get('openid')
+
+async def process_message_wrapper(message) -> bool:
+    """处理一条网关消息，返回是否成功（失败计入管道的失败数）"""
+    event_key = None
     try:
-        data = json.loads(message)
-        logging.debug(f"Raw message data: {data}")
-        
-        if data['op'] == 0:
-            event_type = data['t']
-            access_token = await fetch_access_token()
-            
-            if event_type in ['GROUP_ADD_ROBOT', 'GROUP_DEL_ROBOT', 'FRIEND_ADD', 'FRIEND_DEL']:
-                await handle_event(data)
-            else:
-                await process_message(data, access_token)
-                
+        frame = as_frame(message)
+        # 惰性格式化：未开启 debug 时不会把整条消息转成字符串
+        logging.debug("Raw message data: %r", frame)
+
+        if frame.op == 0:
+            event_type = frame.t
+
+            # 重投的事件直接跳过，避免重复记录入群/退群和重复回复
+            if dedup is not None:
+                event_key = frame.event_key()
+                if event_key is not None and dedup.seen(event_key):
+                    logging.info(f"跳过重复事件: {event_key}")
+                    return True
+
+            with metrics.time('qqbot_stage_duration_seconds', {'stage': 'total'}):
+                if event_type in ['GROUP_ADD_ROBOT', 'GROUP_DEL_ROBOT', 'FRIEND_ADD', 'FRIEND_DEL']:
+                    ok = await handle_event(frame)
+                else:
+                    ok = await process_message(frame)
+            if not ok and event_key is not None:
+                # 处理失败的事件撤销去重登记，重投时可以再次处理
+                dedup.forget(event_key)
+            return ok
+        return True
+
     except Exception as e:
-        logging.error(f"Message processing failed: {e}", exc_info=True)
\ No newline at end of file
+        logging.error(f"Message processing failed: {e}", exc_info=True)
+        if event_key is not None:
+            dedup.forget(event_key)
+        return False